@@ -0,0 +1,70 @@
+"""Benchmark: per-recipient encoding against encode-once fan-out.
+
+Fills a match with N connected clients on discarding transports and times
+broadcasting lka bundles, once by calling sendAllowLockstep per client (the
+old path) and once through CastleMatch.broadcast_allow_lockstep.
+"""
+import argparse
+import time
+
+from castle_game import CastleGameCommand
+from castle_protocol import JSON_CODEC, BINARY_CODEC
+from castle_server import CastleServer, CastleMatch, CastleServerProtocol
+
+
+class NullTransport:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+def build_match(clients, codec):
+    server = CastleServer(None)
+    match = CastleMatch(server, 0)
+    for i in range(clients):
+        protocol = CastleServerProtocol(server)
+        protocol.transport = NullTransport()
+        protocol.codec = codec
+        match.add_player(protocol)
+    return match
+
+
+def per_recipient(match, cmds):
+    for player in match.players:
+        player.sendAllowLockstep(match.allowed_step, cmds)
+
+
+def encode_once(match, cmds):
+    match.broadcast_allow_lockstep(cmds)
+
+
+def measure(fn, match, cmds, rounds):
+    start = time.clock()
+    for i in range(rounds):
+        match.allowed_step += 1
+        fn(match, cmds)
+    return (time.clock() - start) / rounds
+
+
+def main(args):
+    build = CastleGameCommand.Build(1, CastleGameCommand.Build.HOUSE, 3, 4).serialize()
+    cmds = [[10, build], [10, build]]
+
+    print "{0:>8} {1:>6} {2:>16} {3:>16} {4:>8}".format("clients", "codec", "per-client us", "encode-once us", "speedup")
+    for clients in args.clients:
+        rounds = max(10, args.messages // clients)
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            match = build_match(clients, codec)
+            old = measure(per_recipient, match, cmds, rounds)
+            new = measure(encode_once, match, cmds, rounds)
+            print "{0:>8} {1:>6} {2:>16.1f} {3:>16.1f} {4:>7.1f}x".format(clients, codec.NAME, old * 1e6, new * 1e6, old / new)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark broadcast fan-out.")
+    parser.add_argument("-c", "--clients", type=int, nargs="+", default=[4, 64, 1024], dest="clients", help="connected client counts to test")
+    parser.add_argument("-m", "--messages", type=int, default=200000, dest="messages", help="approximate messages written per measurement")
+    args = parser.parse_args()
+    main(args)
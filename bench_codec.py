@@ -0,0 +1,66 @@
+"""Benchmark: JSON line codec against the binary codec.
+
+Reports encode/decode time per message and the bytes one player puts on
+the wire per lockstep (one "lkf" up, one "lka" down).
+"""
+import argparse
+import timeit
+
+from castle_game import CastleGameCommand
+from castle_protocol import JSON_CODEC, BINARY_CODEC
+
+
+def sample_messages():
+    build = CastleGameCommand.Build(1, CastleGameCommand.Build.HOUSE, 3, 4)
+    route = CastleGameCommand.Route(3, 4, [((192, 62, 62), 375, 275, 375, 325, 4), ((192, 62, 62), 375, 325, 425, 325, 4)])
+    return [
+        ("lkf", {"type": "lkf", "step": 1234, "hash": 851149338}),
+        ("lka", {"type": "lka", "step": 1236, "cmds": []}),
+        ("lka bundle", {"type": "lka", "step": 1236, "cmds": [[1235, build.serialize()], [1235, route.serialize()]]}),
+        ("cs", {"type": "cs", "state": 2}),
+        ("ap", {"type": "ap", "ownpos": 1, "allpos": [0, 1, 3]}),
+        ("cmd build", {"type": "cmd", "lturn": 1236, "cmd": build.serialize()}),
+        ("cmd route", {"type": "cmd", "lturn": 1236, "cmd": route.serialize()}),
+    ]
+
+
+def decode(codec, data):
+    if codec is JSON_CODEC:
+        return codec.decode_line(data[:-len(JSON_CODEC.DELIMITER)])
+    return codec.split_frames(data)[0][0]
+
+
+def bytes_per_lockstep(codec, messages):
+    by_name = dict(messages)
+    return len(codec.encode(by_name["lkf"])) + len(codec.encode(by_name["lka"]))
+
+
+def main(args):
+    messages = sample_messages()
+    print "{0:<10} {1:>6} {2:>6} {3:>12} {4:>12} {5:>12} {6:>12}".format(
+        "message", "json B", "bin B", "json enc us", "bin enc us", "json dec us", "bin dec us")
+    for name, ddict in messages:
+        row = [name]
+        encoded = {}
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            encoded[codec] = codec.encode(ddict)
+            assert decode(codec, encoded[codec])["type"] == ddict["type"]
+        row.append(len(encoded[JSON_CODEC]))
+        row.append(len(encoded[BINARY_CODEC]))
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            row.append(timeit.timeit(lambda: codec.encode(ddict), number=args.number) / args.number * 1e6)
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            data = encoded[codec]
+            row.append(timeit.timeit(lambda: decode(codec, data), number=args.number) / args.number * 1e6)
+        print "{0:<10} {1:>6} {2:>6} {3:>12.2f} {4:>12.2f} {5:>12.2f} {6:>12.2f}".format(*row)
+
+    print
+    print "bytes per lockstep per player: json {0}, binary {1}".format(
+        bytes_per_lockstep(JSON_CODEC, messages), bytes_per_lockstep(BINARY_CODEC, messages))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the wire codecs.")
+    parser.add_argument("-n", "--number", type=int, default=100000, dest="number", help="iterations per measurement")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+"""Benchmark: per-match lockstep latency as the number of concurrent matches grows.
+
+Starts runserver.py in a subprocess, fills it with scripted players and
+measures, for every player, the time between sending "lkf" for a step and
+receiving the "lka" that allows the next one.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor, defer, task
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+
+GAME_STATE_WAITING = 0
+GAME_STATE_READY = 1
+GAME_STATE_PLAYING = 2
+
+
+class BenchPlayer(LineReceiver):
+    def __init__(self, players_per_match, locksteps):
+        self.players_per_match = players_per_match
+        self.locksteps = locksteps
+        self.own_position = None
+        self.is_ready = False
+        self.step = 0
+        self.sent_time = None
+        self.latencies = []
+        self.started = defer.Deferred()
+        self.finished = defer.Deferred()
+
+    def connectionMade(self):
+        self.sendPayload({"type": "cs", "state": GAME_STATE_WAITING})
+
+    def sendPayload(self, ddict):
+        self.sendLine(json.dumps(ddict))
+
+    def lineReceived(self, line):
+        ddict = json.loads(line)
+        if ddict["type"] == "ap":
+            self.own_position = ddict["ownpos"]
+            if self.own_position is None:
+                free = [i for i in range(4) if i not in ddict["allpos"]]
+                if free:
+                    self.sendPayload({"type": "sp", "pos": free[0]})
+            elif len(ddict["allpos"]) >= self.players_per_match and not self.is_ready:
+                self.is_ready = True
+                self.sendPayload({"type": "cs", "state": GAME_STATE_READY})
+
+        elif ddict["type"] == "cs" and ddict["state"] == GAME_STATE_PLAYING:
+            self.sendPayload({"type": "cs", "state": GAME_STATE_PLAYING})
+            self.started.callback(self)
+
+        elif ddict["type"] == "lka":
+            if self.sent_time is not None and ddict["step"] > self.step + 1:
+                self.latencies.append(time.time() - self.sent_time)
+                self.sent_time = None
+            if self.sent_time is None and ddict["step"] > self.step + 1:
+                self.advance()
+
+    def advance(self):
+        if self.step >= self.locksteps:
+            if not self.finished.called:
+                self.finished.callback(self)
+            return
+        self.step += 1
+        self.sent_time = time.time()
+        self.sendPayload({"type": "lkf", "step": self.step, "hash": 0})
+
+
+class BenchPlayerFactory(ClientFactory):
+    def __init__(self, players_per_match, locksteps):
+        self.players_per_match = players_per_match
+        self.locksteps = locksteps
+        self.protocols = []
+
+    def buildProtocol(self, addr):
+        protocol = BenchPlayer(self.players_per_match, self.locksteps)
+        self.protocols.append(protocol)
+        return protocol
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+@defer.inlineCallbacks
+def run_round(host, port, matches, players_per_match, locksteps):
+    factory = BenchPlayerFactory(players_per_match, locksteps)
+    for i in range(matches):
+        group_start = len(factory.protocols)
+        for j in range(players_per_match):
+            reactor.connectTCP(host, port, factory)
+        # wait for this match to start before filling the next one
+        while len(factory.protocols) < group_start + players_per_match:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield defer.gatherResults([p.started for p in factory.protocols[group_start:]])
+
+    start_time = time.time()
+    for protocol in factory.protocols:
+        protocol.advance()
+    yield defer.gatherResults([p.finished for p in factory.protocols])
+    elapsed = time.time() - start_time
+
+    latencies = []
+    for protocol in factory.protocols:
+        latencies.extend(protocol.latencies)
+        protocol.transport.loseConnection()
+    yield task.deferLater(reactor, 0.5, lambda: None)
+
+    print "{0:>8} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>12.0f}".format(
+        matches, len(factory.protocols),
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000,
+        matches * locksteps / elapsed)
+
+
+@defer.inlineCallbacks
+def main(args):
+    print "{0:>8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>12}".format("matches", "players", "p50 ms", "p95 ms", "p99 ms", "steps/s")
+    try:
+        for matches in args.matches:
+            yield run_round(args.host, args.port, matches, args.players, args.locksteps)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-match lockstep latency.")
+    parser.add_argument("-p", "--port", type=int, default=9201, dest="port", help="port for the benchmark server")
+    parser.add_argument("-n", "--matches", type=int, nargs="+", default=[1, 8, 32, 128], dest="matches", help="match counts to test")
+    parser.add_argument("--players", type=int, default=4, dest="players", help="players per match")
+    parser.add_argument("--locksteps", type=int, default=200, dest="locksteps", help="locksteps per player")
+    parser.add_argument("-w", "--workers", type=int, default=0, dest="workers", help="match worker processes for the server")
+    args = parser.parse_args()
+    args.host = "127.0.0.1"
+
+    server = subprocess.Popen([sys.executable, "runserver.py", "-p", str(args.port), "-w", str(args.workers)])
+    time.sleep(1.0)
+    try:
+        reactor.callWhenRunning(main, args)
+        reactor.run()
+    finally:
+        server.terminate()
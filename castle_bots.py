@@ -0,0 +1,351 @@
+"""Headless bots that play real matches against a running server.
+
+Each bot speaks the client protocol (codec hello, menu -> waiting ->
+position -> ready -> playing), runs its own CastleGameModel like
+CastleClient does, and on a shared 30 FPS frame clock sends commands and
+"lkf" at the real lockstep cadence. CastleBotSwarm adds bots in stages
+and reports, per stage, what the bots saw of the server.
+
+The latencies are measured at the bot: from sending an "lkf" to reading
+the "lka" it unblocked. They include both network legs, waiting for the
+slowest bot of the match, and however late the bots' own reactor got to
+the socket, so they are an upper bound on the server's share. The "lag"
+column shows how far behind the bots' frame clock ran.
+"""
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor, defer, task
+
+from castle_game import CastleGameCommand, CastleGameModel
+from castle_game_entities import BasicBuilding, House
+from castle_protocol import CastleFramingMixin, BINARY_CODEC, JSON_CODEC
+
+import collections
+import random
+import time
+
+
+class CastleBot(CastleFramingMixin, LineReceiver):
+    """One scripted player. Plays by the lockstep rules of CastleClient, without pygame."""
+    PAYLOAD_TYPE_COMMAND = "cmd"
+    PAYLOAD_TYPE_STATE_CHANGE = "cs"
+    PAYLOAD_TYPE_ALL_POSITION = "ap"
+    PAYLOAD_TYPE_SELECT_POSITION = "sp"
+    PAYLOAD_TYPE_LOCKSTEP_FINISH = "lkf"
+    PAYLOAD_TYPE_LOCKSTEP_ALLOW = "lka"
+    PAYLOAD_TYPE_PING = "png"
+    PAYLOAD_TYPE_PONG = "pog"
+
+    # Same values as CastleClient
+    GAME_STATE_WAITING = 0
+    GAME_STATE_READY = 1
+    GAME_STATE_PLAYING = 2
+
+    # Markets are the cheapest building, see Market.__init__
+    MARKET_PRICE = 50
+
+    def __init__(self, swarm, rng):
+        self.swarm = swarm
+        self.random = rng
+        self.state = None
+        self.own_position = None
+        self.taken_positions = []
+        self.started = defer.Deferred()
+
+        self.model = None
+        self.player = None
+        self.frames_per_lock_step = None
+        self.input_delay = None
+        self.lock_step_id = 0
+        self.allowed_lockstep = 0
+        self.game_frame_id = 0
+        self.pending_commands = {}      # {turn: [commands]}
+        self.lkf_times = collections.deque()    # (allowed step the lkf can unblock, time sent)
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies = []     # lkf sent to lka read, seen from this bot
+        self.frames = 0
+        self.stalled_frames = 0
+        self.locksteps = 0
+        self.commands_sent = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # ==========
+    # Connection
+    # ==========
+    def connectionMade(self):
+        if self.swarm.use_binary:
+            self.requestCodec([BINARY_CODEC.NAME, JSON_CODEC.NAME])
+        self.changeState(self.GAME_STATE_WAITING)
+
+    def connectionLost(self, reason):
+        self.swarm.bot_lost(self)
+
+    def dataReceived(self, data):
+        self.bytes_in += len(data)
+        LineReceiver.dataReceived(self, data)
+
+    def writeData(self, data):
+        self.bytes_out += len(data)
+        CastleFramingMixin.writeData(self, data)
+
+    def changeState(self, state):
+        # state change: {"type": "cs", "state": state}
+        self.state = state
+        self.sendPayload({"type": self.PAYLOAD_TYPE_STATE_CHANGE, "state": state})
+
+    def payloadReceived(self, ddict):
+        if ddict["type"] == self.PAYLOAD_TYPE_LOCKSTEP_ALLOW:
+            # allow lockstep: {"type": "lka", "step": lockstep, "cmds": [[turn, cmd]]}
+            for turn, cmd in ddict["cmds"]:
+                self.pending_commands.setdefault(turn, []).append(CastleGameCommand.decode_command(cmd))
+            self.receive_allowed_lockstep(ddict["step"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_PING:
+            # ping: {"type": "png", "t": server_time}
+            self.sendPayload({"type": self.PAYLOAD_TYPE_PONG, "t": ddict["t"]})
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_ALL_POSITION:
+            # all position: {"type": "ap", "ownpos": ownpos, "allpos": [pos]}
+            if self.state == self.GAME_STATE_PLAYING:
+                return
+            self.own_position = ddict["ownpos"]
+            self.taken_positions = ddict["allpos"]
+            if self.own_position is None:
+                free = [i for i in range(4) if i not in self.taken_positions]
+                if free:
+                    # select position: {"type": "sp", "pos": pos}
+                    self.sendPayload({"type": self.PAYLOAD_TYPE_SELECT_POSITION, "pos": self.random.choice(free)})
+            elif len(self.taken_positions) >= self.swarm.players_per_match and self.state == self.GAME_STATE_WAITING:
+                self.changeState(self.GAME_STATE_READY)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_STATE_CHANGE:
+            # game start: {"type": "cs", "state": playing, "fpl": frames per lockstep, "delay": input delay}
+            if ddict["state"] == self.GAME_STATE_PLAYING:
+                self.start_game(ddict.get("fpl", 5), ddict.get("delay", 2))
+
+    # ========
+    # Lockstep
+    # ========
+    def start_game(self, frames_per_lock_step, input_delay):
+        self.frames_per_lock_step = frames_per_lock_step
+        self.input_delay = input_delay
+        self.model = CastleGameModel(None, self.taken_positions, self.own_position)
+        self.player = self.model.current_player
+        self.allowed_lockstep = input_delay
+        self.changeState(self.GAME_STATE_PLAYING)
+        self.started.callback(self)
+
+    def receive_allowed_lockstep(self, step):
+        self.allowed_lockstep = step
+        now = time.time()
+        while self.lkf_times and self.lkf_times[0][0] <= step:
+            self.latencies.append(now - self.lkf_times.popleft()[1])
+
+    def tick_frame(self):
+        # One client frame, as CastleClient.tick_ui does while playing
+        self.frames += 1
+        if self.game_frame_id == 0 and not self.tick_lock_step():
+            self.stalled_frames += 1
+            return
+        self.model.tick()
+        self.game_frame_id += 1
+        if self.game_frame_id >= self.frames_per_lock_step:
+            self.game_frame_id = 0
+
+    def tick_lock_step(self):
+        if self.lock_step_id + 1 >= self.allowed_lockstep:
+            return False
+        self.lock_step_id += 1
+        self.locksteps += 1
+        for cmd in self.pending_commands.pop(self.lock_step_id, []):
+            cmd.apply_to(self.model)
+        self.model.tick_lock_step()
+
+        # act before finishing the step, so the command's turn is never bundled yet
+        self.act()
+
+        # lockstep finish: {"type": "lkf", "step": lockstep, "hash": state hash after that step}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_LOCKSTEP_FINISH, "step": self.lock_step_id, "hash": self.model.state_hash})
+        self.lkf_times.append((self.lock_step_id + self.input_delay, time.time()))
+        return True
+
+    # =========
+    # Behaviour
+    # =========
+    def act(self):
+        # About swarm.apm actions a minute of play: build on free owned grids, route idle houses at enemy castles
+        locksteps_per_minute = 60.0 * self.swarm.FPS / self.frames_per_lock_step
+        if self.player.is_defeated or self.random.random() >= self.swarm.apm / locksteps_per_minute:
+            return
+
+        idle_houses = [x for x in self.player.buildings if isinstance(x, House) and x.path is None and x.state != x.STATE_BUILDING]
+        targets = [x.castle_grid for x in self.model.player_models if x is not self.player and not x.is_defeated]
+        if idle_houses and targets and self.random.random() < 0.5:
+            house = self.random.choice(idle_houses)
+            cmd = CastleGameCommand.Route(house.grid.x, house.grid.y, self.route(house, self.random.choice(targets)))
+        else:
+            free = [grid for row in self.model.board for grid in row
+                    if grid.building is None and self.own_position in grid.owners]
+            if not free or self.player.money < self.MARKET_PRICE:
+                return
+            grid = self.random.choice(free)
+            building = self.random.choice((CastleGameCommand.Build.HOUSE, CastleGameCommand.Build.HOUSE,
+                                           CastleGameCommand.Build.MARKET, CastleGameCommand.Build.TOWER))
+            if building != CastleGameCommand.Build.MARKET and self.player.money < BasicBuilding.DEFAULT_PRICE:
+                building = CastleGameCommand.Build.MARKET
+            cmd = CastleGameCommand.Build(self.own_position, building, grid.x, grid.y)
+
+        # game command: {"type": "cmd", "lturn": turn, "cmd": cmd.serialize()}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_COMMAND, "lturn": self.lock_step_id + self.input_delay, "cmd": cmd.serialize()})
+        self.commands_sent += 1
+
+    def route(self, house, target):
+        # Path dimensions of an L-shaped route, one grid per section, as House.route builds them
+        board = self.model.board
+        x, y = house.grid.x, house.grid.y
+        path_dim = []
+        while (x, y) != (target.x, target.y):
+            nx = x + cmp(target.x, x)
+            ny = y if nx != x else y + cmp(target.y, y)
+            path_dim.append((house.color, board[y][x].centerx, board[y][x].centery,
+                             board[ny][nx].centerx, board[ny][nx].centery, 4))
+            x, y = nx, ny
+        return path_dim
+
+
+class CastleBotFactory(ClientFactory):
+    def __init__(self, swarm):
+        self.swarm = swarm
+
+    def buildProtocol(self, addr):
+        bot = CastleBot(self.swarm, random.Random(self.swarm.random.random()))
+        self.swarm.bots.append(bot)
+        return bot
+
+    def clientConnectionFailed(self, connector, reason):
+        print "[ERROR][BOTS] Could not connect: {0}".format(reason.getErrorMessage())
+
+
+def percentile(values, percent):
+    # Nearest rank: the smallest value with at least percent of the values at or below it
+    ordered = sorted(values)
+    rank = (len(ordered) * percent + 99) // 100
+    return ordered[max(rank, 1) - 1]
+
+
+class CastleBotSwarm:
+    """Grows a population of bots in stages and measures each stage.
+
+    A stage counts as saturated once matches run slower than the lockstep
+    cadence allows (fewer than SATURATED_CADENCE of the locksteps a second
+    the server picked) or the bots' own frame clock falls behind, which
+    would make the numbers describe the load generator instead.
+    """
+    FPS = 30.0
+    SATURATED_CADENCE = 0.9
+    MAX_CLOCK_LAG = 0.5     # fraction of a frame the bot clock may lag on average
+
+    def __init__(self, host, port, players_per_match=4, apm=30.0, use_binary=True, seed=None):
+        self.host = host
+        self.port = port
+        self.players_per_match = players_per_match
+        self.apm = apm
+        self.use_binary = use_binary
+        self.random = random.Random(seed)
+        self.factory = CastleBotFactory(self)
+        self.bots = []
+        self.playing = []
+        self.frame_call = LoopingCall(self.tick_frames)
+        self.last_frame = None
+        self.clock_lag = 0.0
+        self.clock_frames = 0
+
+    def bot_lost(self, bot):
+        if bot in self.playing:
+            self.playing.remove(bot)
+
+    def tick_frames(self):
+        now = time.time()
+        if self.last_frame is not None:
+            self.clock_lag += max(0.0, now - self.last_frame - 1 / self.FPS)
+            self.clock_frames += 1
+        self.last_frame = now
+        for bot in self.playing:
+            bot.tick_frame()
+
+    @defer.inlineCallbacks
+    def add_bots(self, count):
+        # Fill one match at a time so every match gets exactly players_per_match bots
+        while len(self.bots) < count:
+            group_start = len(self.bots)
+            for i in range(self.players_per_match):
+                reactor.connectTCP(self.host, self.port, self.factory)
+            while len(self.bots) < group_start + self.players_per_match:
+                yield task.deferLater(reactor, 0.01, lambda: None)
+            group = self.bots[group_start:]
+            yield defer.gatherResults([bot.started for bot in group])
+            self.playing.extend(group)
+
+    @defer.inlineCallbacks
+    def run_stage(self, count, duration):
+        """Grow to count bots, measure for duration seconds and print one row.
+
+        The lka columns are milliseconds from an lkf to the lka it unblocked
+        as the bots saw them, reactor delay included; see the module docstring.
+        """
+        yield self.add_bots(count)
+        for bot in self.playing:
+            bot.reset_stats()
+        self.clock_lag = 0.0
+        self.clock_frames = 0
+        start = time.time()
+        yield task.deferLater(reactor, duration, lambda: None)
+        elapsed = time.time() - start
+
+        bots = list(self.playing)
+        latencies = [x for bot in bots for x in bot.latencies]
+        frames = sum(bot.frames for bot in bots)
+        target = sum(self.FPS / bot.frames_per_lock_step for bot in bots)
+        cadence = sum(bot.locksteps for bot in bots) / elapsed / target if target else 0.0
+        clock_lag = self.clock_lag / self.clock_frames * self.FPS if self.clock_frames else 0.0
+        saturated = cadence < self.SATURATED_CADENCE or clock_lag > self.MAX_CLOCK_LAG
+
+        print "{0:>6} {1:>8.1f} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>7.1%} {6:>8.1%} {7:>9.1f} {8:>9.1f} {9:>7.1f} {10:>7.1%}{11}".format(
+            len(bots),
+            percentile(latencies, 50) * 1000 if latencies else 0,
+            percentile(latencies, 95) * 1000 if latencies else 0,
+            percentile(latencies, 99) * 1000 if latencies else 0,
+            max(latencies) * 1000 if latencies else 0,
+            float(sum(bot.stalled_frames for bot in bots)) / frames if frames else 0,
+            cadence,
+            sum(bot.bytes_in for bot in bots) / elapsed / 1024,
+            sum(bot.bytes_out for bot in bots) / elapsed / 1024,
+            sum(bot.commands_sent for bot in bots) / elapsed,
+            clock_lag,
+            "  saturated" if saturated else "")
+        defer.returnValue(saturated)
+
+    @defer.inlineCallbacks
+    def run(self, counts, duration):
+        print "{0:>6} {1:>8} {2:>8} {3:>8} {4:>8} {5:>7} {6:>8} {7:>9} {8:>9} {9:>7} {10:>7}".format(
+            "bots", "lka p50", "lka p95", "lka p99", "lka max", "stall", "cadence", "in KB/s", "out KB/s", "cmd/s", "lag")
+        self.frame_call.start(1 / self.FPS)
+        saturated_at = None
+        try:
+            for count in counts:
+                saturated = yield self.run_stage(count, duration)
+                if saturated and saturated_at is None:
+                    saturated_at = len(self.playing)
+        finally:
+            self.frame_call.stop()
+            for bot in self.bots:
+                bot.transport.loseConnection()
+        if saturated_at is not None:
+            print "Saturated at {0} bots".format(saturated_at)
+        else:
+            print "Not saturated at {0} bots".format(len(self.playing))
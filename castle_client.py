@@ -4,13 +4,17 @@ from twisted.internet.task import LoopingCall   # Let Twisted run main loop
 from twisted.internet import reactor, defer
 
 from castle_game import CastleGameCommand, CastleGameModel
+from castle_protocol import CastleFramingMixin, BINARY_CODEC, JSON_CODEC
 
+import base64   # snapshots in JSON payloads
+import collections  # per-turn command queues
 import json     # For serializing dicts
+import threading    # optional network thread
 import time     # time
 import sys      # exit
 
 
-class CastleClientProtocol(LineReceiver):
+class CastleClientProtocol(CastleFramingMixin, LineReceiver):
     PAYLOAD_TYPE_COMMAND = "cmd"
     PAYLOAD_TYPE_STATE_CHANGE = "cs"
     PAYLOAD_TYPE_ALL_POSITION = "ap"
@@ -18,81 +22,147 @@ class CastleClientProtocol(LineReceiver):
     PAYLOAD_TYPE_LOCKSTEP_FINISH = "lkf"
     PAYLOAD_TYPE_LOCKSTEP_ALLOW = "lka"
     PAYLOAD_TYPE_ERROR = "err"
+    PAYLOAD_TYPE_PING = "png"
+    PAYLOAD_TYPE_PONG = "pog"
+    PAYLOAD_TYPE_REJOIN_TOKEN = "tk"
+    PAYLOAD_TYPE_REJOIN = "rj"
+    PAYLOAD_TYPE_REJOIN_STATE = "rs"
+    PAYLOAD_TYPE_SNAPSHOT = "snp"
+    PAYLOAD_TYPE_WATCH = "wt"
+    PAYLOAD_TYPE_WATCH_STATE = "ws"
 
     def __init__(self, client):
         self.client = client
 
     def connectionMade(self):
         if DEBUG: print "[INFO] Connection made with server:{0}".format(self.transport.getPeer())
+        if self.client.use_binary:
+            self.requestCodec([BINARY_CODEC.NAME, JSON_CODEC.NAME])
+        self.client.deliver(self.connected)
+
+    def connected(self):
         self.client.conn = self
+        if self.client.is_rejoining():
+            self.sendRejoin(*self.client.rejoin)
+        elif self.client.watch_match_id is not None:
+            self.sendWatch(self.client.watch_match_id)
 
     def connectionLost(self, reason):
         if DEBUG: print "[INFO] Connection lost from server:{0}".format(self.transport.getPeer())
+        self.client.deliver(self.disconnected)
+
+    def disconnected(self):
         self.client.conn = None
-        # TODO (SL): this should be a fatal error
+        self.client.connection_lost()
+
+    def payloadReceived(self, ddict):
+        # Frames are decoded on the reactor thread. Pings are answered right away so
+        # the latency the server measures leaves out the client's frame time
+        if ddict["type"] == self.PAYLOAD_TYPE_PING:
+            # ping: {"type": "png", "t": server_time}
+            self.sendPong(ddict["t"])
+        else:
+            self.client.deliver(self.handlePayload, ddict)
 
-    def lineReceived(self, line):
+    def handlePayload(self, ddict):
         # Received a response from the server
-        ddict = json.loads(line)
         if DEBUG: self.__logDumpLine(ddict)
 
         if ddict["type"] == self.PAYLOAD_TYPE_ERROR:
             # error: {"type": "err", "info": info}
             pass
 
-        elif ddict["type"] == self.PAYLOAD_TYPE_COMMAND:
-            # game command: {"type": "cmd", "lturn": cmd_dict["turn"], "cmd": cmd_dict["command"].serialize()}
-            # cmd_dict: {"turn": turn, "command": cmd}
-            cmd_dict = {"turn": ddict["lturn"], "command": CastleGameCommand.decode_command(ddict["cmd"])}
-            self.client.receive_game_command(cmd_dict)
-
         elif ddict["type"] == self.PAYLOAD_TYPE_STATE_CHANGE:
             # state change: {"type": "cs", "state": state}
-            # DEBUG
+            # game start also carries the lockstep settings: {"fpl": frames per lockstep, "delay": input delay}
             if ddict["state"] == self.client.GAME_STATE_PLAYING:
-                self.client.change_state_start_game()
+                self.client.change_state_start_game(ddict.get("fpl", self.client.GAME_FRAMES_PER_LOCK_STEP),
+                                                    ddict.get("delay", self.client.INPUT_DELAY))
 
         elif ddict["type"] == self.PAYLOAD_TYPE_ALL_POSITION:
             # all position: {"type": "ap", "ownpos": ownpos, "allpos": [pos]}
             self.client.receive_pos(ddict["ownpos"], ddict["allpos"])
 
         elif ddict["type"] == self.PAYLOAD_TYPE_LOCKSTEP_ALLOW:
-            # allow lockstep: {"type": "lka", "step": lockstep}
+            # allow lockstep: {"type": "lka", "step": lockstep, "cmds": [[turn, cmd]]}
+            # the server bundles every player's commands (ours included) for the newly allowed turns
+            for turn, cmd in ddict["cmds"]:
+                # cmd_dict: {"turn": turn, "command": cmd}
+                cmd_dict = {"turn": turn, "command": CastleGameCommand.decode_command(cmd)}
+                self.client.receive_game_command(cmd_dict)
             self.client.receive_allowed_lockstep(ddict["step"])
 
+        elif ddict["type"] == self.PAYLOAD_TYPE_REJOIN_TOKEN:
+            # rejoin token: {"type": "tk", "match": match_id, "token": token}
+            self.client.rejoin = (ddict["match"], ddict["token"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_REJOIN_STATE:
+            # rejoin state: {"type": "rs", "step": allowed step, "snap": base64 snapshot, "cmds": [[turn, cmd]],
+            #                "ownpos": pos, "allpos": [pos], "fpl": frames per lockstep, "delay": input delay}
+            self.client.receive_rejoin_state(ddict)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_WATCH_STATE:
+            # watch state: {"type": "ws", "step": watched step, "snap": base64 snapshot, "cmds": [[turn, cmd]],
+            #               "allpos": [pos], "fpl": frames per lockstep, "delay": input delay}
+            self.client.receive_watch_state(ddict)
+
+    def sendPayload(self, ddict):
+        # With a network thread, sends from the game thread are encoded and written there
+        if self.client.network_thread is not None and threading.current_thread() is not self.client.network_thread:
+            reactor.callFromThread(CastleFramingMixin.sendPayload, self, ddict)
+        else:
+            CastleFramingMixin.sendPayload(self, ddict)
+
     def sendCommandDict(self, cmd_dict):
         # cmd_dict: {"turn": turn, "command": cmd}
         # final dict: {"type": "cmd", "lturn": cmd_dict["turn"], "cmd": cmd_dict["command"].serialize()}
         final_cmd = {"type": self.PAYLOAD_TYPE_COMMAND,
                      "lturn": cmd_dict["turn"],
                      "cmd": cmd_dict["command"].serialize()}
-        payload = json.dumps(final_cmd)
         if DEBUG: self.__logDumpPayload(final_cmd)
-        self.sendLine(payload)
+        self.sendPayload(final_cmd)
 
     def sendPosSelection(self, pos):
         # select position: {"type": "sp", "pos": pos}
         pos_dict = {"type": self.PAYLOAD_TYPE_SELECT_POSITION,
                     "pos": pos}
-        payload = json.dumps(pos_dict)
         if DEBUG: self.__logDumpPayload(pos_dict)
-        self.sendLine(payload)
+        self.sendPayload(pos_dict)
 
     def sendStateChange(self, state):
         # state change: {"type": "cs", "state": state}
         change_dict = {"type": self.PAYLOAD_TYPE_STATE_CHANGE,
                        "state": state}
-        payload = json.dumps(change_dict)
         if DEBUG: self.__logDumpPayload(change_dict)
-        self.sendLine(payload)
+        self.sendPayload(change_dict)
 
-    def sendLockstepFinish(self, lockstep):
-        # lockstep finish: {"type": "lkf", "step": lockstep}
+    def sendLockstepFinish(self, lockstep, state_hash):
+        # lockstep finish: {"type": "lkf", "step": lockstep, "hash": state hash after that step}
         step_dict = {"type": self.PAYLOAD_TYPE_LOCKSTEP_FINISH,
-                     "step": lockstep}
-        payload = json.dumps(step_dict)
-        if DEBUG: self.__logDumpPayload(payload)
-        self.sendLine(payload)
+                     "step": lockstep,
+                     "hash": state_hash}
+        if DEBUG: self.__logDumpPayload(step_dict)
+        self.sendPayload(step_dict)
+
+    def sendPong(self, server_time):
+        # pong: {"type": "pog", "t": server_time}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_PONG, "t": server_time})
+
+    def sendRejoin(self, match_id, token):
+        # rejoin: {"type": "rj", "match": match_id, "token": token}
+        rejoin_dict = {"type": self.PAYLOAD_TYPE_REJOIN, "match": match_id, "token": token}
+        if DEBUG: self.__logDumpPayload(rejoin_dict)
+        self.sendPayload(rejoin_dict)
+
+    def sendWatch(self, match_id):
+        # watch: {"type": "wt", "match": match_id}
+        watch_dict = {"type": self.PAYLOAD_TYPE_WATCH, "match": match_id}
+        if DEBUG: self.__logDumpPayload(watch_dict)
+        self.sendPayload(watch_dict)
+
+    def sendSnapshot(self, lockstep, snapshot):
+        # snapshot: {"type": "snp", "step": lockstep, "snap": base64 snapshot}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_SNAPSHOT, "step": lockstep, "snap": base64.b64encode(snapshot)})
 
     def __logDumpPayload(self, payload):
         print "[INFO][SEND] {0}".format(payload)
@@ -113,12 +183,44 @@ class CastleClientProtocolFactory(ClientFactory):
 
 class CastleClient:
     """Castle game client class."""
-    # FPS requested
+    # Simulation ticks per second, a fixed timestep whatever the display does
     DESIRED_FPS = 30.0
+    TICK_LENGTH = 1.0 / DESIRED_FPS
+
+    # Frames drawn per second; frames the reactor could not fit in are dropped
+    DEFAULT_RENDER_FPS = 60.0
 
-    # 10 game frames per lockstep, 6 locksteps per second
-    # Realistically this would change based on network latency
+    # Key presses are picked up this often while playing, independent of the render
+    # rate. The turn a command gets only moves with the frames; polling in between
+    # just sends it sooner, leaving the server more time before that turn is bundled
+    INPUT_POLL_RATE = 250.0
+
+    # Ticks one frame may run to make up for a slow frame; time beyond that is given up
+    MAX_TICKS_PER_FRAME = 8
+
+    # A client that lost time (a pause, a stall, a window drag) is the one holding
+    # the others at the barrier, and the server allows it at most input_delay - 1
+    # locksteps ahead. As soon as one lockstep is allowed it runs the ticks it owes
+    # back to back without drawing, for at most this share of a render frame
+    CATCH_UP_LAG = 1
+    CATCH_UP_BUDGET = 0.5
+
+    # Time owed beyond this is given up rather than caught up
+    MAX_CATCH_UP_TIME = 3.0
+
+    # Defaults: 5 game frames per lockstep, 6 locksteps per second, and commands
+    # run 2 locksteps after they are issued. The server picks the values of each
+    # match from the measured network latency and sends them with the game start.
     GAME_FRAMES_PER_LOCK_STEP = 5
+    INPUT_DELAY = 2
+
+    # Upload a snapshot every this many locksteps so the server can hand it to
+    # a player that reconnects; it only has to keep the commands since then
+    SNAPSHOT_INTERVAL = 150
+
+    # Reconnecting to a running match after the connection dropped
+    RECONNECT_DELAY = 1.0
+    RECONNECT_ATTEMPTS = 10
 
     # Game states
     GAME_STATE_WAITING = 0
@@ -133,10 +235,27 @@ class CastleClient:
     lock_step_id = 0
 
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, use_binary=True, watch_match_id=None, render_fps=DEFAULT_RENDER_FPS, use_network_thread=False):
         self.current_state = self.GAME_STATE_MENU
-        self.pending_commands = []  # [{"turn": turn, "command": cmd}]
+        self.use_network_thread = use_network_thread    # reactor on its own thread, game loop on the main one
+        self.network_thread = None
+        self.inbox = collections.deque()    # (function, args) from the network thread, run by the game thread
+        self.running = True
+        self.render_fps = render_fps
+        self.accumulator = 0.0      # real time not simulated yet
+        self.last_frame_time = None
+        self.last_input_poll = None
+        self.input_since = None     # previous poll: key presses read now happened after it
+        self.dropped_frames = 0
+        self.max_lockstep_lag = 0
+        self.use_binary = use_binary  # negotiate the binary wire codec
+        self.watch_match_id = watch_match_id    # spectate this match instead of playing
+        self.spectating = False
+        self.pending_commands = {}  # {turn: deque of commands} in lka bundle order
+        self.local_commands = collections.deque()   # (turn, command) we sent, until their turn runs
         self.conn = None
+        self.rejoin = None          # (match_id, token) of the running match
+        self.reconnect_attempts = 0
 
         global DEBUG
         DEBUG = debug
@@ -147,8 +266,13 @@ class CastleClient:
 
     def set_game_gui(self, game_ui):
         self.game_ui = game_ui
-        self.ui_tick_call = LoopingCall(self.tick_ui)
-        self.ui_tick_call.start(1.0 / self.DESIRED_FPS)
+        if self.use_network_thread:
+            # run_game_loop ticks the UI instead
+            return
+        self.ui_tick_call = LoopingCall.withCount(self.tick_ui)
+        self.ui_tick_call.start(1.0 / self.render_fps)
+        self.input_poll_call = LoopingCall(self.poll_input)
+        self.input_poll_call.start(1.0 / self.INPUT_POLL_RATE)
 
     def set_game_model(self, model):
         self.game_model = model
@@ -156,10 +280,70 @@ class CastleClient:
     def connect(self):
         client_protocol_factory = CastleClientProtocolFactory(self)
         reactor.connectTCP(self.server_host, self.server_port, client_protocol_factory)
-        reactor.run()
+        if not self.use_network_thread:
+            reactor.run()
+            return
+        self.network_thread = threading.Thread(target=reactor.run, kwargs={"installSignalHandlers": False}, name="castle-network")
+        self.network_thread.daemon = True
+        self.network_thread.start()
+        self.run_game_loop()
+
+    def run_game_loop(self):
+        # Main thread loop when the reactor has its own thread: does what the
+        # LoopingCalls do otherwise, and runs the network events once per frame
+        frame_length = 1.0 / self.render_fps
+        poll_length = 1.0 / self.INPUT_POLL_RATE
+        next_frame = time.time()
+        while self.running and self.network_thread.is_alive():
+            now = time.time()
+            if now < next_frame:
+                self.poll_input()
+                time.sleep(min(next_frame - now, poll_length))
+                continue
+            count = int((now - next_frame) / frame_length) + 1
+            next_frame += count * frame_length
+            self.drain_inbox()
+            if self.running:
+                self.tick_ui(count)
+
+    def deliver(self, function, *args):
+        # Network events reach the game through here. With a network thread they wait
+        # in the inbox for the game thread; deque append and popleft need no lock
+        if self.network_thread is None:
+            function(*args)
+        else:
+            self.inbox.append((function, args))
+
+    def drain_inbox(self):
+        while self.inbox:
+            function, args = self.inbox.popleft()
+            function(*args)
+
+    def call_network(self, function, *args):
+        # Run function on the reactor thread
+        if self.network_thread is None:
+            function(*args)
+        else:
+            reactor.callFromThread(function, *args)
+
+    def is_rejoining(self):
+        return self.rejoin is not None and self.current_state == self.GAME_STATE_PLAYING
+
+    def connection_lost(self):
+        # In a running match, try to get the seat back; the others keep playing meanwhile
+        if not self.is_rejoining() or not reactor.running:
+            return
+        if self.reconnect_attempts >= self.RECONNECT_ATTEMPTS:
+            print "[ERROR] Could not rejoin match {0}".format(self.rejoin[0])
+            return
+        self.reconnect_attempts += 1
+        print "[INFO] Connection lost, rejoining match {0} (attempt {1})".format(self.rejoin[0], self.reconnect_attempts)
+        self.call_network(reactor.callLater, self.RECONNECT_DELAY, reactor.connectTCP, self.server_host, self.server_port,
+                          CastleClientProtocolFactory(self))
 
     def exit(self):
-        reactor.stop()
+        self.running = False
+        self.call_network(reactor.stop)
 
     # ==================
     # Game state changes
@@ -185,14 +369,19 @@ class CastleClient:
         self.current_state = self.GAME_STATE_READY
         self.conn.sendStateChange(self.current_state)
 
-    def change_state_start_game(self):
+    def change_state_start_game(self, frames_per_lock_step, input_delay):
+        self.frames_per_lock_step = frames_per_lock_step
+        self.input_delay = input_delay
+        if DEBUG: print "[INFO] Lockstep settings: {0} frames per lockstep, input delay {1}".format(frames_per_lock_step, input_delay)
+
         self.game_ui.start_game(self.taken_positions, self.own_position)
         self.game_ui.transition_to_playing()
         self.current_state = self.GAME_STATE_PLAYING
         self.conn.sendStateChange(self.current_state)
 
         self.game_frame_id = 0
-        self.allowed_lockstep = 2
+        self.allowed_lockstep = input_delay
+        self.reset_clock()
 
         # DEBUG
         if DEBUG:
@@ -202,7 +391,8 @@ class CastleClient:
     def change_state_finish(self):
         self.game_ui.transition_to_finish()
         self.current_state = self.GAME_STATE_FINISH
-        self.conn.sendStateChange(self.current_state)
+        if not self.spectating:
+            self.conn.sendStateChange(self.current_state)
 
     def change_state_end_game(self):
         self.current_state = self.GAME_STATE_MENU
@@ -215,28 +405,86 @@ class CastleClient:
         self.conn.sendPosSelection(pos)
 
     def receive_pos(self, ownpos, allpos):
+        if self.current_state == self.GAME_STATE_PLAYING:
+            # the lobby seats a reconnecting client before it reads the rejoin request
+            return
         self.own_position = ownpos
         self.taken_positions = allpos
 
     def receive_allowed_lockstep(self, step):
         self.allowed_lockstep = step
 
+    def receive_rejoin_state(self, ddict):
+        self.reconnect_attempts = 0
+        self.own_position = ddict["ownpos"]
+        start_step, caught_up = self.restore_match(ddict)
+        print "[INFO] Rejoined at lockstep {0}, caught up {1} locksteps in {2:.1f} ms".format(
+            self.lock_step_id, self.lock_step_id - start_step, caught_up * 1000)
+
+    def receive_watch_state(self, ddict):
+        # Spectators run the match read-only, watch delay locksteps behind the players
+        self.spectating = True
+        self.own_position = None
+        start_step, caught_up = self.restore_match(ddict)
+        self.game_ui.transition_to_spectating()
+        self.current_state = self.GAME_STATE_PLAYING
+        print "[INFO] Watching match {0} from lockstep {1}, caught up {2} locksteps in {3:.1f} ms".format(
+            self.watch_match_id, self.lock_step_id, self.lock_step_id - start_step, caught_up * 1000)
+
+    def restore_match(self, ddict):
+        # Restore the snapshot, then fast-forward through the command tail without drawing
+        self.taken_positions = ddict["allpos"]
+        self.frames_per_lock_step = ddict["fpl"]
+        self.input_delay = ddict["delay"]
+
+        model = CastleGameModel.restore(base64.b64decode(ddict["snap"]), self.game_ui, self.own_position)
+        self.game_ui.resume_game(model)
+        self.lock_step_id = model.lock_step_id
+        self.game_frame_id = 0
+        self.pending_commands = {}
+        self.local_commands.clear()
+        for turn, cmd in ddict["cmds"]:
+            self.receive_game_command({"turn": turn, "command": CastleGameCommand.decode_command(cmd)})
+        self.allowed_lockstep = ddict["step"]
+
+        start = time.time()
+        start_step = self.lock_step_id
+        while self.tick_lock_step():
+            self.game_model.advance(self.frames_per_lock_step)
+        self.reset_clock()
+        return start_step, time.time() - start
+
     # =====================
     # Game command handling
     # =====================
     def queue_command(self, cmd):
-        # Queue command to be executed AFTER the NEXT lockstep
-        cmd_dict = {"turn": self.lock_step_id + 2, "command": cmd}
-        self.pending_commands.append(cmd_dict)
-        self.conn.sendCommandDict(cmd_dict)
+        # Queue command to be executed input_delay locksteps from now
+        # The server sends it back in the bundle for that turn, so it isn't kept here
+        cmd_dict = {"turn": self.lock_step_id + self.input_delay, "command": cmd}
+        if self.conn is not None:
+            self.conn.sendCommandDict(cmd_dict)
+            self.local_commands.append((cmd_dict["turn"], cmd))
+            if DEBUG and self.input_since is not None:
+                print "[INFO][INPUT] Command for turn {0} sent at most {1:.1f} ms after the key press".format(
+                    cmd_dict["turn"], (time.time() - self.input_since) * 1000)
+
+    @property
+    def ghost_commands(self):
+        # Our own commands whose turn hasn't run, for the UI to draw ahead of time
+        return [cmd for turn, cmd in self.local_commands]
 
     def receive_game_command(self, cmd_dict):
-        self.pending_commands.append(cmd_dict)
+        # The server bundles a turn's commands ordered by player position, then arrival;
+        # keeping them in arrival order keeps every client applying them in that order
+        turn_commands = self.pending_commands.get(cmd_dict["turn"])
+        if turn_commands is None:
+            turn_commands = self.pending_commands[cmd_dict["turn"]] = collections.deque()
+        turn_commands.append(cmd_dict["command"])
 
     @property
     def ready_commands(self):
-        # Compute commands that are ready to be executed in the CURRENT lockstep
-        return [x for x in self.pending_commands if x["turn"] == self.lock_step_id]
+        # Commands to be executed in the CURRENT lockstep
+        return self.pending_commands.get(self.lock_step_id, ())
 
     # =================
     # Ticking mechanism
@@ -251,16 +499,25 @@ class CastleClient:
 
         if DEBUG: print "[INFO][TICK] {0}".format(self.lock_step_id)
 
-        for cmd in self.ready_commands:
-            if DEBUG: print "[INFO][CMD] {0}".format(cmd)
-            cmd["command"].apply_to(self.game_model)
-            self.pending_commands.remove(cmd)
+        # the model holds the end of the previous lockstep right now
+        if self.conn is not None and not self.spectating and (self.lock_step_id - 1) % self.SNAPSHOT_INTERVAL == 0 and self.lock_step_id > 1:
+            self.conn.sendSnapshot(self.lock_step_id - 1, self.game_model.snapshot())
+
+        ready_commands = self.pending_commands.pop(self.lock_step_id, None)
+        if ready_commands:
+            for cmd in ready_commands:
+                if DEBUG: print "[INFO][CMD] {0}".format(cmd)
+                cmd.apply_to(self.game_model)
+        # our commands of this turn are real now, or were rejected
+        while self.local_commands and self.local_commands[0][0] <= self.lock_step_id:
+            self.local_commands.popleft()
 
         # tick lock step for model
         self.game_model.tick_lock_step()
 
-        # message server to prevent desync
-        self.conn.sendLockstepFinish(self.lock_step_id)
+        # message server to prevent desync; the state hash lets it spot clients that diverged
+        if self.conn is not None and not self.spectating:
+            self.conn.sendLockstepFinish(self.lock_step_id, self.game_model.state_hash)
 
         # DEBUG: fps
         if DEBUG:
@@ -270,8 +527,91 @@ class CastleClient:
 
         return True
 
-    def tick_ui(self):
-        # Dispatcher for UI tick
+    def reset_clock(self):
+        # The simulation clock starts from now, with nothing owed
+        self.accumulator = 0.0
+        self.last_frame_time = time.time()
+        self.last_input_poll = self.last_frame_time
+
+    def tick_game_frame(self):
+        # One simulation tick. Every tick of an allowed lockstep is one game frame,
+        # so all clients run exactly frames_per_lock_step ticks per lockstep
+        if self.game_frame_id == 0:
+            # Every first game frame, we advance the lock step
+            if not self.tick_lock_step():
+                return False
+        self.game_model.tick()
+
+        # Increment game frame
+        self.game_frame_id += 1
+        if self.game_frame_id >= self.frames_per_lock_step:
+            self.game_frame_id = 0
+        return True
+
+    def poll_input(self):
+        # Read key presses between frames and send their commands right away. The
+        # frame polls too, before its simulation ticks, so the stamped turn is the
+        # same either way; only the send is earlier
+        if self.current_state != self.GAME_STATE_PLAYING or self.spectating:
+            return
+        now = time.time()
+        self.input_since, self.last_input_poll = self.last_input_poll, now
+        self.game_ui.handle_game_input()
+        self.input_since = None
+
+    def tick_simulation(self):
+        # Fixed timestep: run as many ticks as real time allows, returns (ticks, alpha)
+        # where alpha is how far into the next tick the frame is drawn
+        now = time.time()
+        self.accumulator += now - self.last_frame_time
+        self.last_frame_time = now
+
+        ticks = 0
+        while self.accumulator >= self.TICK_LENGTH and ticks < self.MAX_TICKS_PER_FRAME:
+            if not self.tick_game_frame():
+                # waiting for the server: the clock waits with the game
+                self.accumulator = self.TICK_LENGTH
+                break
+            self.accumulator -= self.TICK_LENGTH
+            ticks += 1
+        if self.accumulator > self.MAX_CATCH_UP_TIME:
+            # too far behind to be worth catching up
+            self.accumulator = self.MAX_CATCH_UP_TIME
+
+        ticks += self.catch_up()
+        return ticks, min(1.0, self.accumulator / self.TICK_LENGTH)
+
+    @property
+    def lockstep_lag(self):
+        # Locksteps the server already allows that this client has not run yet
+        return max(0, self.allowed_lockstep - 1 - self.lock_step_id)
+
+    def catch_up(self):
+        # Run the ticks still owed back to back while the server allows them, until
+        # caught up with real time or with the barrier, or out of budget
+        lag = self.lockstep_lag
+        self.max_lockstep_lag = max(self.max_lockstep_lag, lag)
+        if self.accumulator < self.TICK_LENGTH or (self.game_frame_id == 0 and lag < self.CATCH_UP_LAG):
+            return 0
+
+        deadline = time.time() + self.CATCH_UP_BUDGET / self.render_fps
+        ticks = 0
+        while self.accumulator >= self.TICK_LENGTH and time.time() < deadline and self.current_state == self.GAME_STATE_PLAYING:
+            if not self.tick_game_frame():
+                # reached the barrier: no longer the one the others wait for
+                self.accumulator = self.TICK_LENGTH
+                break
+            self.accumulator -= self.TICK_LENGTH
+            ticks += 1
+        if DEBUG: print "[INFO] Behind by {0} locksteps, caught up {1}".format(lag, lag - self.lockstep_lag)
+        return ticks
+
+    def tick_ui(self, count=1):
+        # Dispatcher for UI tick; count > 1 means the reactor skipped frames
+        if count > 1:
+            self.dropped_frames += count - 1
+            if DEBUG: print "[INFO] Dropped {0} render frames ({1} total)".format(count - 1, self.dropped_frames)
+
         if self.current_state == self.GAME_STATE_MENU:
             self.game_ui.ui_tick_menu()
         elif self.current_state == self.GAME_STATE_INSTRUCTIONS:
@@ -281,20 +621,17 @@ class CastleClient:
         elif self.current_state == self.GAME_STATE_READY:
             self.game_ui.ui_tick_ready()
         elif self.current_state == self.GAME_STATE_PLAYING:
-
-            # First process lockstep stuff
-            if self.game_frame_id == 0:
-                # Every first game frame, we advance the lock step
-                if not self.tick_lock_step():
-                    # If we failed to tick lockstep, make sure we try to tick again
-                    self.game_frame_id -= 1
-
-            # Increment game frame
-            self.game_frame_id += 1
-            if self.game_frame_id >= self.GAME_FRAMES_PER_LOCK_STEP:
-                self.game_frame_id = 0
-
-            self.game_ui.ui_tick_game()
+            # Read input before the turn can advance, simulate at the fixed rate,
+            # then draw once, in between the last two ticks
+            self.poll_input()
+            ticks, alpha = self.tick_simulation()
+            if self.current_state != self.GAME_STATE_PLAYING:
+                # the game ended during these ticks
+                return
+            if self.spectating:
+                self.game_ui.ui_tick_spectate(ticks, alpha)
+            else:
+                self.game_ui.ui_tick_game(ticks, alpha)
 
         elif self.current_state == self.GAME_STATE_FINISH:
             self.game_ui.ui_tick_finish()
@@ -1,6 +1,7 @@
-from castle_game_sprites import *
+from castle_game_entities import *
 import pickle
-import time
+import struct
+import zlib
 
 
 class CastleGameImmediateCommand:
@@ -107,8 +108,11 @@ class CastleGameCommand:
             self.path_dim = path_dim
 
         def apply_to(self, game):
-            # copy out route
+            # copy out route; the house's soldiers on the old route die with it
             house = game.board[self.house_y][self.house_x].building
+            if not isinstance(house, House):
+                # destroyed before the command's turn came
+                return
             house.reload_path_from_dimensions(self.path_dim)
 
         def serialize(self):
@@ -139,19 +143,12 @@ class CastleGameCommand:
 class CastleGamePlayerModel:
     """Castle game player class."""
 
-    # Label drawing
-    LABEL_LOCS = [(190, 50), (610, 50), (610, 450), (190, 450)]
-    LABEL_COLORS = [(118, 66, 200), (192, 62, 62), (39, 190, 173), (200, 146, 37)]
-
     # Default value
     INITIAL_MONEY = 50
     INITIAL_MONEY_INCREMENT = 5
 
-    last_time = 0
-    acc_time = 0
-
-    FONT_NAME = None
-    FONT_SIZE = 26
+    # Income is paid once per simulated second
+    TICKS_PER_INCOME = TICKS_PER_SECOND
 
     def __init__(self, game, pos, castle_grid):
         # TODO: clean this up
@@ -165,14 +162,12 @@ class CastleGamePlayerModel:
 
         self.money = self.INITIAL_MONEY
         self.money_increment = self.INITIAL_MONEY_INCREMENT
+        self.income_ticks = 0
 
         self._game = game
 
         self.is_defeated = False
 
-        # Labels
-        self.font = pygame.font.Font(self.FONT_NAME, self.FONT_SIZE)
-
     def __str__(self):
         return "<Player> {0}".format(self.pos)
 
@@ -202,68 +197,49 @@ class CastleGamePlayerModel:
     # =================
     # Ticking mechanism
     # =================
-    def update(self):
-        self.castle.update()
-        for building in self.buildings:
-            building.update()
-        for soldier in self.soldiers:
-            soldier.update()
-
-    def tick_lock_step(self):
-        # update money every second
-        current_time = time.time()
-        if self.last_time == 0:
-            self.last_time = current_time
-        else:
-            self.acc_time += current_time - self.last_time
-            self.last_time = current_time
-            while self.acc_time >= 1.0:
-                self.acc_time -= 1.0
-                self.money += self.money_increment
+    def tick(self):
+        # update money every simulated second
+        self.income_ticks += 1
+        if self.income_ticks == self.TICKS_PER_INCOME:
+            self.income_ticks = 0
+            self.money += self.money_increment
 
         for building in self.buildings:
-            building.tick_lock_step()
+            building.tick()
         for soldier in self.soldiers:
-            soldier.tick_lock_step()
-
-    # =============
-    # Label drawing
-    # =============
-    def draw(self, surface):
-        label_color = self.LABEL_COLORS[self.pos]
-        label_loc = self.LABEL_LOCS[self.pos]
-
-        if not self.is_defeated:
-            money_text = "${0}".format(self.money)
-            inc_text = "${0} / second".format(self.money_increment)
-        else:
-            money_text = "DEAD"
-            inc_text = "x_x"
-
-        money_label = None
-        inc_label = None
-
-        if self.pos == 0 or self.pos == 3:
-            # topright align
-            money_label = BasicLabel(money_text, self.font, label_color, topright=label_loc)
-            inc_label_loc = (label_loc[0], label_loc[1] + money_label.rect.height)
-            inc_label = BasicLabel(inc_text, self.font, label_color, topright=inc_label_loc)
-
-        elif self.pos == 1 or self.pos == 2:
-            # topleft align
-            money_label = BasicLabel(money_text, self.font, label_color, topleft=label_loc)
-            inc_label_loc = (label_loc[0], label_loc[1] + money_label.rect.height)
-            inc_label = BasicLabel(inc_text, self.font, label_color, topleft=inc_label_loc)
-
-        surface.blit(money_label.image, money_label.rect)
-        surface.blit(inc_label.image, inc_label.rect)
+            soldier.tick()
 
 
 class CastleGameModel:
-    """Castle game model class. This class represents the game state."""
+    """Castle game model class. This class represents the game state.
+
+    It does not depend on pygame: game_ui may be None and current_player_pos
+    may be None to run the rules headless. CastleGameRenderer draws it.
+    """
     WIDTH = 8
     HEIGHT = 8
 
+    # State hash records: player (pos, money, income, income ticks, defeated, castle hp),
+    # building (kind, owner, x, y, hp, state, step count), soldier (owner, x, y)
+    HASH_PLAYER = struct.Struct("!biiB?i")
+    HASH_BUILDING = struct.Struct("!cbBBiBi")
+    HASH_SOLDIER = struct.Struct("!bii")
+    # Locksteps between two hashes. Packing the state costs about as much as
+    # one of the ticks of a lockstep, and a desync is still found within a second
+    HASH_INTERVAL = 5
+
+    # Snapshot records, see snapshot()
+    SNAPSHOT_VERSION = 1
+    SNAP_HEADER = struct.Struct("!BIIB")        # version, lockstep id, state hash, player count
+    SNAP_PLAYER = struct.Struct("!biiH?iHH")    # pos, money, income, income ticks, defeated, castle hp, buildings, soldiers
+    SNAP_BUILDING = struct.Struct("!cBBiBH")    # kind, x, y, hp, state, step count
+    SNAP_HOUSE = struct.Struct("!?H")           # complete, path sections (NO_PATH for none)
+    SNAP_SECTION = struct.Struct("!BBBhhhhB")   # color, x1, y1, x2, y2, width
+    SNAP_SOLDIER = struct.Struct("!HhhBBH")     # house index in buildings, x, y, grid x, grid y, damage
+    SNAP_COUNT = struct.Struct("!H")
+    SNAP_GRID_SOLDIER = struct.Struct("!BbH")   # grid index, owner, index in that player's soldiers
+    NO_PATH = 0xffff
+
     def __init__(self, game_ui, all_players_pos, current_player_pos, debug=False):
         global DEBUG
         DEBUG = debug
@@ -298,7 +274,13 @@ class CastleGameModel:
             player = CastleGamePlayerModel(self, PLAYER_ORANGE, self.board[self.HEIGHT-1][0])
             self.player_models.append(player)
 
-        self.current_player = [x for x in self.player_models if x.pos == current_player_pos][0]
+        self.current_player = None
+        if current_player_pos is not None:
+            self.current_player = [x for x in self.player_models if x.pos == current_player_pos][0]
+
+        # CRC32 chained over the state every HASH_INTERVAL locksteps, sent with lkf
+        self.state_hash = 0
+        self.lock_step_id = 0
 
 
     def prepare_game(self, client):
@@ -306,7 +288,7 @@ class CastleGameModel:
 
     def check_end(self):
         surviving_players_count = reduce(lambda acc, itm: acc + 1 if not itm.is_defeated else acc, self.player_models, 0)
-        if surviving_players_count == 1:
+        if surviving_players_count == 1 and self.game_ui is not None:
             surviving_player = [x for x in self.player_models if not x.is_defeated][0]
             if surviving_player == self.current_player:
                 self.game_ui.is_winning_player = True
@@ -315,39 +297,177 @@ class CastleGameModel:
             self.game_ui.client.change_state_finish()
 
 
-    def tick_ui(self):
-        # called every ui frame
+    def tick(self):
+        # one simulation tick; clients run frames_per_lock_step of them per lockstep
         for player in self.player_models:
-            player.update()
+            player.tick()
 
-    def draw(self, surface):
-        # actual drawing
-        # draw board
-        for row in self.board:
-            for cell in row:
-                cell.draw(surface)
+    def advance(self, ticks):
+        # headless fast-forward, as fast as the rules can run
+        for i in xrange(ticks):
+            self.tick()
 
-        # draw user labels
-        for player in self.player_models:
-            player.draw(surface)
-
-        # draw paths
+    def tick_lock_step(self):
+        # called every lockstep, after the commands of that turn were applied
+        self.lock_step_id += 1
+        if self.lock_step_id % self.HASH_INTERVAL == 0:
+            self.state_hash = self.hash_state(self.state_hash)
+
+    def hash_state(self, previous=0):
+        # Packs the rules-relevant state into one string and folds it into the
+        # previous hash: one crc32 over a few hundred bytes, and a divergence
+        # seen by any hash shows up in every hash after it.
+        parts = []
         for player in self.player_models:
+            parts.append(self.HASH_PLAYER.pack(player.pos, player.money, player.money_increment, player.income_ticks,
+                                               player.is_defeated, player.castle.hp))
             for building in player.buildings:
-                if hasattr(building, "path") and building.path != None:
-                    for pathSection in building.path.pathSections:
-                        surface.blit(pathSection.image, pathSection.rect)
-
-        # draw soldiers
-        for player in self.player_models:
+                parts.append(self.HASH_BUILDING.pack(building.KIND, building.owner, building.grid.x, building.grid.y,
+                                                     building.hp, building.state, building.step_count))
             for soldier in player.soldiers:
-                surface.blit(soldier.image, soldier.rect)
+                parts.append(self.HASH_SOLDIER.pack(player.pos, soldier.current_x, soldier.current_y))
+        return zlib.crc32("".join(parts), previous) & 0xffffffff
+
+    # =========
+    # Snapshots
+    # =========
+    def snapshot(self):
+        # Whole game state as a compact string: header, then per player its
+        # buildings (houses with their path) and soldiers, then the owner
+        # stacks of all grids as one run of (count, owners...) bytes, then the
+        # soldiers standing on each grid. Grid buildings, tower
+        # neighbourhoods and colors are derived again by restore(). A route the
+        # player is still drawing lives in the UI and is not part of the game state.
+        parts = [self.SNAP_HEADER.pack(self.SNAPSHOT_VERSION, self.lock_step_id, self.state_hash, len(self.player_models))]
+        soldier_index = {}      # {soldier: (owner, index)}
+        for player in self.player_models:
+            parts.append(self.SNAP_PLAYER.pack(player.pos, player.money, player.money_increment, player.income_ticks,
+                                               player.is_defeated, player.castle.hp,
+                                               len(player.buildings), len(player.soldiers)))
+            building_index = {}
+            for i, building in enumerate(player.buildings):
+                building_index[building] = i
+                parts.append(self.SNAP_BUILDING.pack(building.KIND, building.grid.x, building.grid.y,
+                                                     building.hp, building.state, building.step_count))
+                if building.KIND == House.KIND:
+                    parts.append(self._pack_path(building))
+            for i, soldier in enumerate(player.soldiers):
+                soldier_index[soldier] = (player.pos, i)
+                parts.append(self.SNAP_SOLDIER.pack(building_index[soldier.house], soldier.current_x, soldier.current_y,
+                                                    soldier.current_grid.x, soldier.current_grid.y, soldier.damage))
+        owners = []
+        grid_soldiers = []
+        for y, row in enumerate(self.board):
+            for x, grid in enumerate(row):
+                owners.append(len(grid.owners))
+                owners.extend(grid.owners)
+                for soldier in grid.soldiers:
+                    grid_soldiers.append(self.SNAP_GRID_SOLDIER.pack(y * self.WIDTH + x, *soldier_index[soldier]))
+        parts.append(self.SNAP_COUNT.pack(len(owners)))
+        parts.append(struct.pack("!{0}b".format(len(owners)), *owners))
+        parts.append(self.SNAP_COUNT.pack(len(grid_soldiers)))
+        parts.extend(grid_soldiers)
+        return "".join(parts)
+
+    def _pack_path(self, house):
+        if house.path is None:
+            return self.SNAP_HOUSE.pack(house.complete, self.NO_PATH)
+        parts = [self.SNAP_HOUSE.pack(house.complete, len(house.path.pathSections))]
+        for section in house.path.pathSections:
+            color = tuple(section.color)
+            parts.append(self.SNAP_SECTION.pack(color[0], color[1], color[2],
+                                                section.x1, section.y1, section.x2, section.y2, section.width))
+        return "".join(parts)
 
+    @classmethod
+    def restore(cls, data, game_ui=None, current_player_pos=None):
+        # Rebuild a model from snapshot(); the result hashes and ticks exactly like the original
+        version, lock_step_id, state_hash, count = cls.SNAP_HEADER.unpack_from(data)
+        if version != cls.SNAPSHOT_VERSION:
+            raise ValueError("Unknown snapshot version: {0}".format(version))
+
+        # The roster comes from the player records, so find them all first
+        players = []    # [(player fields, offset of its buildings)]
+        offset = cls.SNAP_HEADER.size
+        for i in range(count):
+            fields = cls.SNAP_PLAYER.unpack_from(data, offset)
+            offset += cls.SNAP_PLAYER.size
+            players.append((fields, offset))
+            offset = cls._skip_player(data, offset, fields[6], fields[7])
+        grids_offset = offset
+
+        model = cls(game_ui, [x[0][0] for x in players], current_player_pos)
+        model.lock_step_id = lock_step_id
+        model.state_hash = state_hash
+
+        for player, (fields, offset) in zip(model.player_models, players):
+            player.money, player.money_increment, player.income_ticks, player.is_defeated, player.castle.hp = fields[1:6]
+            model._restore_player(data, offset, player, fields[6], fields[7])
+
+        offset = grids_offset
+        n = cls.SNAP_COUNT.unpack_from(data, offset)[0]
+        owners = struct.unpack_from("!{0}b".format(n), data, offset + cls.SNAP_COUNT.size)
+        offset += cls.SNAP_COUNT.size + n
+        i = 0
+        for row in model.board:
+            for grid in row:
+                count = owners[i]
+                grid.owners = list(owners[i + 1:i + 1 + count])
+                grid.soldiers = []
+                i += 1 + count
+
+        soldiers = dict((x.pos, x.soldiers) for x in model.player_models)
+        n = cls.SNAP_COUNT.unpack_from(data, offset)[0]
+        offset += cls.SNAP_COUNT.size
+        for i in range(n):
+            grid_index, owner, index = cls.SNAP_GRID_SOLDIER.unpack_from(data, offset)
+            offset += cls.SNAP_GRID_SOLDIER.size
+            model.board[grid_index // cls.WIDTH][grid_index % cls.WIDTH].soldiers.append(soldiers[owner][index])
+        return model
 
-    def tick_lock_step(self):
-        # called every lockstep
-        for player in self.player_models:
-            player.tick_lock_step()
+    @classmethod
+    def _skip_player(cls, data, offset, buildings, soldiers):
+        for i in range(buildings):
+            kind = data[offset]
+            offset += cls.SNAP_BUILDING.size
+            if kind == House.KIND:
+                sections = cls.SNAP_HOUSE.unpack_from(data, offset)[1]
+                offset += cls.SNAP_HOUSE.size
+                if sections != cls.NO_PATH:
+                    offset += sections * cls.SNAP_SECTION.size
+        return offset + soldiers * cls.SNAP_SOLDIER.size
+
+    def _restore_player(self, data, offset, player, buildings, soldiers):
+        for i in range(buildings):
+            kind, x, y, hp, state, step_count = self.SNAP_BUILDING.unpack_from(data, offset)
+            offset += self.SNAP_BUILDING.size
+            building = CastleGameCommand.Build.NAME_TO_CLS[kind](self, player, self.board[y][x])
+            building.hp, building.state, building.step_count = hp, state, step_count
+            self.board[y][x]._set_building(building)
+            player.add_building(building)
+            if kind == House.KIND:
+                offset = self._restore_path(data, offset, building)
+
+        for i in range(soldiers):
+            house_index, x, y, grid_x, grid_y, damage = self.SNAP_SOLDIER.unpack_from(data, offset)
+            offset += self.SNAP_SOLDIER.size
+            soldier = Soldier(player.buildings[house_index], self, player)
+            soldier.current_x, soldier.current_y, soldier.damage = x, y, damage
+            soldier.prev_x, soldier.prev_y = x, y
+            soldier.current_grid = self.board[grid_y][grid_x]
+
+    def _restore_path(self, data, offset, house):
+        house.complete, sections = self.SNAP_HOUSE.unpack_from(data, offset)
+        offset += self.SNAP_HOUSE.size
+        if sections == self.NO_PATH:
+            house.path = None
+            return offset
+        house.path = Path()
+        for i in range(sections):
+            fields = self.SNAP_SECTION.unpack_from(data, offset)
+            offset += self.SNAP_SECTION.size
+            house.path.pushBackPathSection(PathSection(fields[:3], *fields[3:]))
+        return offset
 
     # helpers
     def grids_surrounding(self, cx, cy):
@@ -0,0 +1,437 @@
+"""Board, building, soldier and path state of the Castle game.
+
+Nothing in here touches pygame, so the rules can run headless on the
+server, in bots and in tests. castle_game_sprites.CastleGameRenderer
+draws these objects.
+
+The simulation advances in fixed ticks, one per client frame at the
+nominal 30 frames per second, and never reads the clock: every counter
+below is in ticks and every position is in whole pixels, so the same
+commands give the same game on every machine and at any speed.
+"""
+
+PLAYER_NONE = -1
+PLAYER_PURPLE = 0
+PLAYER_PINK = 1
+PLAYER_CYAN = 2
+PLAYER_ORANGE = 3
+
+COLOR_DARK_PURPLE = (118, 66, 200)
+COLOR_DARK_CYAN = (39, 190, 173)
+COLOR_DARK_PINK = (192, 62, 62)
+COLOR_DARK_ORANGE = (200, 146, 37)
+PLAYER_COLOR_DARK = [COLOR_DARK_PURPLE, COLOR_DARK_PINK, COLOR_DARK_CYAN, COLOR_DARK_ORANGE]
+
+TICKS_PER_SECOND = 30
+
+
+class BoardGrid:
+    X_OFFSET = 200
+    Y_OFFSET = 50
+    WIDTH = 50
+    HEIGHT = 50
+    TRUE_WIDTH = 46
+    TRUE_HEIGHT = 46
+
+    def __init__(self, x, y):
+        self.owners = []
+        self.building = None
+        self.soldiers = []
+
+        self.x = x
+        self.y = y
+
+        # center of the grid in screen coordinates
+        self.centerx = self.X_OFFSET + self.WIDTH * x + self.WIDTH / 2
+        self.centery = self.Y_OFFSET + self.HEIGHT * y + self.HEIGHT / 2
+
+    def _set_owner(self, owner):
+        self.owners = [owner]
+
+    def add_owner(self, owner):
+        self.owners.append(owner)
+
+    def _set_building(self, building):
+        self.building = building
+
+    @property
+    def owner(self):
+        if self.building is None:
+            if len(self.owners) > 0:
+                return self.owners[-1]
+            else:
+                return PLAYER_NONE
+        else:
+            return self.building.owner
+
+
+class BasicBuilding(object):
+    KIND = "b"      # one byte naming the building in state hashes
+
+    STATE_BUILDING = 0
+    STATE_READY = 1
+    STATE_COOLDOWN = 2
+
+    COUNT_BUILDING_TO_READY = 5
+    COUNT_COOLDOWN_TO_READY = 3
+    step_count = 0
+
+    MAX_HP = 100
+    DEFAULT_PRICE = 100
+
+    def __init__(self, game, player, grid, max_hp=None, price=None):
+        self.player = player
+        self.game = game
+        self.grid = grid
+
+        self.owner = player.pos
+
+        # Game data
+        if max_hp is None:
+            self.max_hp = self.MAX_HP
+        else:
+            self.max_hp = max_hp
+        self.hp = self.max_hp
+
+        if price is None:
+            self.price = self.DEFAULT_PRICE
+        else:
+            self.price = price
+
+        self.state = self.STATE_BUILDING
+
+    def __str__(self):
+        return "<{0}> at ({1}, {2})".format(self.__class__, self.grid.x, self.grid.y)
+
+    def tick(self):
+        # called every simulation tick
+        pass
+
+    def isOwnedBy(self, player_pos):
+        return self.player.pos == player_pos
+
+    # ======
+    # Events
+    # ======
+    def destroyed(self):
+        self.grid._set_building(None)
+        if self in self.player.buildings:
+            print "========="
+            print "REMOVING"
+            print self
+            print self.player
+            print "========="
+            self.player.remove_building(self)
+
+    def hit_by_soldier(self, soldier):
+        if soldier.player.pos != self.owner:
+            # cause damange if the building and the soldier are different
+            soldier.die()
+            self.hp -= soldier.damage
+            if self.hp <= 0:
+                self.destroyed()
+
+
+class Castle(BasicBuilding):
+    KIND = "c"
+
+    def __init__(self, game, player, grid):
+        BasicBuilding.__init__(self, game, player, grid, max_hp=200)
+        self.state = self.STATE_READY
+
+    def destroyed(self):
+        # overriding destroyed to call player's defeated method
+        self.player.defeated()
+
+    def isOwnedBy(self, player_pos):
+        return self.player.pos == player_pos
+
+
+class House(BasicBuilding):
+    KIND = "h"
+    COUNT_BUILDING_TO_READY = 125   # ticks
+    COUNT_COOLDOWN_TO_READY = 125
+    step_count = 0
+
+    COLOR_DARK_CYAN = (39, 190, 173)
+    COLOR_DARK_PINK = (192, 62, 62)
+    COLOR_DARK_ORANGE = (200, 146, 37)
+    COLOR_DARK_PURPLE = (118, 66, 200)
+    COLORS = [COLOR_DARK_PURPLE, COLOR_DARK_PINK, COLOR_DARK_CYAN, COLOR_DARK_ORANGE] # TODO: Weird color order
+
+    def __init__(self, game, player, grid):
+        BasicBuilding.__init__(self, game, player, grid)
+        self.path = None
+        self.color = self.COLORS[player.pos]
+        self.complete = False
+        self.soldiers = []
+
+
+    def reload_path_from_dimensions(self, path_dim):
+        # Soldiers on the old path would have nowhere to go; every client
+        # drops them on the turn the new route is applied
+        for soldier in list(self.soldiers):
+            soldier.die()
+        self.reset_path()
+
+        self.path = Path()
+        self.complete = True
+        for section in path_dim:
+            new_section = PathSection(*section)
+            self.path.pushBackPathSection(new_section)
+
+    def reset_path(self):
+        self.complete = False
+        self.path = None
+
+    # =================
+    # Ticking mechanism
+    # =================
+    def tick(self):
+        # called every simulation tick for game logic
+        if self.state == self.STATE_BUILDING:
+            # count states
+            self.step_count += 1
+            if self.step_count == self.COUNT_BUILDING_TO_READY:
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_READY
+
+        elif self.state == self.STATE_READY and self.complete:
+            self.train_soldier()
+
+            # transition
+            self.step_count = 0
+            self.state = self.STATE_COOLDOWN
+
+        elif self.state == self.STATE_COOLDOWN:
+            # count states
+            self.step_count += 1
+            if self.step_count == self.COUNT_COOLDOWN_TO_READY:
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_READY
+
+    def train_soldier(self):
+        soldier = Soldier(self, self.game, self.player)
+
+    def destroyed(self):
+        super(House, self).destroyed()
+        for soldier in list(self.soldiers):
+            soldier.die()
+
+
+class Tower(BasicBuilding):
+    KIND = "t"
+
+    STATE_BUILDING = 0
+    STATE_READY = 1
+    STATE_COOLDOWN = 2
+
+    COUNT_BUILDING_TO_READY = 125   # ticks
+    COUNT_COOLDOWN_TO_READY = 225
+    step_count = 0
+
+    def __init__(self, game, player, grid):
+        BasicBuilding.__init__(self, game, player, grid)
+        # the tower never moves, so look up its neighbourhood once
+        self.surrounding_grids = game.grids_surrounding(grid.x, grid.y)
+
+    # =================
+    # Ticking mechanism
+    # =================
+    def tick(self):
+        # called every simulation tick for game logic
+        if self.state == self.STATE_BUILDING:
+            # count states
+            self.step_count += 1
+            if self.step_count == self.COUNT_BUILDING_TO_READY:
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_READY
+
+        elif self.state == self.STATE_READY:
+            if self.attack():
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_COOLDOWN
+
+        elif self.state == self.STATE_COOLDOWN:
+            # count states
+            self.step_count += 1
+            if self.step_count == self.COUNT_COOLDOWN_TO_READY:
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_READY
+
+    # ======
+    # Events
+    # ======
+    def attack(self):
+        for grid in self.surrounding_grids:
+            for soldier in grid.soldiers:
+                if soldier.player.pos != self.owner:
+                    soldier.die()
+                    return True
+
+        return False
+
+
+class Market(BasicBuilding):
+    KIND = "m"
+
+    STATE_BUILDING = 0
+    STATE_READY = 1
+
+    COUNT_BUILDING_TO_READY = 125   # ticks
+    step_count = 0
+
+    MONEY_INCREMENT = 5
+
+    def __init__(self, game, player, grid):
+        BasicBuilding.__init__(self, game, player, grid, price=50)
+
+    # =================
+    # Ticking mechanism
+    # =================
+    def tick(self):
+        # called every simulation tick for game logic
+        if self.state == self.STATE_BUILDING:
+            # count states
+            self.step_count += 1
+            if self.step_count == self.COUNT_BUILDING_TO_READY:
+                # transition
+                self.step_count = 0
+                self.state = self.STATE_READY
+                self.player.money_increment += self.MONEY_INCREMENT
+
+    def destroyed(self):
+        super(Market, self).destroyed()
+        self.player.money_increment -= self.MONEY_INCREMENT
+
+
+class Soldier:
+    SPEED = 2
+
+    DEFAULT_DAMAGE = 20
+
+    def __init__(self, house, game, player):
+        self.player = player
+        self.house = house
+        self.game = game
+
+        # Initially it's located at the house
+        self.current_grid = self.house.grid
+        self.current_x = self.house.grid.centerx
+        self.current_y = self.house.grid.centery
+
+        # Position before the last tick, only used to draw in between ticks
+        self.prev_x = self.current_x
+        self.prev_y = self.current_y
+
+        self.damage = self.DEFAULT_DAMAGE
+
+        self.house.soldiers.append(self)
+        self.player.soldiers.append(self)
+
+    # Movement per simulation tick, SPEED whole pixels at a time
+    def tick(self):
+        self.prev_x = self.current_x
+        self.prev_y = self.current_y
+        destination = self.house.path.next_destination(self.current_x, self.current_y)
+
+        if destination is not None:
+            # move towards destination
+            self.current_x = self._step_towards(self.current_x, destination[0])
+            self.current_y = self._step_towards(self.current_y, destination[1])
+
+            # check collision with grid
+            current_grid = self.game.grid_for_coordinates(self.current_x, self.current_y)
+            if current_grid is not self.current_grid:
+                # remove soldier from the previous grid, and install it in the new grid
+                # this is for easy tower attacking
+                if self in self.current_grid.soldiers:
+                    self.current_grid.soldiers.remove(self)
+                if self not in current_grid.soldiers:
+                    current_grid.soldiers.append(self)
+                self.current_grid = current_grid
+
+        current_grid = self.current_grid
+        if current_grid.building is not None:
+            # hit building
+            current_grid.building.hit_by_soldier(self)
+            if self in current_grid.soldiers:
+                current_grid.soldiers.remove(self)
+
+    def _step_towards(self, current, target):
+        if target - current >= self.SPEED:
+            return current + self.SPEED
+        elif current - target >= self.SPEED:
+            return current - self.SPEED
+        return target
+
+    # ======
+    # Events
+    # ======
+    def die(self):
+        if self in self.current_grid.soldiers:
+            self.current_grid.soldiers.remove(self)
+        if self in self.house.soldiers:
+            self.house.soldiers.remove(self)
+        if self in self.player.soldiers:
+            self.player.soldiers.remove(self)
+
+
+class Path:
+    def __init__(self):
+        self.destination = None
+        self.pathSections = []
+        self._next = {}     # {(x, y): next destination} memo, soldiers walk the same pixels
+
+    def pushBackPathSection(self, pathSection):
+        self.pathSections.append(pathSection)
+        self._next = {}
+
+    def popBackPathSection(self):
+        self.pathSections.pop(-1)
+        self._next = {}
+
+    def setDestination(self, enemy_building):
+        self.destination = enemy_building
+
+    def next_destination(self, soldier_x, soldier_y):
+        key = (soldier_x, soldier_y)
+        if key in self._next:
+            return self._next[key]
+
+        destination = None
+        for section in self.pathSections:
+            if section.contains_point(soldier_x, soldier_y):
+                destination = (section.x2, section.y2)
+                break
+        self._next[key] = destination
+        return destination
+
+
+class PathSection:
+    def __init__(self, color, x1, y1, x2, y2, width):
+        self.color = color
+        self.x1 = x1
+        self.y1 = y1
+        self.x2 = x2
+        self.y2 = y2
+        self.width = width
+
+    def contains_point(self, x, y):
+        if self.x1 == self.x2:
+            # vertical
+            if self.y2 > self.y1:
+                return abs(self.x1 - x) <= 2 and self.y1 <= y < self.y2
+            else:
+                return abs(self.x1 - x) <= 2 and self.y2 < y <= self.y1
+        else:
+            # horizontal
+            if self.x2 > self.x1:
+                return abs(self.y1 - y) <= 2 and self.x1 <= x < self.x2
+            else:
+                return abs(self.y1 - y) <= 2 and self.x2 < x <= self.x1
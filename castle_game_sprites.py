@@ -1,19 +1,7 @@
 import pygame
 from pygame.locals import *
 
-import math
-
-PLAYER_NONE = -1
-PLAYER_PURPLE = 0
-PLAYER_PINK = 1
-PLAYER_CYAN = 2
-PLAYER_ORANGE = 3
-
-COLOR_DARK_PURPLE = (118, 66, 200)
-COLOR_DARK_CYAN = (39, 190, 173)
-COLOR_DARK_PINK = (192, 62, 62)
-COLOR_DARK_ORANGE = (200, 146, 37)
-PLAYER_COLOR_DARK = [COLOR_DARK_PURPLE, COLOR_DARK_PINK, COLOR_DARK_CYAN, COLOR_DARK_ORANGE]
+from castle_game_entities import *
 
 # ===========
 # UI elements
@@ -161,16 +149,16 @@ class InstructionLabel(pygame.sprite.Sprite):
         label_color = self.LABEL_COLORS[pos]
 
         # Positioning
-        house_img = House.HOUSE_IMG[pos]
+        house_img = CastleGameRenderer.HOUSE_IMG[pos]
         house_rect = house_img.get_rect()
         house_rect.left = 0
         house_rect.centery = 26
 
-        market_img = Market.MARKET_IMG[pos]
+        market_img = CastleGameRenderer.MARKET_IMG[pos]
         market_rect = market_img.get_rect()
         market_rect.centery = 26
 
-        tower_img = Tower.TOWER_IMG[pos]
+        tower_img = CastleGameRenderer.TOWER_IMG[pos]
         tower_rect = tower_img.get_rect()
         tower_rect.centery = 26
 
@@ -208,636 +196,222 @@ class InstructionLabel(pygame.sprite.Sprite):
         self.rect.centery = centery
 
 
-# =======================
-# Sprites for actual game
-# =======================
-GAME_FRAMES_PER_LOCK_STEP = 5
 
-class BoardGrid(pygame.sprite.Sprite):
+
+# ===================
+# Rendering the board
+# ===================
+class CastleGameRenderer:
+    """Draws a CastleGameModel. All images and fonts of the game board live here."""
     GROUND_CYAN = pygame.image.load("assets/img/ground-cyan.png")
     GROUND_PINK = pygame.image.load("assets/img/ground-pink.png")
     GROUND_ORANGE = pygame.image.load("assets/img/ground-orange.png")
     GROUND_PURPLE = pygame.image.load("assets/img/ground-purple.png")
     GROUND_GREEN = pygame.image.load("assets/img/ground-green.png")
-
     GROUND_IMG = [GROUND_PURPLE, GROUND_PINK, GROUND_CYAN, GROUND_ORANGE, GROUND_GREEN]
 
-    X_OFFSET = 200
-    Y_OFFSET = 50
-    WIDTH = 50
-    HEIGHT = 50
-    TRUE_WIDTH = 46
-    TRUE_HEIGHT = 46
-
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        self.owners = []
-        self.building = None
-        self.soldiers = []
-
-        self.x = x
-        self.y = y
-
-        left = self.X_OFFSET + self.WIDTH * x + (self.WIDTH - self.TRUE_WIDTH) / 2
-        top = self.Y_OFFSET + self.HEIGHT * y + (self.HEIGHT - self.TRUE_HEIGHT) / 2
-        self.rect = pygame.Rect(left, top, self.TRUE_WIDTH, self.TRUE_HEIGHT)
-
-    def draw(self, surface):
-        # draw ground
-        surface.blit(self.image, self.rect)
-        # draw building
-        if self.building is not None:
-            surface.blit(self.building.image, self.building.rect)
-
-    def _set_owner(self, owner):
-        self.owners = [owner]
-
-    def add_owner(self, owner):
-        self.owners.append(owner)
-
-    def _set_building(self, building):
-        self.building = building
-
-    @property
-    def owner(self):
-        if self.building is None:
-            if len(self.owners) > 0:
-                return self.owners[-1]
-            else:
-                return PLAYER_NONE
-        else:
-            return self.building.owner
-
-    @property
-    def image(self):
-        return self.GROUND_IMG[self.owner]
-
-class BasicBuilding(pygame.sprite.Sprite):
     HAMMER_CYAN = pygame.image.load("assets/img/hammer-cyan.png")
     HAMMER_PINK = pygame.image.load("assets/img/hammer-pink.png")
     HAMMER_ORANGE = pygame.image.load("assets/img/hammer-orange.png")
     HAMMER_PURPLE = pygame.image.load("assets/img/hammer-purple.png")
     HAMMER_IMG = [HAMMER_PURPLE, HAMMER_PINK, HAMMER_CYAN, HAMMER_ORANGE]
 
-    STATE_BUILDING = 0
-    STATE_READY = 1
-    STATE_COOLDOWN = 2
-
-    COUNT_BUILDING_TO_READY = 5
-    COUNT_COOLDOWN_TO_READY = 3
-
-    MAX_HP = 100
-    DEFAULT_PRICE = 100
-
-    def __init__(self, game, player, _image, grid, max_hp=None, price=None):
-        pygame.sprite.Sprite.__init__(self)
-        self.player = player
-        self.game = game
-        self.grid = grid
-        self._image = _image
-        self._hammer_image = self.HAMMER_IMG[player.pos]
-        self._rect = self._image.get_rect()
-        self._rect.center = grid.rect.center
-        self._ui_frame_count = 0
-
-        self.owner = player.pos
-
-        # Game data
-        if max_hp is None:
-            self.max_hp = self.MAX_HP
-        else:
-            self.max_hp = max_hp
-        self.hp = self.max_hp
-
-        if price is None:
-            self.price = self.DEFAULT_PRICE
-        else:
-            self.price = price
-
-        self.state = self.STATE_BUILDING
-
-    def __str__(self):
-        return "<{0}> at ({1}, {2})".format(self.__class__, self.grid.x, self.grid.y)
-
-    def update(self):
-        # called every ui frame for animation
-        self._ui_frame_count = (self._ui_frame_count + 1) % 28
-
-    def tick_lock_step(self):
-        pass
-
-    def isOwnedBy(self, player_pos):
-        return self.player.pos == player_pos
-
-    # ======
-    # Events
-    # ======
-    def destroyed(self):
-        self.grid._set_building(None)
-        if self in self.player.buildings:
-            print "========="
-            print "REMOVING"
-            print self
-            print self.player
-            print "========="
-            self.player.remove_building(self)
-
-    def hit_by_soldier(self, soldier):
-        if soldier.player.pos != self.owner:
-            # cause damange if the building and the soldier are different
-            soldier.die()
-            self.hp -= soldier.damage
-            if self.hp <= 0:
-                self.destroyed()
-
-    @property
-    def image(self):
-        base_rect = self._image.get_rect()
-        img = pygame.Surface((base_rect.width, base_rect.height), pygame.SRCALPHA, 32).convert_alpha()
-        img.blit(self._image, base_rect)
-
-        if self.state == self.STATE_BUILDING:
-            # building state, we also blit a hammer
-            rotated = None
-            if self._ui_frame_count >= 14:
-                rotated = pygame.transform.rotate(self._hammer_image, 98 - self._ui_frame_count * 3.5)
-            else:
-                rotated = pygame.transform.rotate(self._hammer_image, self._ui_frame_count * 3.5)
-
-            rotated_rect = rotated.get_rect()
-            rotated_rect.center = base_rect.center
-            img.blit(rotated, rotated_rect)
-
-        if self.hp < self.max_hp:
-            # hp is not full, we also blit a hp bar
-            damage_fraction = float(self.max_hp - self.hp) / self.max_hp
-            bar_width = self.grid.rect.width
-            bar_height = int(self.grid.rect.height * damage_fraction)
-
-            damage_bar = pygame.Surface((bar_width, bar_height))
-            damage_bar.fill(PLAYER_COLOR_DARK[self.owner])
-            damage_bar.set_alpha(100)
-
-            damage_rect = damage_bar.get_rect()
-            damage_rect.bottom = self.grid.rect.height
-
-            img.blit(damage_bar, damage_rect)
-
-        return img
-
-    @property
-    def rect(self):
-        return self._rect
-
-
-class Castle(BasicBuilding):
     CASTLE_CYAN = pygame.image.load("assets/img/castle-cyan.png")
     CASTLE_PINK = pygame.image.load("assets/img/castle-pink.png")
     CASTLE_ORANGE = pygame.image.load("assets/img/castle-orange.png")
     CASTLE_PURPLE = pygame.image.load("assets/img/castle-purple.png")
     CASTLE_IMG = [CASTLE_PURPLE, CASTLE_PINK, CASTLE_CYAN, CASTLE_ORANGE]
 
-    def __init__(self, game, player, grid):
-        BasicBuilding.__init__(self, game, player, self.CASTLE_IMG[player.pos], grid, max_hp=200)
-        self.state = self.STATE_READY
-
-    def destroyed(self):
-        # overriding destroyed to call player's defeated method
-        self.player.defeated()
-
-    def isOwnedBy(self, player_pos):
-        return self.player.pos == player_pos
-
-
-class House(BasicBuilding):
     HOUSE_CYAN = pygame.image.load("assets/img/house-cyan.png")
     HOUSE_PINK = pygame.image.load("assets/img/house-pink.png")
     HOUSE_ORANGE = pygame.image.load("assets/img/house-orange.png")
     HOUSE_PURPLE = pygame.image.load("assets/img/house-purple.png")
     HOUSE_IMG = [HOUSE_PURPLE, HOUSE_PINK, HOUSE_CYAN, HOUSE_ORANGE]
 
-    COUNT_BUILDING_TO_READY = 5 * GAME_FRAMES_PER_LOCK_STEP
-    COUNT_COOLDOWN_TO_READY = 5 * GAME_FRAMES_PER_LOCK_STEP
-    step_count = 0
-
-    COLOR_DARK_CYAN = (39, 190, 173)
-    COLOR_DARK_PINK = (192, 62, 62)
-    COLOR_DARK_ORANGE = (200, 146, 37)
-    COLOR_DARK_PURPLE = (118, 66, 200)
-    COLORS = [COLOR_DARK_PURPLE, COLOR_DARK_PINK, COLOR_DARK_CYAN, COLOR_DARK_ORANGE] # TODO: Weird color order
-
-    ROUTE_UP = 1
-    ROUTE_DOWN = 2
-    ROUTE_LEFT = 3
-    ROUTE_RIGHT = 4
-    ROUTE_CANCEL = 5
-
-    def __init__(self, game, player, grid):
-        BasicBuilding.__init__(self, game, player, self.HOUSE_IMG[player.pos], grid)
-        self.is_routing = False
-        self.prev_x = None # default of the end point of previous route
-        self.prev_y = None
-        self.x = None # stores the locatio
-        self.y = None
-        self.path = None
-        self.path_dim = [] # used for pickling of the path object
-        self.dir_list = [] # list of directions
-        self.color = self.COLORS[player.pos]
-        self.complete = False
-        self.soldiers = []
-
-
-    def reload_path_from_dimensions(self, path_dim):
-        self.reset_path()
-
-        self.path = Path()
-        self.complete = True
-        for section in path_dim:
-            new_section = PathSection(*section)
-            self.path.pathSections.append(new_section)
-
-    def reset_path(self):
-        self.complete = False
-        self.path = None
-
-    # =================
-    # Ticking mechanism
-    # =================
-    def tick_lock_step(self):
-        # called every lockstep for game logic
-        if self.state == self.STATE_BUILDING:
-            # count states
-            self.step_count += 1
-            if self.step_count == self.COUNT_BUILDING_TO_READY:
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_READY
-
-        elif self.state == self.STATE_READY and self.complete:
-            self.train_soldier()
-
-            # transition
-            self.step_count = 0
-            self.state = self.STATE_COOLDOWN
-
-        elif self.state == self.STATE_COOLDOWN:
-            # count states
-            self.step_count += 1
-            if self.step_count == self.COUNT_COOLDOWN_TO_READY:
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_READY
-
-    # ======
-    # Events
-    # ======
-    def route(self, direction, x, y): # x, y is the current cursor location in terms of grids
-        if not self.is_routing: # starts routing
-            self.is_routing = True
-            self.path = Path()
-            self.x = 225 + 50 * x
-            self.y = 75 + 50 * y
-            self.prev_x = self.x
-            self.prev_y = self.y
-            self.dir_list = []
-            self.path_dim = []
-
-            for soldier in self.soldiers:
-                soldier.die()
-
-            self.complete = False
-            return
-
-        if direction == self.ROUTE_CANCEL:
-            self.is_routing = False
-            self.path = None
-            self.prev_x = self.x
-            self.prev_y = self.y
-            self.path_dim = []
-            self.dir_list = []
-            self.complete = False
-            return
-
-        if 225 + 50 * x == self.prev_x and 75 + 50 * y == self.prev_y: # check bounds
-            return
-
-        if direction == self.ROUTE_UP:
-            if self.dir_list and self.dir_list[-1] == self.ROUTE_DOWN:
-                if self.path.pathSections:
-                    self.prev_x = self.path.pathSections[-1].x1
-                    self.prev_y = self.path.pathSections[-1].y1
-                    self.path.popBackPathSection()
-                if self.path_dim: self.path_dim.pop(-1)
-                self.dir_list.pop(-1)
-            else:
-                self.path_dim.append((self.color, self.prev_x, self.prev_y, self.prev_x, self.prev_y - 50, 4))
-                new_path = PathSection(self.color, self.prev_x, self.prev_y, self.prev_x, self.prev_y - 50, 4)
-                self.prev_y = self.prev_y - 50
-                self.path.pushBackPathSection(new_path)
-                self.dir_list.append(direction)
-        elif direction == self.ROUTE_DOWN:
-            if self.dir_list and self.dir_list[-1] == self.ROUTE_UP:
-                if self.path.pathSections:
-                    self.prev_x = self.path.pathSections[-1].x1
-                    self.prev_y = self.path.pathSections[-1].y1
-                    self.path.popBackPathSection()
-                if self.path_dim: self.path_dim.pop(-1)
-                self.dir_list.pop(-1)
-            else:
-                self.path_dim.append((self.color, self.prev_x, self.prev_y, self.prev_x, self.prev_y + 50, 4))
-                new_path = PathSection(self.color, self.prev_x, self.prev_y, self.prev_x, self.prev_y + 50, 4)
-                self.prev_y = self.prev_y + 50
-                self.path.pushBackPathSection(new_path)
-                self.dir_list.append(direction)
-        elif direction == self.ROUTE_LEFT:
-            if self.dir_list and self.dir_list[-1] == self.ROUTE_RIGHT:
-                if self.path.pathSections:
-                    self.prev_x = self.path.pathSections[-1].x1
-                    self.prev_y = self.path.pathSections[-1].y1
-                    self.path.popBackPathSection()
-                if self.path_dim: self.path_dim.pop(-1)
-                self.dir_list.pop(-1)
-            else:
-                self.path_dim.append((self.color, self.prev_x, self.prev_y, self.prev_x - 50, self.prev_y, 4))
-                new_path = PathSection(self.color, self.prev_x, self.prev_y, self.prev_x - 50, self.prev_y, 4)
-                self.prev_x = self.prev_x - 50
-                self.path.pushBackPathSection(new_path)
-                self.dir_list.append(direction)
-        elif direction == self.ROUTE_RIGHT:
-            if self.dir_list and self.dir_list[-1] == self.ROUTE_LEFT:
-                if self.path.pathSections:
-                    self.prev_x = self.path.pathSections[-1].x1
-                    self.prev_y = self.path.pathSections[-1].y1
-                    self.path.popBackPathSection()
-                if self.path_dim: self.path_dim.pop(-1)
-                self.dir_list.pop(-1)
-            else:
-                self.path_dim.append((self.color, self.prev_x, self.prev_y, self.prev_x + 50, self.prev_y, 4))
-                new_path = PathSection(self.color, self.prev_x, self.prev_y, self.prev_x + 50, self.prev_y, 4)
-                self.prev_x = self.prev_x + 50
-                self.path.pushBackPathSection(new_path)
-                self.dir_list.append(direction)
-        building_at_new_pos = self.game.grid_for_coordinates(self.prev_x, self.prev_y).building
-        if building_at_new_pos != None and not building_at_new_pos.isOwnedBy(self.player.pos):
-            self.is_routing = False
-            self.path.destination = building_at_new_pos
-            self.dir_list = []
-
-
-    def train_soldier(self):
-        soldier = Soldier(self, self.game, self.player)
-
-    def destroyed(self):
-        super(House, self).destroyed()
-        for soldier in self.soldiers:
-            soldier.die()
-
-
-class Tower(BasicBuilding):
     TOWER_CYAN = pygame.image.load("assets/img/tower-cyan.png")
     TOWER_PINK = pygame.image.load("assets/img/tower-pink.png")
     TOWER_ORANGE = pygame.image.load("assets/img/tower-orange.png")
     TOWER_PURPLE = pygame.image.load("assets/img/tower-purple.png")
     TOWER_IMG = [TOWER_PURPLE, TOWER_PINK, TOWER_CYAN, TOWER_ORANGE]
 
-    STATE_BUILDING = 0
-    STATE_READY = 1
-    STATE_COOLDOWN = 2
-
-    COUNT_BUILDING_TO_READY = 5 * GAME_FRAMES_PER_LOCK_STEP
-    COUNT_COOLDOWN_TO_READY = 9 * GAME_FRAMES_PER_LOCK_STEP
-    step_count = 0
-
-    def __init__(self, game, player, grid):
-        BasicBuilding.__init__(self, game, player, self.TOWER_IMG[player.pos], grid)
-
-    # =================
-    # Ticking mechanism
-    # =================
-    def tick_lock_step(self):
-        # called every lockstep for game logic
-        if self.state == self.STATE_BUILDING:
-            # count states
-            self.step_count += 1
-            if self.step_count == self.COUNT_BUILDING_TO_READY:
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_READY
-
-        elif self.state == self.STATE_READY:
-            if self.attack():
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_COOLDOWN
-
-        elif self.state == self.STATE_COOLDOWN:
-            # count states
-            self.step_count += 1
-            if self.step_count == self.COUNT_COOLDOWN_TO_READY:
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_READY
-
-    # ======
-    # Events
-    # ======
-    def attack(self):
-        surrounding_grids = self.game.grids_surrounding(self.grid.x, self.grid.y)
-
-        for grid in surrounding_grids:
-            for soldier in grid.soldiers:
-                if soldier.player.pos != self.owner:
-                    soldier.die()
-                    return True
-
-        return False
-
-
-class Market(BasicBuilding):
     MARKET_CYAN = pygame.image.load("assets/img/market-cyan.png")
     MARKET_PINK = pygame.image.load("assets/img/market-pink.png")
     MARKET_ORANGE = pygame.image.load("assets/img/market-orange.png")
     MARKET_PURPLE = pygame.image.load("assets/img/market-purple.png")
     MARKET_IMG = [MARKET_PURPLE, MARKET_PINK, MARKET_CYAN, MARKET_ORANGE]
 
-    STATE_BUILDING = 0
-    STATE_READY = 1
-
-    COUNT_BUILDING_TO_READY = 5 * GAME_FRAMES_PER_LOCK_STEP
-    step_count = 0
-
-    MONEY_INCREMENT = 5
-
-    def __init__(self, game, player, grid):
-        BasicBuilding.__init__(self, game, player, self.MARKET_IMG[player.pos], grid, price=50)
-
-    # =================
-    # Ticking mechanism
-    # =================
-    def tick_lock_step(self):
-        # called every lockstep for game logic
-        if self.state == self.STATE_BUILDING:
-            # count states
-            self.step_count += 1
-            if self.step_count == self.COUNT_BUILDING_TO_READY:
-                # transition
-                self.step_count = 0
-                self.state = self.STATE_READY
-                self.player.money_increment += self.MONEY_INCREMENT
-
-    def destroyed(self):
-        super(Market, self).destroyed()
-        self.player.money_increment -= self.MONEY_INCREMENT
-
-
-class Soldier(pygame.sprite.Sprite):
     SOLDIER_CYAN = pygame.image.load("assets/img/soldier-cyan.png")
     SOLDIER_PINK = pygame.image.load("assets/img/soldier-pink.png")
     SOLDIER_ORANGE = pygame.image.load("assets/img/soldier-orange.png")
     SOLDIER_PURPLE = pygame.image.load("assets/img/soldier-purple.png")
-
     SOLDIER_IMG = [SOLDIER_PURPLE, SOLDIER_PINK, SOLDIER_CYAN, SOLDIER_ORANGE]
 
-    SPEED = 2
-
-    DEFAULT_DAMAGE = 20
+    BUILDING_IMG = {Castle: CASTLE_IMG, House: HOUSE_IMG, Tower: TOWER_IMG, Market: MARKET_IMG}
 
-    def __init__(self, house, game, player):
-        pygame.sprite.Sprite.__init__(self)
-        self.player = player
-        self.house = house
-        self.game = game
-        self._image = self.SOLDIER_IMG[player.pos]
+    # Label drawing
+    LABEL_LOCS = [(190, 50), (610, 50), (610, 450), (190, 450)]
+    LABEL_COLORS = [(118, 66, 200), (192, 62, 62), (39, 190, 173), (200, 146, 37)]
 
-        # Initially it's located at the house
-        self.current_grid = self.house.grid
-        self._canonical_rect = self._image.get_rect()
-        self.current_x = self.house.rect.centerx
-        self.current_y = self.house.rect.centery
+    FONT_NAME = None
+    FONT_SIZE = 26
 
-        self.lockstep_x = self.current_x
-        self.lockstep_y = self.current_y
+    HAMMER_PERIOD = 28
 
-        self.damage = self.DEFAULT_DAMAGE
+    def __init__(self, game):
+        self.game = game
+        self.font = pygame.font.Font(self.FONT_NAME, self.FONT_SIZE)
+        self._ui_frame_count = 0
 
-        self.house.soldiers.append(self)
-        self.player.soldiers.append(self)
+    def grid_rect(self, x, y):
+        left = BoardGrid.X_OFFSET + BoardGrid.WIDTH * x + (BoardGrid.WIDTH - BoardGrid.TRUE_WIDTH) / 2
+        top = BoardGrid.Y_OFFSET + BoardGrid.HEIGHT * y + (BoardGrid.HEIGHT - BoardGrid.TRUE_HEIGHT) / 2
+        return pygame.Rect(left, top, BoardGrid.TRUE_WIDTH, BoardGrid.TRUE_HEIGHT)
 
-    # Movement per UI frame
     def update(self):
-        # TODO: get current destination: (x, y)
-        destination = self.house.path.next_destination(self.current_x, self.current_y)
+        # called every ui frame for animation
+        self._ui_frame_count = (self._ui_frame_count + 1) % self.HAMMER_PERIOD
+
+    # =======
+    # Drawing
+    # =======
+    def draw(self, surface, alpha=1.0):
+        # alpha: how far the frame is between the previous and the last tick
+        # draw board
+        for row in self.game.board:
+            for grid in row:
+                self.draw_grid(surface, grid)
+
+        # draw user labels
+        for player in self.game.player_models:
+            self.draw_player_labels(surface, player)
+
+        # draw paths
+        for player in self.game.player_models:
+            for building in player.buildings:
+                if hasattr(building, "path") and building.path != None:
+                    for section in building.path.pathSections:
+                        self.draw_path_section(surface, section)
+
+        # draw soldiers
+        for player in self.game.player_models:
+            for soldier in player.soldiers:
+                self.draw_soldier(surface, soldier, alpha)
+
+    def draw_grid(self, surface, grid):
+        # draw ground
+        rect = self.grid_rect(grid.x, grid.y)
+        surface.blit(self.GROUND_IMG[grid.owner], rect)
+        # draw building
+        if grid.building is not None:
+            image = self.building_image(grid.building)
+            image_rect = image.get_rect()
+            image_rect.center = rect.center
+            surface.blit(image, image_rect)
+
+    def building_image(self, building):
+        base_image = self.BUILDING_IMG[building.__class__][building.owner]
+        base_rect = base_image.get_rect()
+        img = pygame.Surface((base_rect.width, base_rect.height), pygame.SRCALPHA, 32).convert_alpha()
+        img.blit(base_image, base_rect)
 
-        if destination is not None:
-            # move towards destination
-            if abs(destination[0] - self.current_x) >= self.SPEED:
-                self.current_x += math.copysign(self.SPEED, destination[0] - self.current_x)
-            else:
-                self.current_x = destination[0]
-            if abs(destination[1] - self.current_y) >= self.SPEED:
-                self.current_y += math.copysign(self.SPEED, destination[1] - self.current_y)
+        if building.state == building.STATE_BUILDING:
+            # building state, we also blit a hammer
+            hammer_image = self.HAMMER_IMG[building.owner]
+            rotated = None
+            if self._ui_frame_count >= 14:
+                rotated = pygame.transform.rotate(hammer_image, 98 - self._ui_frame_count * 3.5)
             else:
-                self.current_y = destination[1]
-
-        # check collision with grid
-        current_grid = self.game.grid_for_coordinates(self.current_x, self.current_y)
-        if current_grid != self.current_grid:
-            # remove soldier from the previous grid, and install it in the new grid
-            # this is for easy tower attacking
-            if self in self.current_grid.soldiers:
-                self.current_grid.soldiers.remove(self)
-            if self not in current_grid.soldiers:
-                current_grid.soldiers.append(self)
-            self.current_grid = current_grid
-
-        if current_grid.building is not None:
-            # hit building
-            current_grid.building.hit_by_soldier(self)
-            if self in current_grid.soldiers:
-                current_grid.soldiers.remove(self)
-
-    def tick_lock_step(self):
-        # TODO: fix lockstep desync
-        pass
-
-    # ======
-    # Events
-    # ======
-    def die(self):
-        if self in self.current_grid.soldiers:
-            self.current_grid.soldiers.remove(self)
-        if self in self.house.soldiers:
-            self.house.soldiers.remove(self)
-        if self in self.player.soldiers:
-            self.player.soldiers.remove(self)
-
+                rotated = pygame.transform.rotate(hammer_image, self._ui_frame_count * 3.5)
 
-    @property
-    def image(self):
-        return self._image
-
-    @property
-    def rect(self):
-        rect = self._canonical_rect
-        rect.center = (self.current_x, self.current_y)
-        return rect
-
-
-class Path(pygame.sprite.Sprite):
-    def __init__(self):
-        pygame.sprite.Sprite.__init__(self)
-        self.destination = None
-        self.pathSections = []
-
-    def pushBackPathSection(self, pathSection):
-        self.pathSections.append(pathSection)
+            rotated_rect = rotated.get_rect()
+            rotated_rect.center = base_rect.center
+            img.blit(rotated, rotated_rect)
 
-    def popBackPathSection(self):
-        self.pathSections.pop(-1)
+        if building.hp < building.max_hp:
+            # hp is not full, we also blit a hp bar
+            damage_fraction = float(building.max_hp - building.hp) / building.max_hp
+            bar_width = BoardGrid.TRUE_WIDTH
+            bar_height = int(BoardGrid.TRUE_HEIGHT * damage_fraction)
 
-    def setDestination(self, enemy_building):
-        self.destination = enemy_building
+            damage_bar = pygame.Surface((bar_width, bar_height))
+            damage_bar.fill(PLAYER_COLOR_DARK[building.owner])
+            damage_bar.set_alpha(100)
 
-    def next_destination(self, soldier_x, soldier_y):
-        # TODO: return an actual destination in coordinates (x, y)
-        for section in self.pathSections:
-            if section.contains_point(soldier_x, soldier_y):
-                return (section.x2, section.y2)
+            damage_rect = damage_bar.get_rect()
+            damage_rect.bottom = BoardGrid.TRUE_HEIGHT
 
-        return None
+            img.blit(damage_bar, damage_rect)
 
+        return img
 
-class PathSection(pygame.sprite.Sprite):
-    def __init__(self, color, x1, y1, x2, y2, width):
-        pygame.sprite.Sprite.__init__(self)
-        self.x1 = x1
-        self.y1 = y1
-        self.x2 = x2
-        self.y2 = y2
-
-        # drawing
-        self.image = None
-        if self.x1 == self.x2: # vertical
-            self.image = pygame.Surface([width, abs(self.y2 - self.y1)])
-        elif self.y1 == self.y2: # horizontal
-            self.image = pygame.Surface([abs(self.x2 - self.x1), width])
+    def draw_path_section(self, surface, section):
+        if section.x1 == section.x2: # vertical
+            size = (section.width, abs(section.y2 - section.y1))
+        elif section.y1 == section.y2: # horizontal
+            size = (abs(section.x2 - section.x1), section.width)
         else: return
-        self.image.fill(color)
-        self.rect = self.image.get_rect()
-        self.rect.centerx = (self.x1 + self.x2) / 2
-        self.rect.centery = (self.y1 + self.y2) / 2
-
-    def contains_point(self, x, y):
-        if self.x1 == self.x2:
-            # vertical
-            if self.y2 > self.y1:
-                return abs(self.x1 - x) <= 2 and self.y1 <= y < self.y2
-            else:
-                return abs(self.x1 - x) <= 2 and self.y2 < y <= self.y1
+        rect = pygame.Rect((0, 0), size)
+        rect.centerx = (section.x1 + section.x2) / 2
+        rect.centery = (section.y1 + section.y2) / 2
+        surface.fill(section.color, rect)
+
+    # Ghosts: provisional look of the player's own commands still in flight
+    GHOST_ALPHA = 110
+
+    def draw_ghost_building(self, surface, building_class, owner, x, y):
+        image = self.BUILDING_IMG[building_class][owner].copy()
+        image.set_alpha(self.GHOST_ALPHA)
+        image_rect = image.get_rect()
+        image_rect.center = self.grid_rect(x, y).center
+        surface.blit(image, image_rect)
+
+    def draw_ghost_path(self, surface, sections):
+        for section in sections:
+            if section.x1 == section.x2: # vertical
+                size = (section.width, abs(section.y2 - section.y1))
+            elif section.y1 == section.y2: # horizontal
+                size = (abs(section.x2 - section.x1), section.width)
+            else: continue
+            image = pygame.Surface(size)
+            image.fill(section.color)
+            image.set_alpha(self.GHOST_ALPHA)
+            rect = image.get_rect()
+            rect.centerx = (section.x1 + section.x2) / 2
+            rect.centery = (section.y1 + section.y2) / 2
+            surface.blit(image, rect)
+
+    def draw_soldier(self, surface, soldier, alpha=1.0):
+        image = self.SOLDIER_IMG[soldier.player.pos]
+        rect = image.get_rect()
+        rect.center = (int(round(soldier.prev_x + (soldier.current_x - soldier.prev_x) * alpha)),
+                       int(round(soldier.prev_y + (soldier.current_y - soldier.prev_y) * alpha)))
+        surface.blit(image, rect)
+
+    def draw_player_labels(self, surface, player):
+        label_color = self.LABEL_COLORS[player.pos]
+        label_loc = self.LABEL_LOCS[player.pos]
+
+        if not player.is_defeated:
+            money_text = "${0}".format(player.money)
+            inc_text = "${0} / second".format(player.money_increment)
         else:
-            # horizontal
-            if self.x2 > self.x1:
-                return abs(self.y1 - y) <= 2 and self.x1 <= x < self.x2
-            else:
-                return abs(self.y1 - y) <= 2 and self.x2 < x <= self.x1
-
+            money_text = "DEAD"
+            inc_text = "x_x"
+
+        money_label = None
+        inc_label = None
+
+        if player.pos == 0 or player.pos == 3:
+            # topright align
+            money_label = BasicLabel(money_text, self.font, label_color, topright=label_loc)
+            inc_label_loc = (label_loc[0], label_loc[1] + money_label.rect.height)
+            inc_label = BasicLabel(inc_text, self.font, label_color, topright=inc_label_loc)
+
+        elif player.pos == 1 or player.pos == 2:
+            # topleft align
+            money_label = BasicLabel(money_text, self.font, label_color, topleft=label_loc)
+            inc_label_loc = (label_loc[0], label_loc[1] + money_label.rect.height)
+            inc_label = BasicLabel(inc_text, self.font, label_color, topleft=inc_label_loc)
+
+        surface.blit(money_label.image, money_label.rect)
+        surface.blit(inc_label.image, inc_label.rect)
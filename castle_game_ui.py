@@ -6,6 +6,39 @@ from pygame import font
 from castle_game import CastleGameCommand, CastleGameModel
 from castle_game_sprites import *
 
+
+class RouteDraft:
+    """A route the player is still drawing. Lives in the UI only; the game
+    model changes when the finished route comes back as a Route command."""
+    PATH_WIDTH = 4
+
+    def __init__(self, game, house):
+        self.game = game
+        self.house = house
+        self.points = [(house.grid.x, house.grid.y)]    # grids the route walks through
+        self.path_dim = []      # Route command sections, one per step
+
+    def move(self, x, y):
+        # Extend the route to the neighbouring grid x, y, or take back the last step
+        # if that's where it came from. Returns True once it reaches an enemy building
+        if (x, y) == self.points[-1]:
+            return False
+        if len(self.points) > 1 and (x, y) == self.points[-2]:
+            self.points.pop()
+            self.path_dim.pop()
+            return False
+
+        board = self.game.board
+        last = board[self.points[-1][1]][self.points[-1][0]]
+        grid = board[y][x]
+        self.points.append((x, y))
+        self.path_dim.append((self.house.color, last.centerx, last.centery, grid.centerx, grid.centery, self.PATH_WIDTH))
+        return grid.building is not None and not grid.building.isOwnedBy(self.house.player.pos)
+
+    def sections(self):
+        return [PathSection(*x) for x in self.path_dim]
+
+
 class CastleGameUI:
     """UI class for Castle game."""
 
@@ -38,13 +71,6 @@ class CastleGameUI:
     PLAYER_COLOR_LIGHT = [COLOR_LIGHT_PURPLE, COLOR_LIGHT_PINK, COLOR_LIGHT_CYAN, COLOR_LIGHT_ORANGE]
     PLAYER_COLOR_DARK = [COLOR_DARK_PURPLE, COLOR_DARK_PINK, COLOR_DARK_CYAN, COLOR_DARK_ORANGE]
 
-    # route directions
-    ROUTE_UP = 1
-    ROUTE_DOWN = 2
-    ROUTE_LEFT = 3
-    ROUTE_RIGHT = 4
-    ROUTE_CANCEL = 5
-
     def __init__(self, debug=False):
         # Init pygame
         self.init_pygame()
@@ -84,11 +110,24 @@ class CastleGameUI:
     # ===================
     def start_game(self, all_players_pos, current_player_pos):
         self.game_model = CastleGameModel(self, all_players_pos, current_player_pos, DEBUG)
+        self.renderer = CastleGameRenderer(self.game_model)
+        self.client.set_game_model(self.game_model)
+
+    def resume_game(self, game_model):
+        # Rejoining a running match with a model restored from a snapshot; nothing
+        # may keep pointing into the old model
+        self.game_model = game_model
+        self.renderer = CastleGameRenderer(self.game_model)
         self.client.set_game_model(self.game_model)
+        self.route_draft = None
+        self.player_model = self.game_model.current_player
+        if self.player_model is not None:
+            self.cursor = Cursor(self.PLAYER_COLOR_DARK[self.player_model.pos], self.renderer.grid_rect(self.cursor_x, self.cursor_y))
 
     def end_game(self):
         self.client.set_game_model(None)
         self.game_model = None
+        self.renderer = None
 
     # =================
     # State transitions
@@ -145,14 +184,15 @@ class CastleGameUI:
         default_cursor_positions = [(0, 0), (0, 7), (7, 7), (7, 0)]
         self.cursor_y, self.cursor_x = default_cursor_positions[self.client.own_position]
 
-        self.cursor = Cursor(self.PLAYER_COLOR_DARK[self.client.own_position], self.game_model.board[self.cursor_y][self.cursor_x].rect)
+        self.cursor = Cursor(self.PLAYER_COLOR_DARK[self.client.own_position], self.renderer.grid_rect(self.cursor_x, self.cursor_y))
 
         self.game_instr_label = InstructionLabel(self.client.own_position, self.screen.get_rect().centerx, 525)
-        self.is_routing = False  # determine if the user is routing
-        self.route_from_x = None  # coordinate of the house you are routing from
-        self.route_from_y = None
+        self.route_draft = None  # RouteDraft while the user is routing
         self.player_model = [x for x in self.game_model.player_models if x.pos == self.client.own_position][0]
 
+    def transition_to_spectating(self):
+        self.game_instr_label = BasicLabel("SPECTATING", self.font, self.COLOR_BLACK, centerx=self.screen.get_rect().centerx, centery=525)
+
     def transition_to_finish(self):
         pass
 
@@ -292,7 +332,9 @@ class CastleGameUI:
 
         self.screen.fill(self.COLOR_WHITE)
         label = None
-        if self.is_winning_player:
+        if self.client.spectating:
+            label = BasicLabel("GAME OVER", self.font, (0, 0, 0), centerx=self.screen.get_rect().centerx, centery=self.screen.get_rect().centery)
+        elif self.is_winning_player:
             label = BasicLabel("YOU WIN!", self.font, (0, 0, 0), centerx=self.screen.get_rect().centerx, centery=self.screen.get_rect().centery)
         else:
             label = BasicLabel("YOU LOSE:(", self.font, (0, 0, 0), centerx=self.screen.get_rect().centerx, centery=self.screen.get_rect().centery)
@@ -303,63 +345,19 @@ class CastleGameUI:
     # ===================
     # Actual game ticking
     # ===================
-    def ui_tick_game(self):
-        # Process events
+    def handle_game_input(self):
+        # Called by the client more often than frames are drawn, and before the
+        # simulation of each frame, so a command is stamped before the turn can advance
         for e in pygame.event.get():
             if e.type == KEYDOWN:
                 if e.key == K_LEFT:
-                    self.cursor_x = self.cursor_x - 1 if self.cursor_x != 0 else 0
-                    self.cursor.set_rect(self.game_model.board[self.cursor_y][self.cursor_x].rect)
-                    if self.is_routing:
-                        my_house = self.game_model.board[self.route_from_y][self.route_from_x].building
-                        my_house.route(self.ROUTE_LEFT, self.cursor_x, self.cursor_y)
-                        if not my_house.is_routing: # finish routing
-                            cmd = CastleGameCommand.Route(self.route_from_x, self.route_from_y, my_house.path_dim)
-                            self.client.queue_command(cmd)
-                            self.route_from_x = None
-                            self.route_from_y = None
-                            my_house.complete = True
-                            self.is_routing = False
+                    self.move_cursor(-1, 0)
                 elif e.key == K_RIGHT:
-                    self.cursor_x = self.cursor_x + 1 if self.cursor_x != 7 else 7
-                    self.cursor.set_rect(self.game_model.board[self.cursor_y][self.cursor_x].rect)
-                    if self.is_routing:
-                        my_house = self.game_model.board[self.route_from_y][self.route_from_x].building
-                        my_house.route(self.ROUTE_RIGHT, self.cursor_x, self.cursor_y)
-                        if not my_house.is_routing:
-                            cmd = CastleGameCommand.Route(self.route_from_x, self.route_from_y, my_house.path_dim)
-                            self.client.queue_command(cmd)
-                            self.route_from_x = None
-                            self.route_from_y = None
-                            my_house.complete = True
-                            self.is_routing = False
+                    self.move_cursor(1, 0)
                 elif e.key == K_UP:
-                    self.cursor_y = self.cursor_y - 1 if self.cursor_y != 0 else 0
-                    self.cursor.set_rect(self.game_model.board[self.cursor_y][self.cursor_x].rect)
-                    if self.is_routing:
-                        my_house = self.game_model.board[self.route_from_y][self.route_from_x].building
-                        my_house.route(self.ROUTE_UP, self.cursor_x, self.cursor_y)
-                        if not my_house.is_routing:
-                            cmd = CastleGameCommand.Route(self.route_from_x, self.route_from_y, my_house.path_dim)
-                            self.client.queue_command(cmd)
-                            self.route_from_x = None
-                            self.route_from_y = None
-                            my_house.complete = True
-                            self.is_routing = False
+                    self.move_cursor(0, -1)
                 elif e.key == K_DOWN:
-                    self.cursor_y = self.cursor_y + 1 if self.cursor_y != 7 else 7
-                    self.cursor.set_rect(self.game_model.board[self.cursor_y][self.cursor_x].rect)
-                    if self.is_routing:
-                        my_house = self.game_model.board[self.route_from_y][self.route_from_x].building
-                        my_house.route(self.ROUTE_DOWN, self.cursor_x, self.cursor_y)
-                        if not my_house.is_routing:
-                            cmd = CastleGameCommand.Route(self.route_from_x, self.route_from_y, my_house.path_dim)
-                            self.client.queue_command(cmd)
-                            self.route_from_x = None
-                            self.route_from_y = None
-                            my_house.complete = True
-                            self.is_routing = False
-
+                    self.move_cursor(0, 1)
 
                 elif e.key == K_a:
                     cmd = CastleGameCommand.Build(self.client.own_position, CastleGameCommand.Build.HOUSE, self.cursor_x, self.cursor_y)
@@ -371,34 +369,72 @@ class CastleGameUI:
                     cmd = CastleGameCommand.Build(self.client.own_position, CastleGameCommand.Build.TOWER, self.cursor_x, self.cursor_y)
                     self.client.queue_command(cmd)
                 elif e.key == K_SPACE:
-                    if not self.is_routing:
-                        try:
-                            house = self.game_model.board[self.cursor_y][self.cursor_x].building
-                            if not house.isOwnedBy(self.client.own_position): continue
-                            house.route(0, self.cursor_x, self.cursor_y)
-                            self.route_from_x = self.cursor_x
-                            self.route_from_y = self.cursor_y
-                            self.is_routing = True
-                        except Exception, e:
+                    if self.route_draft is None:
+                        house = self.game_model.board[self.cursor_y][self.cursor_x].building
+                        if isinstance(house, House) and house.isOwnedBy(self.client.own_position):
+                            self.route_draft = RouteDraft(self.game_model, house)
+                        else:
                             print "You should route from your houses."
-                    elif self.route_from_x != None and self.route_from_y != None:
-                        self.game_model.board[self.route_from_y][self.route_from_x].building.route(self.ROUTE_CANCEL, self.cursor_x, self.cursor_y)
-                        cmd = CastleGameCommand.Route(self.route_from_x, self.route_from_y, [])
-                        self.client.queue_command(cmd)
-                        self.route_from_x = None
-                        self.route_from_y = None
-                        self.is_routing = False
+                    else:
+                        # cancel: the house keeps its current route
+                        self.route_draft = None
+
+    def ui_tick_game(self, ticks=1, alpha=1.0):
+        # Called every render frame, after ticks simulation ticks; alpha places
+        # moving things between the last two ticks. Input is handled in handle_game_input
+        # Animate at the simulation rate; the client ticks the simulation itself
+        for i in range(ticks):
+            self.cursor.update()
+            self.renderer.update()
+
+        # Drawing; our own commands show as ghosts until their turn runs
+        self.screen.fill(self.COLOR_WHITE)
+        self.renderer.draw(self.screen, alpha)
+        self.draw_ghosts()
+        self.cursor.draw(self.screen)
+        self.screen.blit(self.game_instr_label.image, self.game_instr_label.rect)
 
-        # Animate
-        self.cursor.update()
+        pygame.display.flip()
 
-        # Ticking
-        self.game_model.tick_ui()
+    def move_cursor(self, dx, dy):
+        x = min(max(self.cursor_x + dx, 0), self.game_model.WIDTH - 1)
+        y = min(max(self.cursor_y + dy, 0), self.game_model.HEIGHT - 1)
+        if (x, y) == (self.cursor_x, self.cursor_y):
+            return
+        self.cursor_x, self.cursor_y = x, y
+        self.cursor.set_rect(self.renderer.grid_rect(self.cursor_x, self.cursor_y))
+
+        if self.route_draft is not None and self.route_draft.move(x, y):
+            # finished routing: only now does the route go into the game
+            house = self.route_draft.house
+            if self.game_model.board[house.grid.y][house.grid.x].building is house:
+                self.client.queue_command(CastleGameCommand.Route(house.grid.x, house.grid.y, self.route_draft.path_dim))
+            self.route_draft = None
+
+    def draw_ghosts(self):
+        # Provisional look of commands we sent whose turn hasn't run yet. A build the
+        # turn rejects just disappears; the model is never touched here
+        for cmd in self.client.ghost_commands:
+            if isinstance(cmd, CastleGameCommand.Build):
+                if self.game_model.board[cmd.y][cmd.x].building is None:
+                    self.renderer.draw_ghost_building(self.screen, CastleGameCommand.Build.NAME_TO_CLS[cmd.building],
+                                                      cmd.player_pos, cmd.x, cmd.y)
+            elif isinstance(cmd, CastleGameCommand.Route):
+                self.renderer.draw_ghost_path(self.screen, [PathSection(*x) for x in cmd.path_dim])
+        if self.route_draft is not None:
+            self.renderer.draw_ghost_path(self.screen, self.route_draft.sections())
+
+    def ui_tick_spectate(self, ticks=1, alpha=1.0):
+        # Read-only view of a match: no cursor, no commands
+        for e in pygame.event.get():
+            if e.type == QUIT or (e.type == KEYDOWN and e.key == K_ESCAPE):
+                self.exit()
+
+        for i in range(ticks):
+            self.renderer.update()
 
-        # Drawing
         self.screen.fill(self.COLOR_WHITE)
-        self.game_model.draw(self.screen)
-        self.cursor.draw(self.screen)
+        self.renderer.draw(self.screen, alpha)
         self.screen.blit(self.game_instr_label.image, self.game_instr_label.rect)
 
         pygame.display.flip()
@@ -0,0 +1,336 @@
+"""Wire codecs shared by CastleClientProtocol and CastleServerProtocol.
+
+Every connection starts with JSON lines. A client may send a hello line
+listing the codecs it speaks; the server answers with the one it picked
+and both sides switch to it right after the hello exchange. Clients that
+never say hello keep talking JSON.
+"""
+import json
+import struct
+
+
+# Largest payload either codec sends or accepts, in bytes. Snapshots plus a
+# command backlog (rejoin and watch states) go well past a 16-bit frame
+MAX_PAYLOAD_SIZE = 1 << 24
+
+
+def check_payload(ddict):
+    # every payload is a dict carrying its type; anything else is a bad frame
+    if not isinstance(ddict, dict) or "type" not in ddict:
+        raise ValueError("payload without a type")
+    return ddict
+
+class CastleJSONCodec:
+    """One JSON dict per line, the original wire format."""
+    NAME = "json"
+    DELIMITER = "\r\n"
+
+    def encode(self, ddict):
+        line = json.dumps(ddict)
+        if len(line) > MAX_PAYLOAD_SIZE:
+            raise ValueError("Payload of {0} bytes is too large".format(len(line)))
+        return line + self.DELIMITER
+
+    def decode_line(self, line):
+        return check_payload(json.loads(line))
+
+
+class CastleBinaryCodec:
+    """Length-prefixed frames with a one-byte message type and struct-packed fields.
+
+    Frame: !H length of everything that follows, !B message type, body.
+    Bodies too long for the 16-bit length use a long frame: !H 0, !B message
+    type, !I body length, body.
+    Messages with fields the packers don't know about are sent as a JSON
+    body under MSG_JSON, so new payload keys never break the wire.
+    """
+    NAME = "bin1"
+
+    FRAME_HEADER = struct.Struct("!HB")
+    LONG_FRAME_HEADER = struct.Struct("!HBI")
+    MAX_SHORT_BODY = 0xFFFF - 1
+
+    MSG_COMMAND = 1
+    MSG_STATE_CHANGE = 2
+    MSG_ALL_POSITION = 3
+    MSG_SELECT_POSITION = 4
+    MSG_LOCKSTEP_FINISH = 5
+    MSG_LOCKSTEP_ALLOW = 6
+    MSG_ERROR = 7
+    MSG_PING = 8
+    MSG_PONG = 9
+    MSG_JSON = 255
+
+    STRUCT_TURN_LEN = struct.Struct("!IH")
+    STRUCT_BYTE = struct.Struct("!B")
+    STRUCT_SIGNED_BYTE = struct.Struct("!b")
+    STRUCT_STEP = struct.Struct("!I")
+    STRUCT_TIME = struct.Struct("!d")
+    STRUCT_STEP_HASH = struct.Struct("!II")
+
+    def __init__(self):
+        # payload type: (message type, fields, pack, unpack)
+        self.packers = {
+            "cmd": (self.MSG_COMMAND, ("lturn", "cmd"), self._pack_command, self._unpack_command),
+            "cs": (self.MSG_STATE_CHANGE, ("state",), self._pack_state, self._unpack_state),
+            "ap": (self.MSG_ALL_POSITION, ("ownpos", "allpos"), self._pack_all_position, self._unpack_all_position),
+            "sp": (self.MSG_SELECT_POSITION, ("pos",), self._pack_select_position, self._unpack_select_position),
+            "lkf": (self.MSG_LOCKSTEP_FINISH, ("step", "hash"), self._pack_lockstep_finish, self._unpack_lockstep_finish),
+            "lka": (self.MSG_LOCKSTEP_ALLOW, ("step", "cmds"), self._pack_lockstep_allow, self._unpack_lockstep_allow),
+            "err": (self.MSG_ERROR, ("info",), self._pack_error, self._unpack_error),
+            "png": (self.MSG_PING, ("t",), self._pack_time, self._unpack_ping),
+            "pog": (self.MSG_PONG, ("t",), self._pack_time, self._unpack_pong),
+        }
+        self.unpackers = dict((v[0], v[3]) for v in self.packers.values())
+
+    # ========
+    # Encoding
+    # ========
+    def encode(self, ddict):
+        packer = self.packers.get(ddict.get("type"))
+        body = None
+        if packer is not None and len(ddict) == len(packer[1]) + 1:
+            try:
+                msg_type = packer[0]
+                body = packer[2](ddict)
+            except (KeyError, TypeError, ValueError, struct.error):
+                body = None
+        if body is None:
+            msg_type = self.MSG_JSON
+            body = json.dumps(ddict)
+        if len(body) <= self.MAX_SHORT_BODY:
+            return self.FRAME_HEADER.pack(len(body) + 1, msg_type) + body
+        if len(body) > MAX_PAYLOAD_SIZE:
+            raise ValueError("Payload of {0} bytes is too large".format(len(body)))
+        return self.LONG_FRAME_HEADER.pack(0, msg_type, len(body)) + body
+
+    def _pack_command(self, ddict):
+        cmd = ddict["cmd"]
+        if isinstance(cmd, unicode): cmd = cmd.encode("utf-8")
+        return self.STRUCT_TURN_LEN.pack(ddict["lturn"], len(cmd)) + cmd
+
+    def _pack_state(self, ddict):
+        return self.STRUCT_BYTE.pack(ddict["state"])
+
+    def _pack_all_position(self, ddict):
+        ownpos = ddict["ownpos"] if ddict["ownpos"] is not None else -1
+        allpos = ddict["allpos"]
+        return self.STRUCT_SIGNED_BYTE.pack(ownpos) + struct.pack("!B{0}B".format(len(allpos)), len(allpos), *allpos)
+
+    def _pack_select_position(self, ddict):
+        return self.STRUCT_BYTE.pack(ddict["pos"])
+
+    def _pack_lockstep_finish(self, ddict):
+        return self.STRUCT_STEP_HASH.pack(ddict["step"], ddict["hash"])
+
+    def _pack_lockstep_allow(self, ddict):
+        # step, command count, then (turn, length, cmd) per bundled command
+        cmds = ddict["cmds"]
+        parts = [self.STRUCT_STEP.pack(ddict["step"]), self.STRUCT_STEP.pack(len(cmds))]
+        for turn, cmd in cmds:
+            if isinstance(cmd, unicode): cmd = cmd.encode("utf-8")
+            parts.append(self.STRUCT_TURN_LEN.pack(turn, len(cmd)))
+            parts.append(cmd)
+        return "".join(parts)
+
+    def _pack_error(self, ddict):
+        info = ddict["info"]
+        if isinstance(info, unicode): info = info.encode("utf-8")
+        return info
+
+    def _pack_time(self, ddict):
+        return self.STRUCT_TIME.pack(ddict["t"])
+
+    # ========
+    # Decoding
+    # ========
+    def split_frames(self, data):
+        # Returns ([ddicts], leftover bytes of an incomplete frame). Frames that don't
+        # decode are logged and skipped; only a frame too large to buffer raises ValueError
+        ddicts = []
+        offset = 0
+        header_size = self.FRAME_HEADER.size
+        while len(data) - offset >= header_size:
+            length, msg_type = self.FRAME_HEADER.unpack_from(data, offset)
+            if length > 0:
+                start = offset + header_size
+                end = offset + 2 + length
+            else:
+                # long frame
+                if len(data) - offset < self.LONG_FRAME_HEADER.size:
+                    break
+                length = self.LONG_FRAME_HEADER.unpack_from(data, offset)[2]
+                if length > MAX_PAYLOAD_SIZE:
+                    raise ValueError("Frame of {0} bytes is too large".format(length))
+                start = offset + self.LONG_FRAME_HEADER.size
+                end = start + length
+            if end > len(data):
+                break
+            body = data[start:end]
+            offset = end
+            try:
+                if msg_type == self.MSG_JSON:
+                    ddict = check_payload(json.loads(body))
+                elif msg_type in self.unpackers:
+                    ddict = self.unpackers[msg_type](body)
+                else:
+                    raise ValueError("unknown message type {0}".format(msg_type))
+            except (ValueError, struct.error) as e:
+                print "[ERROR] Skipped bad frame: {0}".format(e)
+                continue
+            ddicts.append(ddict)
+        return ddicts, data[offset:]
+
+    def _unpack_command(self, body):
+        turn, length = self.STRUCT_TURN_LEN.unpack_from(body)
+        start = self.STRUCT_TURN_LEN.size
+        return {"type": "cmd", "lturn": turn, "cmd": body[start:start + length]}
+
+    def _unpack_state(self, body):
+        return {"type": "cs", "state": self.STRUCT_BYTE.unpack(body)[0]}
+
+    def _unpack_all_position(self, body):
+        ownpos = self.STRUCT_SIGNED_BYTE.unpack_from(body)[0]
+        count = self.STRUCT_BYTE.unpack_from(body, 1)[0]
+        allpos = list(struct.unpack_from("!{0}B".format(count), body, 2))
+        return {"type": "ap", "ownpos": ownpos if ownpos >= 0 else None, "allpos": allpos}
+
+    def _unpack_select_position(self, body):
+        return {"type": "sp", "pos": self.STRUCT_BYTE.unpack(body)[0]}
+
+    def _unpack_lockstep_finish(self, body):
+        step, state_hash = self.STRUCT_STEP_HASH.unpack(body)
+        return {"type": "lkf", "step": step, "hash": state_hash}
+
+    def _unpack_lockstep_allow(self, body):
+        step = self.STRUCT_STEP.unpack_from(body)[0]
+        count = self.STRUCT_STEP.unpack_from(body, 4)[0]
+        offset = 8
+        cmds = []
+        for i in range(count):
+            turn, length = self.STRUCT_TURN_LEN.unpack_from(body, offset)
+            offset += self.STRUCT_TURN_LEN.size
+            cmds.append([turn, body[offset:offset + length]])
+            offset += length
+        return {"type": "lka", "step": step, "cmds": cmds}
+
+    def _unpack_error(self, body):
+        return {"type": "err", "info": body}
+
+    def _unpack_ping(self, body):
+        return {"type": "png", "t": self.STRUCT_TIME.unpack(body)[0]}
+
+    def _unpack_pong(self, body):
+        return {"type": "pog", "t": self.STRUCT_TIME.unpack(body)[0]}
+
+
+JSON_CODEC = CastleJSONCodec()
+BINARY_CODEC = CastleBinaryCodec()
+CODECS = {JSON_CODEC.NAME: JSON_CODEC, BINARY_CODEC.NAME: BINARY_CODEC}
+
+
+def fan_out(ddict, protocols):
+    """Send one payload to many protocols, encoding it once per codec in use.
+
+    Twisted only flushes a TCP transport's write buffer when the reactor
+    next finds the socket writable, so everything written to a peer in the
+    same reactor iteration already leaves in a single send() call.
+    """
+    encoded = {}
+    for protocol in protocols:
+        data = encoded.get(protocol.codec)
+        if data is None:
+            data = encoded[protocol.codec] = protocol.codec.encode(ddict)
+        protocol.sendEncoded(data, ddict)
+
+
+class CastleFramingMixin:
+    """Codec negotiation and framing for LineReceiver based protocols.
+
+    Subclasses implement payloadReceived(ddict) and send with sendPayload(ddict).
+    """
+    PAYLOAD_TYPE_HELLO = "hi"
+
+    # LineReceiver's limit for JSON lines
+    MAX_LENGTH = MAX_PAYLOAD_SIZE
+
+    codec = JSON_CODEC
+    _frame_buffer = ""
+    _outbox = None          # payloads held back until the hello exchange finishes
+
+    def sendPayload(self, ddict):
+        if self._outbox is not None:
+            self._outbox.append(ddict)
+            return
+        self.writeData(self.codec.encode(ddict))
+
+    def sendEncoded(self, data, ddict):
+        # data is ddict encoded with self.codec, see fan_out. While the hello exchange
+        # runs, ddict waits in the outbox behind the payloads already queued
+        if self._outbox is not None:
+            self._outbox.append(ddict)
+            return
+        self.writeData(data)
+
+    def writeData(self, data):
+        # Every encoded payload goes out here; subclasses may hook it, e.g. to count bytes
+        self.transport.write(data)
+
+    def clearBuffers(self):
+        # Everything received but not handled yet, oldest first, e.g. to pass it on with the socket
+        data = self._frame_buffer + self.clearLineBuffer()
+        self._frame_buffer = ""
+        return data
+
+    def requestCodec(self, names):
+        # hello: {"type": "hi", "codecs": [names]}
+        self._outbox = []
+        self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_HELLO, "codecs": names}))
+
+    def useCodec(self, name):
+        self.codec = CODECS[name]
+        if self.codec is not JSON_CODEC:
+            self.setRawMode()
+
+    def helloReceived(self, ddict):
+        if "codecs" in ddict:
+            # the peer asks: answer in JSON, then switch
+            names = [x for x in ddict["codecs"] if x in CODECS]
+            name = names[0] if names else JSON_CODEC.NAME
+            self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_HELLO, "codec": name}))
+            self.useCodec(name)
+        else:
+            # the peer answered our request
+            self.useCodec(ddict["codec"])
+            outbox = self._outbox or []
+            self._outbox = None
+            for queued in outbox:
+                self.sendPayload(queued)
+
+    def lineReceived(self, line):
+        try:
+            ddict = JSON_CODEC.decode_line(line)
+        except ValueError as e:
+            print "[ERROR] Skipped bad line: {0}".format(e)
+            return
+        if ddict.get("type") == self.PAYLOAD_TYPE_HELLO:
+            self.helloReceived(ddict)
+        else:
+            self.payloadReceived(ddict)
+
+    def rawDataReceived(self, data):
+        try:
+            ddicts, self._frame_buffer = self.codec.split_frames(self._frame_buffer + data)
+        except ValueError as e:
+            # the stream can't be resynchronized past a frame we won't buffer
+            print "[ERROR] Closing connection: {0}".format(e)
+            self._frame_buffer = ""
+            self.transport.loseConnection()
+            return
+        for i, ddict in enumerate(ddicts):
+            if self.paused:
+                # paused mid-chunk (a socket handed to another process): keep the
+                # rest unread, like LineReceiver does with its lines
+                self._frame_buffer = "".join(self.codec.encode(x) for x in ddicts[i:]) + self._frame_buffer
+                return
+            self.payloadReceived(ddict)
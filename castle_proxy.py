@@ -0,0 +1,213 @@
+"""TCP proxy that makes localhost behave like a long, unreliable link.
+
+Sits between clients and runserver.py and shapes each direction on its
+own: fixed delay, random jitter, a bandwidth cap, loss and periodic
+stalls. TCP never loses data, so loss shows up the way it does for a TCP
+stream: the chunk and everything behind it wait one retransmission
+timeout. Bytes always leave in the order they came in.
+
+Every shaped chunk can be logged as one line:
+
+    time conn direction bytes delay_ms event
+
+where event is "-", "loss" or "stall".
+"""
+from twisted.internet.protocol import Factory, ClientFactory, Protocol
+from twisted.internet import reactor
+
+import random
+import time
+
+
+class CastleLinkProfile:
+    """Impairments of one direction of a link. Times are in seconds, bandwidth in bytes per second."""
+    def __init__(self, delay=0.0, jitter=0.0, bandwidth=0, loss=0.0, loss_penalty=0.2, stall_every=0.0, stall_for=0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.bandwidth = bandwidth          # 0 means unlimited
+        self.loss = loss                    # chance a chunk needs a retransmission
+        self.loss_penalty = loss_penalty    # retransmission timeout
+        self.stall_every = stall_every      # 0 means never
+        self.stall_for = stall_for
+
+    def __str__(self):
+        return "delay {0:.0f} ms, jitter {1:.0f} ms, {2}, loss {3:.1%}, {4}".format(
+            self.delay * 1000, self.jitter * 1000,
+            "{0} B/s".format(self.bandwidth) if self.bandwidth > 0 else "unlimited",
+            self.loss,
+            "stall {0:.0f} ms every {1:.1f} s".format(self.stall_for * 1000, self.stall_every) if self.stall_every > 0 else "no stalls")
+
+
+class CastleProxyLink:
+    """One direction of a proxied connection: holds each chunk until the profile lets it out."""
+    def __init__(self, proxy, conn_id, direction, profile):
+        self.proxy = proxy
+        self.conn_id = conn_id
+        self.direction = direction
+        self.profile = profile
+        self.target = None          # transport the bytes go out on
+        self.held = []              # chunks that arrived before the target connected
+        self.free_at = 0.0          # when the link finished sending the previous chunk
+        self.closing = False
+
+        self.chunks = 0
+        self.bytes = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.losses = 0
+        self.stalls = 0
+
+    def connect(self, target):
+        self.target = target
+        held, self.held = self.held, []
+        for data in held:
+            self.send(data)
+
+    def send(self, data):
+        if self.target is None:
+            self.held.append(data)
+            return
+
+        now = time.time()
+        profile = self.profile
+        rng = self.proxy.random
+        at = now + profile.delay + rng.uniform(0, profile.jitter)
+        event = "-"
+        if profile.loss > 0 and rng.random() < profile.loss:
+            at += profile.loss_penalty
+            self.losses += 1
+            event = "loss"
+        if profile.stall_every > 0:
+            # nothing gets through during the first stall_for seconds of every period
+            phase = (at - self.proxy.started) % profile.stall_every
+            if phase < profile.stall_for:
+                at += profile.stall_for - phase
+                self.stalls += 1
+                event = "stall"
+        if profile.bandwidth > 0:
+            at = max(at, self.free_at) + float(len(data)) / profile.bandwidth
+        # a stream never overtakes itself
+        at = max(at, self.free_at)
+        self.free_at = at
+
+        delay = at - now
+        self.chunks += 1
+        self.bytes += len(data)
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+        self.proxy.record(self.conn_id, self.direction, len(data), delay, event)
+        reactor.callLater(delay, self._deliver, data)
+
+    def _deliver(self, data):
+        if self.target is not None:
+            self.target.write(data)
+
+    def close(self):
+        # Hang up once everything in flight went out
+        if self.closing:
+            return
+        self.closing = True
+        if self.target is None:
+            return
+        reactor.callLater(max(0, self.free_at - time.time()), self.target.loseConnection)
+
+    def summary(self):
+        average = self.total_delay / self.chunks if self.chunks else 0.0
+        return "{0}: {1} chunks, {2} bytes, delay avg {3:.1f} ms max {4:.1f} ms, {5} losses, {6} stalls".format(
+            self.direction, self.chunks, self.bytes, average * 1000, self.max_delay * 1000, self.losses, self.stalls)
+
+
+class CastleProxyUpstreamProtocol(Protocol):
+    """Proxy end connected to the real server."""
+    def __init__(self, downstream):
+        self.downstream = downstream
+
+    def connectionMade(self):
+        if self.downstream.up.closing:
+            # the client hung up before the server answered
+            self.transport.loseConnection()
+            return
+        self.downstream.upstream = self
+        self.downstream.up.connect(self.transport)
+        self.downstream.down.connect(self.downstream.transport)
+
+    def dataReceived(self, data):
+        self.downstream.down.send(data)
+
+    def connectionLost(self, reason):
+        self.downstream.down.close()
+
+
+class CastleProxyUpstreamFactory(ClientFactory):
+    def __init__(self, downstream):
+        self.downstream = downstream
+
+    def buildProtocol(self, addr):
+        return CastleProxyUpstreamProtocol(self.downstream)
+
+    def clientConnectionFailed(self, connector, reason):
+        print "[ERROR][PROXY] Could not reach server: {0}".format(reason.getErrorMessage())
+        self.downstream.transport.loseConnection()
+
+
+class CastleProxyDownstreamProtocol(Protocol):
+    """Proxy end a client connected to."""
+    def __init__(self, proxy, conn_id):
+        self.proxy = proxy
+        self.conn_id = conn_id
+        self.upstream = None
+        self.up = CastleProxyLink(proxy, conn_id, "up", proxy.up_profile)
+        self.down = CastleProxyLink(proxy, conn_id, "down", proxy.down_profile)
+
+    def connectionMade(self):
+        if DEBUG: print "[INFO][PROXY] Connection {0} from {1}".format(self.conn_id, self.transport.getPeer())
+        reactor.connectTCP(self.proxy.server_host, self.proxy.server_port, CastleProxyUpstreamFactory(self))
+
+    def dataReceived(self, data):
+        self.up.send(data)
+
+    def connectionLost(self, reason):
+        self.up.close()
+        print "[INFO][PROXY] Connection {0} closed. {1}; {2}".format(self.conn_id, self.up.summary(), self.down.summary())
+
+
+class CastleProxyFactory(Factory):
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def buildProtocol(self, addr):
+        self.proxy.next_conn_id += 1
+        return CastleProxyDownstreamProtocol(self.proxy, self.proxy.next_conn_id)
+
+
+class CastleProxy:
+    """Shapes every connection between clients and one server with the same up and down profiles."""
+    def __init__(self, port, server_host, server_port, up_profile, down_profile, debug=False, log_path=None, seed=None):
+        self.port = port
+        self.server_host = server_host
+        self.server_port = server_port
+        self.up_profile = up_profile        # client to server
+        self.down_profile = down_profile    # server to client
+        self.random = random.Random(seed)
+        self.next_conn_id = 0
+        self.started = time.time()
+
+        self.log_file = None
+        if log_path is not None:
+            self.log_file = open(log_path, "w")
+            reactor.addSystemEventTrigger("after", "shutdown", self.log_file.close)
+
+        global DEBUG
+        DEBUG = debug
+
+    def start(self):
+        print "[INFO][PROXY] :{0} -> {1}:{2}".format(self.port, self.server_host, self.server_port)
+        print "[INFO][PROXY] up: {0}".format(self.up_profile)
+        print "[INFO][PROXY] down: {0}".format(self.down_profile)
+        reactor.listenTCP(self.port, CastleProxyFactory(self))
+        reactor.run()
+
+    def record(self, conn_id, direction, size, delay, event):
+        if self.log_file is not None:
+            self.log_file.write("{0:.6f} {1} {2} {3} {4:.3f} {5}\n".format(
+                time.time() - self.started, conn_id, direction, size, delay * 1000, event))
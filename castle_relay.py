@@ -0,0 +1,220 @@
+from twisted.internet.protocol import Factory, ClientFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet import reactor
+
+from castle_protocol import CastleFramingMixin, fan_out, BINARY_CODEC, JSON_CODEC
+
+
+# ======================================
+# Upstream: the relay watching one match
+# ======================================
+class CastleRelayUpstreamProtocol(CastleFramingMixin, LineReceiver):
+    """Spectator connection from the relay to the match server, one per watched match."""
+    PAYLOAD_TYPE_LOCKSTEP_ALLOW = "lka"
+    PAYLOAD_TYPE_ERROR = "err"
+    PAYLOAD_TYPE_PING = "png"
+    PAYLOAD_TYPE_PONG = "pog"
+    PAYLOAD_TYPE_WATCH = "wt"
+    PAYLOAD_TYPE_WATCH_STATE = "ws"
+    PAYLOAD_TYPE_WATCH_SNAPSHOT = "wsn"
+
+    def __init__(self, feed):
+        self.feed = feed
+
+    def connectionMade(self):
+        self.feed.upstream = self
+        if self.feed.relay.use_binary:
+            self.requestCodec([BINARY_CODEC.NAME, JSON_CODEC.NAME])
+        # watch: {"type": "wt", "match": match_id, "snaps": true}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_WATCH, "match": self.feed.match_id, "snaps": True})
+
+    def connectionLost(self, reason):
+        self.feed.upstream = None
+        self.feed.relay.feed_lost(self.feed)
+
+    def payloadReceived(self, ddict):
+        if DEBUG: print "[INFO][RELAY] Match {0}: {1}".format(self.feed.match_id, ddict["type"])
+
+        if ddict["type"] == self.PAYLOAD_TYPE_WATCH_STATE:
+            # watch state: {"type": "ws", "step": watched step, "snap": base64 snapshot, "cmds": [[turn, cmd]],
+            #               "allpos": [pos], "fpl": frames per lockstep, "delay": input delay}
+            self.feed.receive_state(ddict)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_WATCH_SNAPSHOT:
+            # watch snapshot: {"type": "wsn", "step": snapshot step, "snap": base64 snapshot}
+            self.feed.receive_snapshot(ddict)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_LOCKSTEP_ALLOW:
+            # allow lockstep: {"type": "lka", "step": lockstep, "cmds": [[turn, cmd]]}
+            self.feed.receive_allow(ddict)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_PING:
+            # ping: {"type": "png", "t": server_time}
+            self.sendPayload({"type": self.PAYLOAD_TYPE_PONG, "t": ddict["t"]})
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_ERROR:
+            # error: {"type": "err", "info": info}
+            print "[ERROR][RELAY] Match {0}: {1}".format(self.feed.match_id, ddict["info"])
+
+
+class CastleRelayUpstreamFactory(ClientFactory):
+    def __init__(self, feed):
+        self.feed = feed
+
+    def buildProtocol(self, addr):
+        return CastleRelayUpstreamProtocol(self.feed)
+
+    def clientConnectionFailed(self, connector, reason):
+        print "[ERROR][RELAY] Could not reach server for match {0}: {1}".format(self.feed.match_id, reason.getErrorMessage())
+        self.feed.relay.feed_lost(self.feed)
+
+
+class CastleRelayFeed:
+    """Turn stream of one match, as the server sends it to spectators.
+
+    Keeps a watch state for viewers that join late: the newest snapshot the
+    server sent and every command bundled after it.
+    """
+    # Past this many commands since the snapshot, late viewers wait for the next
+    # snapshot instead of getting an ever larger watch state
+    MAX_STATE_COMMANDS = 4096
+
+    def __init__(self, relay, match_id):
+        self.relay = relay
+        self.match_id = match_id
+        self.upstream = None
+        self.state = None       # ws payload, with snap, cmds and step kept current
+        self.viewers = []       # [conns] receiving lka
+        self.waiting = []       # [conns] that get the state once it is usable
+
+    def __len__(self):
+        return len(self.viewers) + len(self.waiting)
+
+    def state_usable(self):
+        return self.state is not None and len(self.state["cmds"]) <= self.MAX_STATE_COMMANDS
+
+    def add_viewer(self, viewer):
+        viewer.feed = self
+        self.waiting.append(viewer)
+        self.release_waiting()
+
+    def remove_viewer(self, viewer):
+        if viewer in self.viewers:
+            self.viewers.remove(viewer)
+        if viewer in self.waiting:
+            self.waiting.remove(viewer)
+        viewer.feed = None
+
+    def release_waiting(self):
+        if self.waiting and self.state_usable():
+            fan_out(self.state, self.waiting)
+            self.viewers.extend(self.waiting)
+            self.waiting = []
+
+    def receive_state(self, ddict):
+        self.state = ddict
+        # everyone who arrived before the server answered
+        self.release_waiting()
+
+    def receive_snapshot(self, ddict):
+        # Rebase the state: commands up to the snapshot step are in the snapshot
+        if self.state is None:
+            return
+        self.state["snap"] = ddict["snap"]
+        self.state["cmds"] = [x for x in self.state["cmds"] if x[0] > ddict["step"]]
+        self.release_waiting()
+
+    def receive_allow(self, ddict):
+        if self.state is not None:
+            self.state["cmds"].extend(ddict["cmds"])
+            self.state["step"] = ddict["step"]
+        # encoded once per codec, however many viewers there are
+        fan_out(ddict, self.viewers)
+
+    def close(self):
+        if self.upstream is not None:
+            self.upstream.transport.loseConnection()
+        for viewer in self.viewers + self.waiting:
+            viewer.transport.loseConnection()
+
+
+# ===========================
+# Downstream: the many viewers
+# ===========================
+class CastleRelayViewerProtocol(CastleFramingMixin, LineReceiver):
+    """Spectator connected to the relay. It talks to the relay as if it were the match server."""
+    PAYLOAD_TYPE_WATCH = "wt"
+    PAYLOAD_TYPE_ERROR = "err"
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.feed = None
+
+    def connectionLost(self, reason):
+        if self.feed is not None:
+            self.relay.viewer_lost(self)
+
+    def payloadReceived(self, ddict):
+        # Viewers are read-only: everything but the watch request is ignored
+        if ddict["type"] == self.PAYLOAD_TYPE_WATCH and self.feed is None:
+            # watch: {"type": "wt", "match": match_id}
+            self.relay.watch(self, ddict["match"])
+
+
+class CastleRelayViewerFactory(Factory):
+    def __init__(self, relay):
+        self.relay = relay
+
+    def buildProtocol(self, addr):
+        return CastleRelayViewerProtocol(self.relay)
+
+
+class CastleRelay:
+    """Fans the spectator stream of a match server out to many viewers.
+
+    The server writes each turn once to the relay, the relay writes it once
+    per viewer codec and lets the transports copy the bytes out.
+    """
+    def __init__(self, port, server_host, server_port, debug=False, use_binary=True):
+        self.port = port
+        self.server_host = server_host
+        self.server_port = server_port
+        self.use_binary = use_binary
+        self.feeds = {}         # {match_id: feed}
+
+        global DEBUG
+        DEBUG = debug
+
+    def listen(self):
+        endpoint = TCP4ServerEndpoint(reactor, self.port)
+        return endpoint.listen(CastleRelayViewerFactory(self))
+
+    def start(self):
+        self.listen()
+        reactor.run()
+
+    def watch(self, viewer, match_id):
+        # The first viewer of a match opens its feed from the server
+        feed = self.feeds.get(match_id)
+        if feed is None:
+            feed = self.feeds[match_id] = CastleRelayFeed(self, match_id)
+            reactor.connectTCP(self.server_host, self.server_port, CastleRelayUpstreamFactory(feed))
+            print "[INFO][RELAY] Watching match {0}".format(match_id)
+        feed.add_viewer(viewer)
+        if DEBUG: print "[INFO][RELAY] Match {0} has {1} viewers".format(match_id, len(feed))
+
+    def viewer_lost(self, viewer):
+        feed = viewer.feed
+        feed.remove_viewer(viewer)
+        if len(feed) == 0 and self.feeds.get(feed.match_id) is feed:
+            # nobody is watching anymore, stop the feed
+            del self.feeds[feed.match_id]
+            feed.close()
+
+    def feed_lost(self, feed):
+        # The match ended or the server refused: the viewers go too
+        if self.feeds.get(feed.match_id) is feed:
+            del self.feeds[feed.match_id]
+            print "[INFO][RELAY] Stopped watching match {0}".format(feed.match_id)
+        feed.close()
@@ -0,0 +1,378 @@
+"""Match replays: one compact, append-only binary file per match.
+
+File layout, all big endian:
+
+    header  !4sHIBBdB  magic, version, match id, frames per lockstep,
+                       input delay, start time, player count
+    roster  !{n}B      seated positions
+    records !BII       kind, turn, data length, then data (!BIH in version 1)
+
+A RECORD_COMMAND carries one command (turn, serialized command) exactly as
+it was bundled into "lka". A RECORD_STEP follows every "lka" with the
+allowed step it announced, so a reader knows how far the match got even
+when no commands were issued. A RECORD_KEYFRAME carries a snapshot a client
+uploaded (turn is the lockstep it was taken after); it lands a few records
+after the commands of that lockstep.
+
+The server never packs or writes records on the reactor thread: the bundles
+pile up in memory and whole chunks go to the CastleReplayRecorder thread,
+which turns them into records and appends them to the file.
+
+A keyframe index (<replay>.idx) sits next to a replay so a reader can seek
+without re-simulating from turn 0:
+
+    header  !4sHHI     magic, version, keyframe interval, keyframe count
+    table   !IIII      per keyframe: lockstep, offset of the next command
+                       record in the replay, snapshot offset, snapshot length
+    snapshots          CastleGameModel.snapshot() after that lockstep
+
+Keyframe k holds the last keyframe at or before lockstep k * interval, so
+finding it is one table lookup. The index is built from the recorded
+keyframes; replays without them are simulated once to take snapshots.
+"""
+import bisect
+import mmap
+import os
+import Queue
+import struct
+import threading
+import time
+
+from castle_game import CastleGameCommand, CastleGameModel
+
+
+REPLAY_MAGIC = "CCRP"
+REPLAY_VERSION = 2
+REPLAY_EXTENSION = ".ccr"
+
+HEADER = struct.Struct("!4sHIBBdB")
+RECORD = struct.Struct("!BII")
+RECORD_V1 = struct.Struct("!BIH")   # version 1 files, read only
+
+RECORD_COMMAND = 1
+RECORD_STEP = 2
+RECORD_KEYFRAME = 3
+
+INDEX_MAGIC = "CCRI"
+INDEX_VERSION = 2
+INDEX_EXTENSION = ".idx"
+
+INDEX_HEADER = struct.Struct("!4sHHI")
+INDEX_ENTRY = struct.Struct("!IIII")
+
+
+def pack_header(match_id, roster, frames_per_lock_step, input_delay, started):
+    header = HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, match_id, frames_per_lock_step, input_delay,
+                         started, len(roster))
+    return header + struct.pack("!{0}B".format(len(roster)), *roster)
+
+
+def pack_records(entries):
+    # entries: [(RECORD_STEP, allowed step, [[turn, cmd]] as announced in lka)
+    #           or (RECORD_KEYFRAME, lockstep, snapshot)]
+    records = []
+    for kind, step, data in entries:
+        if kind == RECORD_KEYFRAME:
+            records.append(RECORD.pack(RECORD_KEYFRAME, step, len(data)) + data)
+            continue
+        for turn, cmd in data:
+            if isinstance(cmd, unicode): cmd = cmd.encode("utf-8")
+            records.append(RECORD.pack(RECORD_COMMAND, turn, len(cmd)) + cmd)
+        records.append(RECORD.pack(RECORD_STEP, step, 0))
+    return "".join(records)
+
+
+class CastleReplayWriter:
+    """Replay of one match, buffered in memory and flushed in chunks by the recorder."""
+    # Hand a chunk to the writer thread once it holds this many steps or is this old
+    FLUSH_STEPS = 64
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, recorder, path, match_id, roster, frames_per_lock_step, input_delay):
+        self.recorder = recorder
+        self.path = path
+        self.entries = []   # [(kind, step, data)] not handed to the recorder yet
+        self.last_flush = time.time()
+        self.recorder.write(path, pack_header, match_id, roster, frames_per_lock_step, input_delay, self.last_flush)
+
+    def record_allow(self, step, cmds):
+        # cmds: [[turn, cmd]] as bundled into lka
+        self.entries.append((RECORD_STEP, step, cmds))
+        if len(self.entries) >= self.FLUSH_STEPS or time.time() - self.last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def record_keyframe(self, step, snapshot):
+        # snapshot: CastleGameModel.snapshot() after lockstep step
+        self.entries.append((RECORD_KEYFRAME, step, snapshot))
+
+    def flush(self):
+        if self.entries:
+            self.recorder.write(self.path, pack_records, self.entries)
+            self.entries = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.recorder.close(self.path)
+
+
+class CastleReplayRecorder:
+    """Owns the replay directory and the single thread that writes every replay file.
+
+    One thread keeps the chunks of a file in order and packs them; the reactor
+    only pays for a Queue.put per flush, and a chunk that fails to pack is
+    logged and dropped without touching the match.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="castle-replay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self, match):
+        roster = [pos for pos, player in enumerate(match.player_pos) if player is not None]
+        name = "match-{0}-{1}{2}".format(match.match_id, time.strftime("%Y%m%d-%H%M%S"), REPLAY_EXTENSION)
+        return CastleReplayWriter(self, os.path.join(self.directory, name), match.match_id, roster,
+                                  match.frames_per_lock_step, match.input_delay)
+
+    def write(self, path, pack, *args):
+        # pack(*args) returns the bytes to append, it runs on the writer thread
+        self.queue.put((path, pack, args))
+
+    def close(self, path):
+        self.queue.put((path, None, ()))
+
+    def stop(self):
+        # Drain everything queued so far, then end the thread
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        files = {}      # {path: open file}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, pack, args = item
+            try:
+                if pack is None:
+                    replay_file = files.pop(path, None)
+                    if replay_file is not None:
+                        replay_file.close()
+                    continue
+                data = pack(*args)
+                replay_file = files.get(path)
+                if replay_file is None:
+                    replay_file = files[path] = open(path, "ab")
+                replay_file.write(data)
+                replay_file.flush()
+            except (IOError, OSError, struct.error, UnicodeError) as e:
+                print "[ERROR] Replay {0}: {1}".format(path, e)
+        for replay_file in files.values():
+            replay_file.close()
+
+
+class CastleReplayReader:
+    """Memory-mapped view of a replay file. Records are decoded lazily from the map."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            self.file.close()
+            raise ValueError("Not a replay file: {0}".format(path))
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.match_id, self.frames_per_lock_step, self.input_delay, self.started, count = HEADER.unpack_from(self.data)
+        if magic != REPLAY_MAGIC or version not in (1, REPLAY_VERSION):
+            self.close()
+            raise ValueError("Not a replay file: {0}".format(path))
+        self.record = RECORD if version == REPLAY_VERSION else RECORD_V1
+        self.roster = list(struct.unpack_from("!{0}B".format(count), self.data, HEADER.size))
+        self.records_offset = HEADER.size + count
+
+        # The map never grows, so scan once for the allowed step of the last lka and
+        # the keyframes: (lockstep, command offset, snapshot offset, snapshot length).
+        # Every command recorded before the lka allowing lockstep + 1 is at or before
+        # that lockstep, so a keyframe's commands resume right after that lka
+        self.last_step = 0
+        self.keyframes = []
+        steps = []
+        step_ends = []
+        for offset, kind, turn, data in self.records():
+            if kind == RECORD_STEP:
+                self.last_step = turn
+                steps.append(turn)
+                step_ends.append(offset + self.record.size)
+            elif kind == RECORD_KEYFRAME:
+                i = bisect.bisect_right(steps, turn + 1)
+                command_offset = step_ends[i - 1] if i > 0 else self.records_offset
+                self.keyframes.append((turn, command_offset, offset + self.record.size, len(data)))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def records(self, offset=None):
+        # Yields (offset, kind, turn, data); stops at a record cut short by a crash
+        data = self.data
+        size = len(data)
+        record = self.record
+        if offset is None:
+            offset = self.records_offset
+        while offset + record.size <= size:
+            kind, turn, length = record.unpack_from(data, offset)
+            start = offset + record.size
+            if start + length > size:
+                break
+            yield offset, kind, turn, data[start:start + length]
+            offset = start + length
+
+    def commands(self, offset=None):
+        # Yields (offset, turn, cmd) in recorded order
+        for offset, kind, turn, cmd in self.records(offset):
+            if kind == RECORD_COMMAND:
+                yield offset, turn, cmd
+
+
+class CastleReplaySimulation:
+    """Rebuilds the match of a replay and steps it headless, the way every client did.
+
+    Each lockstep applies the commands of its turn in bundle order, folds the
+    state hash, then runs frames_per_lock_step ticks, like CastleClient.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.model = CastleGameModel(None, reader.roster, None)
+        self.lock_step_id = 0
+        self.command_count = 0
+        self._read_commands_from(None)
+
+    def _read_commands_from(self, offset):
+        self._commands = self.reader.commands(offset)
+        self._next_command = next(self._commands, None)
+
+    @property
+    def command_offset(self):
+        # Replay offset of the first command not applied yet
+        if self._next_command is None:
+            return len(self.reader.data)
+        return self._next_command[0]
+
+    @property
+    def last_step(self):
+        # Clients may run every step below the last allowed one
+        return self.reader.last_step - 1
+
+    def tick_lock_step(self):
+        self.lock_step_id += 1
+        while self._next_command is not None and self._next_command[1] <= self.lock_step_id:
+            offset, turn, cmd = self._next_command
+            if turn == self.lock_step_id:
+                CastleGameCommand.decode_command(cmd).apply_to(self.model)
+                self.command_count += 1
+            self._next_command = next(self._commands, None)
+
+        self.model.tick_lock_step()
+        self.model.advance(self.reader.frames_per_lock_step)
+
+    def run(self, until=None):
+        # Run up to lockstep until (default: as far as the match got)
+        if until is None or until > self.last_step:
+            until = self.last_step
+        while self.lock_step_id < until:
+            self.tick_lock_step()
+
+    def seek(self, turn, index):
+        # Restore the last keyframe at or before turn, then replay the locksteps after it
+        keyframe = index.keyframe_for(turn)
+        if keyframe is not None and (keyframe[0] > self.lock_step_id or turn < self.lock_step_id):
+            self.lock_step_id, offset, snapshot = keyframe
+            self.model = CastleGameModel.restore(snapshot)
+            self._read_commands_from(offset)
+        elif turn < self.lock_step_id:
+            # no usable keyframe: start over
+            self.__init__(self.reader)
+        self.run(turn)
+
+
+class CastleReplayIndex:
+    """Memory-mapped keyframe index of a replay, see the module docstring."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.interval, self.count = INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError("Not a replay index: {0}".format(path))
+
+    @classmethod
+    def path_for(cls, replay_path):
+        return replay_path + INDEX_EXTENSION
+
+    @classmethod
+    def from_keyframes(cls, reader, interval):
+        # Index the keyframes recorded in the replay, no simulation needed; the
+        # table entry for k * interval points at the last keyframe at or before it
+        keyframes = [(0, reader.records_offset, CastleGameModel(None, reader.roster, None).snapshot())]
+        for step, command_offset, snapshot_offset, length in reader.keyframes:
+            if step > keyframes[-1][0]:
+                keyframes.append((step, command_offset, reader.data[snapshot_offset:snapshot_offset + length]))
+        entries = []
+        k = 0
+        for step in range(0, max(0, reader.last_step - 1) + 1, interval):
+            while k + 1 < len(keyframes) and keyframes[k + 1][0] <= step:
+                k += 1
+            entries.append(k)
+        return cls._write(reader, interval, [x[:2] for x in keyframes], [x[2] for x in keyframes], entries)
+
+    @classmethod
+    def build(cls, reader, interval):
+        # Replays recorded without keyframes: simulate the whole replay once,
+        # keeping a snapshot every interval locksteps
+        simulation = CastleReplaySimulation(reader)
+        last_step = simulation.last_step
+        keyframes = []
+        snapshots = []
+        while True:
+            keyframes.append((simulation.lock_step_id, simulation.command_offset))
+            snapshots.append(simulation.model.snapshot())
+            if simulation.lock_step_id + interval > last_step:
+                break
+            simulation.run(simulation.lock_step_id + interval)
+        return cls._write(reader, interval, keyframes, snapshots, range(len(keyframes)))
+
+    @classmethod
+    def _write(cls, reader, interval, keyframes, snapshots, entries):
+        # keyframes: [(lockstep, command offset)] with their snapshots; entries: keyframe of each table slot
+        path = cls.path_for(reader.path)
+        snapshot_offsets = []
+        snapshot_offset = INDEX_HEADER.size + INDEX_ENTRY.size * len(entries)
+        for snapshot in snapshots:
+            snapshot_offsets.append(snapshot_offset)
+            snapshot_offset += len(snapshot)
+        with open(path, "wb") as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, interval, len(entries)))
+            for k in entries:
+                step, command_offset = keyframes[k]
+                index_file.write(INDEX_ENTRY.pack(step, command_offset, snapshot_offsets[k], len(snapshots[k])))
+            for snapshot in snapshots:
+                index_file.write(snapshot)
+        return cls(path)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def keyframe_for(self, turn):
+        # (lockstep, command offset, snapshot) of the last keyframe at or before turn
+        if self.count == 0 or turn < 0:
+            return None
+        k = min(turn // self.interval, self.count - 1)
+        step, command_offset, snapshot_offset, length = INDEX_ENTRY.unpack_from(
+            self.data, INDEX_HEADER.size + INDEX_ENTRY.size * k)
+        return step, command_offset, self.data[snapshot_offset:snapshot_offset + length]
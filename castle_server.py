@@ -1,14 +1,22 @@
 from twisted.internet.protocol import Factory, Protocol
 from twisted.protocols.basic import LineReceiver
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet import reactor, defer
 
 from castle_game import CastleGameCommand, CastleGameModel
+from castle_protocol import CastleFramingMixin, fan_out
+from castle_replay import CastleReplayRecorder
 
+import base64
+import collections
 import json
+import math
+import os
+import time
 
 
-class CastleServerProtocol(LineReceiver):
+class CastleServerProtocol(CastleFramingMixin, LineReceiver):
     PAYLOAD_TYPE_COMMAND = "cmd"
     PAYLOAD_TYPE_STATE_CHANGE = "cs"
     PAYLOAD_TYPE_ALL_POSITION = "ap"
@@ -16,24 +24,47 @@ class CastleServerProtocol(LineReceiver):
     PAYLOAD_TYPE_LOCKSTEP_FINISH = "lkf"
     PAYLOAD_TYPE_LOCKSTEP_ALLOW = "lka"
     PAYLOAD_TYPE_ERROR = "err"
+    PAYLOAD_TYPE_PING = "png"
+    PAYLOAD_TYPE_PONG = "pog"
+    PAYLOAD_TYPE_REJOIN_TOKEN = "tk"
+    PAYLOAD_TYPE_REJOIN = "rj"
+    PAYLOAD_TYPE_REJOIN_STATE = "rs"
+    PAYLOAD_TYPE_SNAPSHOT = "snp"
+    PAYLOAD_TYPE_WATCH = "wt"
+    PAYLOAD_TYPE_WATCH_STATE = "ws"
+    PAYLOAD_TYPE_WATCH_SNAPSHOT = "wsn"
+
+    # Weight of a new sample in the smoothed round-trip time, as in TCP
+    RTT_GAIN = 0.125
+
+    # Seconds a connection to a full server may take to ask for its old seat or to watch
+    REJOIN_WAIT = 5.0
 
     def __init__(self, server):
         self.server = server
+        self.match = None
+        self.watching = None    # match this read-only connection spectates
+        self.wants_snapshots = False    # a relay: send it every newer watch snapshot
+        self.rtt = None     # smoothed round-trip time in seconds
+        self.reject_call = None
 
     def connectionMade(self):
-        # Check if game is on; if it's on, deny incoming connection
-        if self.server.is_game_on():
-            self.rejectClient()
+        # New connections go to the lobby; deny them only if the server is full
+        # and they don't rejoin a running match in time
+        if not self.server.player_connected(self):
+            self.reject_call = reactor.callLater(self.REJOIN_WAIT, self.rejectClient)
             return
 
-        self.server.players.append(self)
-        self.server.player_states[self] = self.server.GAME_STATE_MENU
-
-        if DEBUG:
-            print "[INFO] New connection from {0}".format(self.transport.getPeer())
-            print "[INFO] Player states: {0}".format(self.server.player_states)
+        self.sendPing()
+        if DEBUG and self.match is not None:
+            print "[INFO] New connection from {0} in match {1}".format(self.transport.getPeer(), self.match.match_id)
+            print "[INFO] Player states: {0}".format(self.match.player_states)
 
     def connectionLost(self, reason):
+        if self.reject_call is not None and self.reject_call.active():
+            self.reject_call.cancel()
+        if self.watching is not None:
+            self.watching.remove_watcher(self)
         self.server.purge_player(self)
         if DEBUG:
             print "[INFO] Lost connection from {0}".format(self.transport.getPeer())
@@ -48,78 +79,139 @@ class CastleServerProtocol(LineReceiver):
     # ==============
     # Active actions
     # ==============
-    def rejectClient(self):
-        # rejection: {"type": "error", "info": "game is on"}
-        ddict = {"type": self.PAYLOAD_TYPE_ERROR, "info": "Game is currently on"}
-        payload = json.dumps(ddict)
+    def rejectClient(self, info="Server is full"):
+        # rejection: {"type": "error", "info": "server is full"}
+        ddict = {"type": self.PAYLOAD_TYPE_ERROR, "info": info}
         if DEBUG: self.__logDumpPayload(ddict)
-        self.sendLine(payload)
+        self.sendPayload(ddict)
         self.transport.loseConnection()
 
-    def sendPosition(self):
-        all_positions = [i for i, conn in enumerate(self.server.player_pos) if conn != None]
+    def positionPayload(self):
+        all_positions = [i for i, conn in enumerate(self.match.player_pos) if conn != None]
         self.own_position = None
-        if self in self.server.player_pos:
-            self.own_position = self.server.player_pos.index(self)
+        if self in self.match.player_pos:
+            self.own_position = self.match.player_pos.index(self)
 
         # position: {"type": "allpos", "ownpos": ownpos, "allpos": [allpos]}
-        payload_dict = {"type": self.PAYLOAD_TYPE_ALL_POSITION,
-                        "ownpos": self.own_position,
-                        "allpos": all_positions}
-        payload = json.dumps(payload_dict)
+        return {"type": self.PAYLOAD_TYPE_ALL_POSITION,
+                "ownpos": self.own_position,
+                "allpos": all_positions}
+
+    def sendPosition(self):
+        payload_dict = self.positionPayload()
         if DEBUG: self.__logDumpPayload(payload_dict)
-        self.sendLine(payload)
+        self.sendPayload(payload_dict)
+
+    def sendPing(self):
+        # ping: {"type": "png", "t": server_time}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_PING, "t": time.time()})
 
     def sendState(self, state):
         payload_dict = {"type": self.PAYLOAD_TYPE_STATE_CHANGE, "state": state}
-        payload = json.dumps(payload_dict)
         if DEBUG: self.__logDumpPayload(payload_dict)
-        self.sendLine(payload)
+        self.sendPayload(payload_dict)
+
+    def sendAllowLockstep(self, step, cmds):
+        # allow lockstep: {"type": "lka", "step": lockstep, "cmds": [[turn, cmd]]}
+        payload_dict = {"type": self.PAYLOAD_TYPE_LOCKSTEP_ALLOW, "step": step, "cmds": cmds}
+        if DEBUG: self.__logDumpPayload(payload_dict)
+        self.sendPayload(payload_dict)
 
-    def sendAllowLockstep(self, step):
-        payload_dict = {"type": self.PAYLOAD_TYPE_LOCKSTEP_ALLOW, "step": step}
-        payload = json.dumps(payload_dict)
+    def rejectCommands(self, info):
+        # The player stays connected and keeps receiving lka, its commands are dropped
+        ddict = {"type": self.PAYLOAD_TYPE_ERROR, "info": info}
+        if DEBUG: self.__logDumpPayload(ddict)
+        self.sendPayload(ddict)
+
+    def sendRejoinToken(self, match_id, token):
+        # rejoin token: {"type": "tk", "match": match_id, "token": token}
+        self.sendPayload({"type": self.PAYLOAD_TYPE_REJOIN_TOKEN, "match": match_id, "token": token})
+
+    def sendRejoinState(self, payload_dict, data):
+        # rejoin state: see CastleMatch.rejoin_payload; data is payload_dict encoded with self.codec
+        if DEBUG: self.__logDumpPayload(payload_dict)
+        self.sendEncoded(data, payload_dict)
+
+    def rejoinAnswered(self, ok):
+        if ok:
+            if self.reject_call is not None and self.reject_call.active():
+                self.reject_call.cancel()
+        else:
+            self.rejectClient("Cannot rejoin match")
+
+    def sendWatchState(self, payload_dict):
+        # watch state: see CastleMatch.watch_payload
         if DEBUG: self.__logDumpPayload(payload_dict)
-        self.sendLine(payload)
+        self.sendPayload(payload_dict)
 
 
-    # ==============================
-    # Passive action (line received)
-    # ==============================
-    def lineReceived(self, line):
+    # =================================
+    # Passive action (payload received)
+    # =================================
+    def payloadReceived(self, ddict):
         # Receive a command from the client
-        ddict = json.loads(line)
         if DEBUG: self.__logDumpLine(ddict)
 
+        if ddict["type"] == self.PAYLOAD_TYPE_REJOIN:
+            # rejoin: {"type": "rj", "match": match_id, "token": token}
+            # the answer may come later when another process runs the match
+            defer.maybeDeferred(self.server.rejoin_player, self, ddict["match"], ddict["token"]).addCallback(self.rejoinAnswered)
+            return
+
+        if ddict["type"] == self.PAYLOAD_TYPE_WATCH:
+            # watch: {"type": "wt", "match": match_id}, relays add "snaps": true
+            self.wants_snapshots = bool(ddict.get("snaps"))
+            if self.server.watch_match(self, ddict["match"]):
+                if self.reject_call is not None and self.reject_call.active():
+                    self.reject_call.cancel()
+            else:
+                self.rejectClient("Cannot watch match")
+            return
+
+        if self.match is None:
+            # rejected connection, ignore anything it says
+            return
+
         if ddict["type"] == self.PAYLOAD_TYPE_COMMAND:
             # game command: {"type": "cmd", "lturn": cmd_dict["turn"], "cmd": cmd_dict["command"].serialize()}
-            # broadcast command
-            self.server.broadcast_command(self, ddict)
+            # hold the command until its turn is bundled
+            self.match.queue_command(self, ddict)
 
         elif ddict["type"] == self.PAYLOAD_TYPE_STATE_CHANGE:
             # state change: {"type": "chgstate", "state": state}
+            if ddict["state"] == self.server.GAME_STATE_MENU and self.match.started:
+                # back in the menu after the game ended
+                self.server.return_to_lobby(self)
+                return
             # change state
-            self.server.player_change_state(self, ddict["state"])
+            self.match.player_change_state(self, ddict["state"])
             # if everyone is ready, broadcast game start
-            if self.server.is_everyone_ready():
+            if self.match.is_everyone_ready():
                 # TODO: countdown
-                self.server.broadcast_ready()
+                self.server.start_match(self.match)
 
         elif ddict["type"] == self.PAYLOAD_TYPE_SELECT_POSITION:
             # select position: {"type": "selpos", "pos": pos}
-            if self.server.player_select_position(self, ddict["pos"]):
-                self.server.broadcast_position()
+            if self.match.player_select_position(self, ddict["pos"]):
+                self.match.broadcast_position()
             else:
                 self.sendPosition()
 
         elif ddict["type"] == self.PAYLOAD_TYPE_LOCKSTEP_FINISH:
-            # lockstep finish: {"type": "lkf", "step": lockstep}
-            self.server.player_step[self.own_position] = ddict["step"]
-            for step in self.server.player_step:
-                if step is not None and step < ddict["step"]:
-                    return
-            self.server.allowed_step = ddict["step"] + 2
-            self.server.broadcast_allow_lockstep()
+            # lockstep finish: {"type": "lkf", "step": lockstep, "hash": state hash after that step}
+            self.match.player_finish_lockstep(self, ddict["step"], ddict.get("hash"))
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_SNAPSHOT:
+            # snapshot: {"type": "snp", "step": lockstep, "snap": base64 CastleGameModel.snapshot()}
+            self.match.store_snapshot(ddict["step"], base64.b64decode(ddict["snap"]))
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_PONG:
+            # pong: {"type": "pog", "t": server_time from the ping}
+            sample = time.time() - ddict["t"]
+            if self.rtt is None:
+                self.rtt = sample
+            else:
+                self.rtt += self.RTT_GAIN * (sample - self.rtt)
 
 
 class CastleServerProtocolFactory(Factory):
@@ -131,39 +223,159 @@ class CastleServerProtocolFactory(Factory):
         return new_protocol
 
 
-class CastleServer:
-    """Castle game server class."""
-    # Game states
-    GAME_STATE_WAITING = 0
-    GAME_STATE_READY   = 1
-    GAME_STATE_PLAYING = 2
-    GAME_STATE_MENU    = 3
+class CastleLockstepBarrier:
+    """Incremental lockstep barrier of one match.
 
-    def __init__(self, port, debug=False):
-        self.port = port
-        self.players = []           # [conns]
-        self.player_states = {}     # {conn: state}
-        self.player_pos = [None, None, None, None] # [conns]
+    Keeps how many players sit at each completed step, so finding the
+    slowest player costs O(1) amortized per lkf instead of a scan.
+    """
+    def __init__(self, delay=2):
+        self.delay = delay          # turns players may run ahead of the slowest one
+        self.steps = {}             # {pos: completed step}
+        self.counts = {}            # {step: number of players at that step}
+        self.min_step = 0
 
-        self.player_step = [None, None, None, None] # [steps]
-        self.allowed_step = 2
+    def __len__(self):
+        return len(self.steps)
 
-        global DEBUG
-        DEBUG = debug
+    def __contains__(self, pos):
+        return pos in self.steps
 
-    def start(self):
-        # Start listening
-        server_protocol_factory = CastleServerProtocolFactory(self)
-        endpoint = TCP4ServerEndpoint(reactor, self.port)
-        endpoint.listen(server_protocol_factory)
-        reactor.run()
+    @property
+    def allowed_step(self):
+        return self.min_step + self.delay
+
+    def add(self, pos, step=0):
+        self.steps[pos] = step
+        self.counts[step] = self.counts.get(step, 0) + 1
+        if len(self.steps) == 1 or step < self.min_step:
+            self.min_step = step
+
+    def finish(self, pos, step):
+        # Returns True if the slowest player moved, i.e. allowed_step grew
+        old_step = self.steps.get(pos)
+        if old_step is None or step <= old_step:
+            return False
+        self._leave(old_step)
+        self.steps[pos] = step
+        self.counts[step] = self.counts.get(step, 0) + 1
+        return self._raise_min(old_step)
+
+    def slowest(self):
+        # Positions of the players holding the barrier at min_step
+        return [pos for pos, step in self.steps.items() if step == self.min_step]
+
+    def remove(self, pos):
+        # Returns True if allowed_step grew because the slowest player left
+        old_step = self.steps.pop(pos, None)
+        if old_step is None:
+            return False
+        self._leave(old_step)
+        if len(self.steps) == 0:
+            return False
+        return self._raise_min(old_step)
+
+    def _leave(self, step):
+        self.counts[step] -= 1
+        if self.counts[step] == 0:
+            del self.counts[step]
+
+    def _raise_min(self, old_step):
+        if old_step != self.min_step or old_step in self.counts:
+            return False
+        # steps only grow, so each step is walked past at most once
+        while self.min_step not in self.counts:
+            self.min_step += 1
+        return True
+
+
+class CastleMatch:
+    """A single game room. Each match owns its roster and its lockstep barrier."""
+    # Must match CastleClient.DESIRED_FPS
+    DESIRED_FPS = 30.0
+
+    # Used when no player answered a ping yet
+    DEFAULT_FRAMES_PER_LOCK_STEP = 5
+    DEFAULT_INPUT_DELAY = 2
+
+    # Turn length bounds in client frames, and the input delay we try to stay under
+    MIN_FRAMES_PER_LOCK_STEP = 2
+    MAX_FRAMES_PER_LOCK_STEP = 10
+    TARGET_INPUT_DELAY = 3
+
+    # Slack on top of the worst round trip: jitter factor and per-hop processing
+    RTT_MARGIN = 1.5
+    PROCESSING_TIME = 0.01
+
+    # Waits between two lka longer than this are logged as stalls
+    STALL_LOG_AFTER = 0.5
+
+    # Turns spectators run behind the players, so they can't scout for one
+    DEFAULT_WATCH_DELAY = 10
+
+    # Longest serialized command accepted from a player
+    MAX_COMMAND_LENGTH = 16384
+
+    def __init__(self, server, match_id):
+        self.server = server
+        self.match_id = match_id
+        self.players = []           # [conns]
+        self.player_states = {}     # {conn: state}
+        self.player_pos = [None, None, None, None] # [conns]
+        self.started = False
+
+        self.barrier = CastleLockstepBarrier()
+        self.allowed_step = self.barrier.allowed_step
+        self.turn_commands = {}     # {turn: [(pos, cmd)]} not bundled yet
+        self.step_hashes = {}       # {step: (state hash, pos)} first hash reported, until everyone passed it
+        self.desync_step = None     # first step where two players reported different hashes
+        self.replay = None          # CastleReplayWriter while the game is recorded
+
+        # Stalled players, see check_stall
+        self.waiting_since = None   # when allowed_step last grew
+        self.benched = set()        # [pos] out of the barrier until they catch up (empty input policy)
+        self.spectators = set()     # [pos] out of the barrier for good (spectate policy)
+
+        # Rejoining: seats by secret token, the latest snapshot a client uploaded
+        # and every command bundled after it
+        self.tokens = {}            # {token: pos}
+        self.snapshot_step = 0
+        self.snapshot = None
+        self.command_log = []       # [[turn, cmd]] with turn > snapshot_step
+
+        # Spectators: read-only connections (viewers or relays) that get every lka
+        # watch_delay locksteps late, and the same rejoin data as of that point
+        self.watchers = []          # [conns]
+        self.watch_delay = self.server.watch_delay
+        self.watch_backlog = collections.deque()    # lka payloads not released to watchers yet
+        self.watch_snapshots = collections.deque()  # (step, snapshot) newer than watched_step
+        self.watched_step = 0
+        self.watch_snapshot_step = 0
+        self.watch_snapshot = None
+        self.watch_log = []         # [[turn, cmd]] released, with turn > watch_snapshot_step
+
+        # Picked from measured round trips when the game starts
+        self.frames_per_lock_step = self.DEFAULT_FRAMES_PER_LOCK_STEP
+        self.input_delay = self.DEFAULT_INPUT_DELAY
+        self.max_rtt = None
+
+    def __str__(self):
+        return "<Match> {0}".format(self.match_id)
 
     def is_game_on(self):
         if len(self.players) > 0:
-            return (self.player_states[self.players[0]] == self.GAME_STATE_PLAYING)
+            return (self.player_states[self.players[0]] == self.server.GAME_STATE_PLAYING)
         else:
             return False
 
+    def is_full(self):
+        return len(self.players) >= len(self.player_pos)
+
+    def add_player(self, player):
+        self.players.append(player)
+        self.player_states[player] = self.server.GAME_STATE_MENU
+        player.match = self
+
     def purge_player(self, player):
         if player in self.players:
             self.players.remove(player)
@@ -171,13 +383,37 @@ class CastleServer:
             if player in self.player_pos:
                 original_pos = self.player_pos.index(player)
                 self.player_pos[original_pos] = None
-                self.player_step[original_pos] = None
+                self.benched.discard(original_pos)
+                self.spectators.discard(original_pos)
                 self.broadcast_position()
+                # nobody waits for a player who left
+                old_min = self.barrier.min_step
+                if self.barrier.remove(original_pos):
+                    self.forget_state_hashes(old_min)
+                    self.advance_allowed_step(self.barrier.allowed_step)
             if len(self.players) == 0:
-                self.allowed_step = 2
+                self.close_replay()
+                for watcher in self.watchers:
+                    watcher.transport.loseConnection()
+                self.watchers = []
+                self.watch_backlog.clear()
+                self.watch_snapshots.clear()
+                self.watch_snapshot = None
+                self.watch_log = []
+                self.barrier = CastleLockstepBarrier()
+                self.allowed_step = self.barrier.allowed_step
+                self.turn_commands = {}
+                self.step_hashes = {}
+                self.desync_step = None
+                self.waiting_since = None
+                self.benched = set()
+                self.spectators = set()
+                self.tokens = {}
+                self.snapshot = None
+                self.command_log = []
 
     def __logDumpPayload(self, payload):
-        print "[INFO] Broadcast msg: {0}".format(payload)
+        print "[INFO] Broadcast msg in match {0}: {1}".format(self.match_id, payload)
 
     # ==============
     # Player actions
@@ -195,40 +431,476 @@ class CastleServer:
 
     def player_change_state(self, player, state):
         self.player_states[player] = state
-        if state == self.GAME_STATE_WAITING:
+        if state == self.server.GAME_STATE_WAITING:
             player.sendPosition()
 
+    def player_finish_lockstep(self, player, step, state_hash=None):
+        if state_hash is not None:
+            self.check_state_hash(player, step, state_hash)
+
+        pos = player.own_position
+        if pos in self.spectators:
+            return
+        if pos in self.benched:
+            if step < self.barrier.min_step:
+                return
+            # caught up with the others, hold the barrier again
+            self.benched.discard(pos)
+            self.barrier.add(pos, step)
+            print "[INFO] Match {0} player {1} caught up at step {2}".format(self.match_id, pos, step)
+            return
+
+        # Only send lka when the slowest player moved the allowed window
+        old_min = self.barrier.min_step
+        if self.barrier.finish(player.own_position, step):
+            self.forget_state_hashes(old_min)
+            self.advance_allowed_step(self.barrier.allowed_step)
+
+    # ================
+    # Desync detection
+    # ================
+    def check_state_hash(self, player, step, state_hash):
+        # The first hash reported for a step is the reference; hashes are chained,
+        # so only the first step that differs is worth reporting
+        if step < self.barrier.min_step:
+            # a rejoining player catching up on steps everyone else already compared
+            return
+        reference = self.step_hashes.setdefault(step, (state_hash, player.own_position))
+        if reference[0] != state_hash and self.desync_step is None:
+            self.desync_step = step
+            print "[ERROR] Match {0} desynced at turn {1}: player {2} hash {3:08x}, player {4} hash {5:08x}".format(
+                self.match_id, step, reference[1], reference[0], player.own_position, state_hash)
+
+    def forget_state_hashes(self, old_min):
+        # Every remaining player reported the steps the barrier moved past
+        for step in range(old_min, self.barrier.min_step + 1):
+            self.step_hashes.pop(step, None)
+
+    # ===============
+    # Stalled players
+    # ===============
+    def check_stall(self, now):
+        # After a grace period, stop waiting for the players holding the barrier:
+        # "spectate" drops them out of the lockstep for good, "empty" plays on
+        # without their input until they catch up
+        policy = self.server.stall_policy
+        if policy is None or self.waiting_since is None or now - self.waiting_since < self.server.stall_grace:
+            return
+        stalled = self.barrier.slowest()
+        if len(stalled) == len(self.barrier):
+            # everyone is equally behind, nobody is waiting on anyone
+            return
+
+        print "[ERROR] Match {0} stalled {1:.1f} s at step {2} on players {3}, policy {4}".format(
+            self.match_id, now - self.waiting_since, self.barrier.min_step, stalled, policy)
+        old_min = self.barrier.min_step
+        for pos in stalled:
+            self.barrier.remove(pos)
+            if policy == self.server.STALL_POLICY_SPECTATE:
+                self.spectators.add(pos)
+                self.player_pos[pos].rejectCommands("Stalled, now spectating")
+            else:
+                self.benched.add(pos)
+        self.forget_state_hashes(old_min)
+        self.advance_allowed_step(self.barrier.allowed_step)
+
     # =================================
     # Command handling and broadcasting
     # =================================
     def is_everyone_ready(self):
-        if DEBUG: print "All player states: {0}".format(self.player_states)
+        if DEBUG: print "All player states in match {0}: {1}".format(self.match_id, self.player_states)
 
         if len(self.players) < 2:
             return False
 
         for player in self.players:
-            if self.player_states[player] != self.GAME_STATE_READY:
+            if self.player_states[player] != self.server.GAME_STATE_READY:
                 return False
         return True
 
-    def broadcast_command(self, origin_protocol, cmd_dict):
-        payload = json.dumps(cmd_dict)
-        if DEBUG: self.__logDumpPayload(cmd_dict)
-        dests = [x for x in self.players if x != origin_protocol]
-        for d in dests:
-            d.sendLine(payload)
+    def queue_command(self, origin_protocol, cmd_dict):
+        if origin_protocol.own_position in self.spectators:
+            return
+        turn = cmd_dict["lturn"]
+        if len(cmd_dict["cmd"]) > self.MAX_COMMAND_LENGTH:
+            print "[ERROR] Match {0} dropped a {1} byte command from player {2}".format(
+                self.match_id, len(cmd_dict["cmd"]), origin_protocol.own_position)
+            return
+        if turn < self.allowed_step:
+            # that turn was already bundled and sent out, everyone has to skip it
+            print "[ERROR] Match {0} dropped late command for turn {1} (allowed {2})".format(self.match_id, turn, self.allowed_step)
+            return
+        self.turn_commands.setdefault(turn, []).append((origin_protocol.own_position, cmd_dict["cmd"]))
+
+    def bundle_commands(self, from_step, to_step):
+        # Commands of turns [from_step, to_step), ordered by turn, then player position, then arrival
+        bundle = []
+        for turn in range(from_step, to_step):
+            cmds = self.turn_commands.pop(turn, None)
+            if cmds:
+                cmds.sort(key=lambda x: x[0])
+                bundle.extend([turn, cmd] for pos, cmd in cmds)
+        return bundle
+
+    def choose_lockstep_settings(self):
+        # A command sent during step k runs at k + delay, and the client can only run
+        # step k + 1 once the slowest player's lkf for step k + 2 - delay made the round
+        # trip. So (delay - 1) turns must cover the worst round trip. Use the shortest
+        # turn that keeps the delay at TARGET_INPUT_DELAY, and grow the delay beyond that.
+        rtts = [x.rtt for x in self.players if x.rtt is not None]
+        if len(rtts) == 0:
+            return self.DEFAULT_FRAMES_PER_LOCK_STEP, self.DEFAULT_INPUT_DELAY
+
+        self.max_rtt = max(rtts)
+        budget = self.max_rtt * self.RTT_MARGIN + self.PROCESSING_TIME
+        for frames in range(self.MIN_FRAMES_PER_LOCK_STEP, self.MAX_FRAMES_PER_LOCK_STEP + 1):
+            turn_length = frames / self.DESIRED_FPS
+            if (self.TARGET_INPUT_DELAY - 1) * turn_length >= budget:
+                break
+        delay = max(2, 1 + int(math.ceil(budget / turn_length)))
+        return frames, delay
+
+    def settings(self):
+        # lockstep settings: {"fpl": frames per lockstep, "delay": input delay in locksteps}
+        return {"fpl": self.frames_per_lock_step, "delay": self.input_delay}
+
+    def start_game(self):
+        self.started = True
+        self.frames_per_lock_step, self.input_delay = self.choose_lockstep_settings()
+        self.barrier = CastleLockstepBarrier(self.input_delay)
+        self.allowed_step = self.barrier.allowed_step
+        print "[INFO] Match {0} lockstep: {1} frames per turn, input delay {2} (max rtt {3})".format(
+            self.match_id, self.frames_per_lock_step, self.input_delay,
+            "{0:.1f} ms".format(self.max_rtt * 1000) if self.max_rtt is not None else "unknown")
+
+        # Every seated player enters the barrier at step 0
+        for pos, player in enumerate(self.player_pos):
+            if player is not None:
+                self.barrier.add(pos)
+        self.waiting_since = time.time()
+        if self.server.recorder is not None:
+            self.replay = self.server.recorder.open(self)
+
+        # A rejoin before any client uploaded a snapshot starts from the initial board
+        roster = [pos for pos, player in enumerate(self.player_pos) if player is not None]
+        self.snapshot_step = 0
+        self.snapshot = CastleGameModel(None, roster, None).snapshot()
+        self.command_log = []
+        self.watched_step = max(0, self.allowed_step - self.watch_delay)
+        self.watch_snapshot_step = 0
+        self.watch_snapshot = self.snapshot
+        self.watch_log = []
+
+        self.broadcast_ready()
+        for pos, player in enumerate(self.player_pos):
+            if player is not None:
+                token = os.urandom(8).encode("hex")
+                self.tokens[token] = pos
+                player.sendRejoinToken(self.match_id, token)
+
+    def close_replay(self):
+        if self.replay is not None:
+            self.replay.close()
+            self.replay = None
+
+    def advance_allowed_step(self, step):
+        if step <= self.allowed_step:
+            return
+        now = time.time()
+        if self.waiting_since is not None and now - self.waiting_since >= self.STALL_LOG_AFTER:
+            print "[INFO] Match {0} waited {1:.2f} s for step {2}".format(self.match_id, now - self.waiting_since, self.allowed_step)
+        self.waiting_since = now
+        cmds = self.bundle_commands(self.allowed_step, step)
+        self.allowed_step = step
+        self.command_log.extend(cmds)
+        if self.replay is not None:
+            self.replay.record_allow(step, cmds)
+        self.watch_backlog.append(self.broadcast_allow_lockstep(cmds))
+        self.release_watched_steps()
+
+    # =========
+    # Rejoining
+    # =========
+    def store_snapshot(self, step, snapshot):
+        # Keep the newest snapshot and only the commands a rejoining client still has to run
+        if step <= self.snapshot_step:
+            return
+        self.snapshot_step = step
+        self.snapshot = snapshot
+        self.command_log = [x for x in self.command_log if x[0] > step]
+        self.watch_snapshots.append((step, snapshot))
+        if self.replay is not None:
+            self.replay.record_keyframe(step, snapshot)
+
+    def can_rejoin(self, token):
+        pos = self.tokens.get(token)
+        return pos is not None and self.player_pos[pos] is None and self.is_game_on()
+
+    def rejoin_player(self, player, token):
+        # Returns False if the rejoin state is too large to send
+        pos = self.tokens[token]
+        payload_dict = self.rejoin_payload(pos)
+        try:
+            data = player.codec.encode(payload_dict)
+        except ValueError as e:
+            print "[ERROR] Player {0} cannot rejoin match {1}: {2}".format(pos, self.match_id, e)
+            return False
+
+        self.add_player(player)
+        self.player_states[player] = self.server.GAME_STATE_PLAYING
+        self.player_pos[pos] = player
+        player.own_position = pos
+
+        # Nobody waits while the player fast-forwards through the command tail
+        self.barrier.add(pos, self.barrier.min_step if len(self.barrier) > 0 else self.snapshot_step)
+        print "[INFO] Player {0} rejoined match {1} from step {2} ({3} commands to catch up)".format(
+            pos, self.match_id, self.snapshot_step, len(self.command_log))
+        player.sendRejoinState(payload_dict, data)
+        return True
+
+    def rejoin_payload(self, pos):
+        # rejoin state: {"type": "rs", "step": allowed step, "snap": base64 snapshot, "cmds": [[turn, cmd]],
+        #                "ownpos": pos, "allpos": [pos], "fpl": frames per lockstep, "delay": input delay}
+        payload_dict = {"type": CastleServerProtocol.PAYLOAD_TYPE_REJOIN_STATE,
+                        "step": self.allowed_step,
+                        "snap": base64.b64encode(self.snapshot),
+                        "cmds": self.command_log,
+                        "ownpos": pos,
+                        "allpos": sorted(self.tokens.values())}
+        payload_dict.update(self.settings())
+        return payload_dict
+
+    # ==========
+    # Spectating
+    # ==========
+    def add_watcher(self, watcher):
+        self.watchers.append(watcher)
+        watcher.watching = self
+        if DEBUG: print "[INFO] Match {0} has {1} watchers".format(self.match_id, len(self.watchers))
+        watcher.sendWatchState(self.watch_payload())
+
+    def remove_watcher(self, watcher):
+        if watcher in self.watchers:
+            self.watchers.remove(watcher)
+        watcher.watching = None
+
+    def release_watched_steps(self):
+        # Every lka goes out to the watchers once the players are watch_delay locksteps past it;
+        # a relay counts as one watcher however many viewers it serves
+        while self.watch_backlog and self.watch_backlog[0]["step"] + self.watch_delay <= self.allowed_step:
+            payload_dict = self.watch_backlog.popleft()
+            self.watched_step = payload_dict["step"]
+            self.watch_log.extend(payload_dict["cmds"])
+            if self.watchers:
+                fan_out(payload_dict, self.watchers)
+
+        # a snapshot can only be shown once watchers got past it
+        if self.watch_snapshots and self.watch_snapshots[0][0] < self.watched_step:
+            while self.watch_snapshots and self.watch_snapshots[0][0] < self.watched_step:
+                self.watch_snapshot_step, self.watch_snapshot = self.watch_snapshots.popleft()
+            self.watch_log = [x for x in self.watch_log if x[0] > self.watch_snapshot_step]
+            # relays rebase the state they hand to late viewers on it
+            relays = [x for x in self.watchers if x.wants_snapshots]
+            if relays:
+                # watch snapshot: {"type": "wsn", "step": snapshot step, "snap": base64 snapshot}
+                fan_out({"type": CastleServerProtocol.PAYLOAD_TYPE_WATCH_SNAPSHOT,
+                         "step": self.watch_snapshot_step,
+                         "snap": base64.b64encode(self.watch_snapshot)}, relays)
+
+    def watch_payload(self):
+        # watch state: {"type": "ws", "step": watched step, "snap": base64 snapshot, "cmds": [[turn, cmd]],
+        #               "allpos": [pos], "fpl": frames per lockstep, "delay": input delay}
+        payload_dict = {"type": CastleServerProtocol.PAYLOAD_TYPE_WATCH_STATE,
+                        "step": self.watched_step,
+                        "snap": base64.b64encode(self.watch_snapshot),
+                        "cmds": self.watch_log,
+                        "allpos": sorted(self.tokens.values())}
+        payload_dict.update(self.settings())
+        return payload_dict
 
     def broadcast_position(self):
-        waiting_players = [x for x in self.players if self.player_states[x] == self.GAME_STATE_WAITING or self.player_states[x] == self.GAME_STATE_READY]
+        waiting_players = [x for x in self.players if self.player_states[x] == self.server.GAME_STATE_WAITING or self.player_states[x] == self.server.GAME_STATE_READY]
 
+        # players only differ by their own position; everyone without a seat shares one payload
+        by_position = {}
         for player in waiting_players:
-            player.sendPosition()
+            payload_dict = player.positionPayload()
+            by_position.setdefault(player.own_position, (payload_dict, []))[1].append(player)
+        for payload_dict, players in by_position.values():
+            if DEBUG: self.__logDumpPayload(payload_dict)
+            fan_out(payload_dict, players)
 
     def broadcast_ready(self):
-        for player in self.players:
-            player.sendState(self.GAME_STATE_PLAYING)
+        # game start: {"type": "cs", "state": playing, "fpl": frames per lockstep, "delay": input delay}
+        payload_dict = {"type": CastleServerProtocol.PAYLOAD_TYPE_STATE_CHANGE, "state": self.server.GAME_STATE_PLAYING}
+        payload_dict.update(self.settings())
+        if DEBUG: self.__logDumpPayload(payload_dict)
+        fan_out(payload_dict, self.players)
 
-    def broadcast_allow_lockstep(self):
-        for player in self.players:
-            player.sendAllowLockstep(self.allowed_step)
+    def broadcast_allow_lockstep(self, cmds):
+        # allow lockstep: {"type": "lka", "step": lockstep, "cmds": [[turn, cmd]]}
+        payload_dict = {"type": CastleServerProtocol.PAYLOAD_TYPE_LOCKSTEP_ALLOW, "step": self.allowed_step, "cmds": cmds}
+        if DEBUG: self.__logDumpPayload(payload_dict)
+        fan_out(payload_dict, self.players)
+        return payload_dict
+
+
+class CastleServer:
+    """Castle game server class. Hosts many concurrent matches on one reactor."""
+    # Game states
+    GAME_STATE_WAITING = 0
+    GAME_STATE_READY   = 1
+    GAME_STATE_PLAYING = 2
+    GAME_STATE_MENU    = 3
+
+    # Seconds between round-trip measurements of every connection
+    PING_INTERVAL = 1.0
+
+    # What to do with a player that holds the lockstep barrier longer than the grace period
+    STALL_POLICY_SPECTATE = "spectate"
+    STALL_POLICY_EMPTY = "empty"
+    STALL_POLICIES = (STALL_POLICY_SPECTATE, STALL_POLICY_EMPTY)
+    DEFAULT_STALL_GRACE = 3.0
+    STALL_CHECK_INTERVAL = 0.25
+
+    def __init__(self, port, debug=False, max_matches=0, replay_dir=None, stall_policy=None, stall_grace=DEFAULT_STALL_GRACE,
+                 watch_delay=CastleMatch.DEFAULT_WATCH_DELAY):
+        self.port = port
+        self.max_matches = max_matches  # 0 means unlimited
+        self.matches = {}           # {match_id: match}
+        self.lobby = None           # match accepting new connections
+        self.next_match_id = 0
+        self.ping_call = LoopingCall(self.ping_players)
+
+        # None waits for stalled players forever
+        self.stall_policy = stall_policy
+        self.stall_grace = stall_grace
+        self.stall_call = LoopingCall(self.check_stalls)
+
+        # Locksteps spectators run behind the players
+        self.watch_delay = watch_delay
+
+        # Every started match writes a replay into replay_dir
+        self.replay_dir = replay_dir
+        self.recorder = None
+        if replay_dir is not None:
+            self.recorder = CastleReplayRecorder(replay_dir)
+            reactor.addSystemEventTrigger("before", "shutdown", self.stop_recording)
+
+        global DEBUG
+        DEBUG = debug
+
+    def listen(self):
+        # Start listening without running the reactor
+        self.start_timers()
+        server_protocol_factory = CastleServerProtocolFactory(self)
+        endpoint = TCP4ServerEndpoint(reactor, self.port)
+        return endpoint.listen(server_protocol_factory)
+
+    def start(self):
+        self.listen()
+        reactor.run()
+
+    def stop_recording(self):
+        for match in self.matches.values():
+            match.close_replay()
+        self.recorder.stop()
+
+    def start_timers(self):
+        if not self.ping_call.running:
+            self.ping_call.start(self.PING_INTERVAL, now=False)
+        if self.stall_policy is not None and not self.stall_call.running:
+            self.stall_call.start(self.STALL_CHECK_INTERVAL, now=False)
+
+    def ping_players(self):
+        for match in self.matches.values():
+            for player in match.players:
+                player.sendPing()
+
+    def check_stalls(self):
+        now = time.time()
+        for match in self.matches.values():
+            if match.is_game_on():
+                match.check_stall(now)
+
+    # ================
+    # Match management
+    # ================
+    def open_match(self):
+        # Return the lobby match, creating a new one if the current one can't take more players
+        if self.lobby is None or self.lobby.is_game_on() or self.lobby.is_full():
+            if self.max_matches > 0 and len(self.matches) >= self.max_matches:
+                return None
+            self.lobby = self.create_match()
+        return self.lobby
+
+    def create_match(self, match_id=None):
+        if match_id is None:
+            match_id = self.next_match_id
+            self.next_match_id += 1
+        match = CastleMatch(self, match_id)
+        self.matches[match_id] = match
+        if DEBUG: print "[INFO] Opened match {0}, {1} matches running".format(match_id, len(self.matches))
+        return match
+
+    def player_connected(self, player):
+        match = self.open_match()
+        if match is None:
+            return False
+        match.add_player(player)
+        return True
+
+    def rejoin_player(self, player, match_id, token):
+        # Give a reconnecting player its seat back in a running match
+        match = self.matches.get(match_id)
+        if match is None or not match.can_rejoin(token):
+            return False
+        if player.match is not None:
+            # leave the lobby it was put in on connect
+            self.purge_player(player)
+            player.match = None
+        return match.rejoin_player(player, token)
+
+    def watch_match(self, watcher, match_id):
+        # Turn a connection into a read-only spectator of a running match
+        match = self.matches.get(match_id)
+        if match is None or not match.is_game_on():
+            return False
+        if watcher.match is not None:
+            # leave the lobby it was put in on connect
+            self.purge_player(watcher)
+            watcher.match = None
+        match.add_watcher(watcher)
+        return True
+
+    def start_match(self, match):
+        # The match leaves the lobby; later connections get a new one
+        if match is self.lobby:
+            self.lobby = None
+        match.start_game()
+
+    def return_to_lobby(self, player):
+        # A player done with its match joins the lobby again, as if it just connected
+        self.purge_player(player)
+        player.match = None
+        match = self.open_match()
+        if match is None:
+            player.rejectClient()
+            return
+        match.add_player(player)
+
+    def purge_player(self, player):
+        match = player.match
+        if match is None:
+            return
+        match.purge_player(player)
+        if len(match.players) == 0:
+            self.matches.pop(match.match_id, None)
+            if match is self.lobby:
+                self.lobby = None
+            self.match_closed(match)
+            if DEBUG: print "[INFO] Closed match {0}, {1} matches running".format(match.match_id, len(self.matches))
+
+    def match_closed(self, match):
+        # Hook for subclasses that track matches outside this process
+        pass
@@ -0,0 +1,551 @@
+from twisted.internet.protocol import Factory, ClientFactory, ProcessProtocol
+from twisted.protocols.basic import LineReceiver
+from twisted.internet.interfaces import IFileDescriptorReceiver, IPullProducer
+from twisted.internet import reactor, defer
+from zope.interface import implementer
+
+from castle_server import CastleServer, CastleMatch, CastleServerProtocolFactory
+
+import base64
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+
+# ==========================
+# Moving sockets in the pool
+# ==========================
+@implementer(IPullProducer)
+class CastleFlushWatcher:
+    """Tells when everything written to a player's socket so far went out.
+
+    A pull producer is asked for data when it is registered and again each time
+    the write buffer runs empty. The first time it writes a ping, so the second
+    time the ping and everything written before it have left the buffer.
+    """
+    def __init__(self, player):
+        self.player = player
+        self.pinged = False
+        self.flushed = defer.Deferred()     # fires with player, or None if the connection was lost
+
+    def resumeProducing(self):
+        if not self.pinged:
+            self.pinged = True
+            self.player.sendPing()
+        elif not self.flushed.called:
+            self.player.transport.unregisterProducer()
+            self.flushed.callback(self.player)
+
+    def stopProducing(self):
+        if not self.flushed.called:
+            self.flushed.callback(None)
+
+
+def adopt_socket(fd, factory):
+    # Take over a socket the other process passed. Returns its transport
+    transport = reactor.adoptStreamConnection(fd, socket.AF_INET, factory)
+    os.close(fd)
+    return transport
+
+
+def receive_pending(transport, pending):
+    # Handle what the other process had read from the socket but not handled
+    data = base64.b64decode(pending)
+    if transport is not None and data:
+        transport.protocol.dataReceived(data)
+
+
+def release_socket(player):
+    # Let go of this process's copy of a socket the other process adopted. Closing
+    # the handle rather than the connection skips the shutdown() that would end
+    # the connection for the other process too
+    if player.reject_call is not None and player.reject_call.active():
+        player.reject_call.cancel()
+    player.match = None
+    player.transport.stopReading()
+    player.transport.stopWriting()
+    player.transport.getHandle().close()
+
+
+@implementer(IFileDescriptorReceiver)
+class CastleHandOverMixin:
+    """Player sockets moving between the two ends of a pool connection.
+
+    Reading stops at once. The fds and a line describing them follow once
+    everything this process wrote to them went out, and this process lets
+    go of its copies when the other end answers "adopted".
+    """
+    PAYLOAD_TYPE_ADOPTED = "adopted"
+
+    def fileDescriptorReceived(self, fd):
+        self.pending_fds.append(fd)
+
+    def sendAdopted(self, key):
+        # adopted: {"type": "adopted", "key": key of the hand-over}
+        self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_ADOPTED, "key": key}))
+
+    def adopted(self, key):
+        for player in self.handoffs.pop(key, []):
+            release_socket(player)
+
+    def _pending(self, player):
+        # Bytes player read but did not handle yet, for the other process to handle
+        return base64.b64encode(player.clearBuffers())
+
+    def _handOver(self, players, key, describe):
+        # describe(players) returns the line that follows the fds; players that
+        # left meanwhile are not passed. Pausing also stops the protocol handling
+        # the rest of a chunk it already read. The sockets belong to the other
+        # process from now on, so nothing here writes to them any more
+        watchers = []
+        for player in players:
+            player.match = None
+            player.pauseProducing()
+            watcher = CastleFlushWatcher(player)
+            player.transport.registerProducer(watcher, False)
+            watchers.append(watcher.flushed)
+
+        def flushed(results):
+            handed = [player for ok, player in results if player is not None]
+            if len(handed) == 0:
+                return handed
+            for player in handed:
+                self.transport.sendFileDescriptor(player.transport.fileno())
+            self.sendLine(json.dumps(describe(handed)))
+            self.handoffs[key] = handed
+            return handed
+
+        return defer.DeferredList(watchers).addCallback(flushed)
+
+
+# ======================
+# Lobby side of the pool
+# ======================
+class CastleLobbyWorkerProtocol(CastleHandOverMixin, LineReceiver):
+    """Lobby end of the Unix socket connected to one worker process."""
+    PAYLOAD_TYPE_HELLO = "hello"
+    PAYLOAD_TYPE_MATCH = "match"
+    PAYLOAD_TYPE_CHECK_REJOIN = "check"
+    PAYLOAD_TYPE_REJOIN_CHECKED = "checked"
+    PAYLOAD_TYPE_REJOIN = "rejoin"
+    PAYLOAD_TYPE_WATCH = "watch"
+    PAYLOAD_TYPE_RETURN = "return"
+    PAYLOAD_TYPE_CLOSED = "closed"
+
+    def __init__(self, lobby):
+        self.lobby = lobby
+        self.worker_id = None
+        self.match_count = 0
+        self.handoffs = {}      # {key: [conns]} waiting for the worker to adopt them
+        self.pending_fds = []
+        self.rejoin_checks = {} # {token: [Deferred]} waiting for the worker to check the token
+        self.next_watch_id = 0
+
+    def connectionLost(self, reason):
+        self.lobby.worker_lost(self)
+        # nobody is left to adopt or check anything
+        for players in self.handoffs.values():
+            for player in players:
+                player.transport.loseConnection()
+        self.handoffs = {}
+        for checks in self.rejoin_checks.values():
+            for d in checks:
+                d.callback(False)
+        self.rejoin_checks = {}
+
+    def lineReceived(self, line):
+        ddict = json.loads(line)
+        if DEBUG: print "[INFO][POOL] From worker {0}: {1}".format(self.worker_id, ddict)
+
+        if ddict["type"] == self.PAYLOAD_TYPE_HELLO:
+            # hello: {"type": "hello", "worker": worker_id}
+            self.worker_id = ddict["worker"]
+            self.lobby.worker_ready(self)
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_ADOPTED:
+            # adopted: {"type": "adopted", "key": match_id, rejoin token or watch id}
+            self.adopted(ddict["key"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_REJOIN_CHECKED:
+            # rejoin checked: {"type": "checked", "token": token, "ok": bool}
+            checks = self.rejoin_checks.pop(ddict["token"], [])
+            for d in checks:
+                d.callback(ddict["ok"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_RETURN:
+            # return: {"type": "return", "key": key, "codec": codec, "rtt": rtt, "pending": base64 bytes}
+            fd = self.pending_fds.pop(0)
+            self.lobby.adopt_returning(fd, ddict)
+            self.sendAdopted(ddict["key"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_CLOSED:
+            # closed: {"type": "closed", "match": match_id}
+            self.match_count -= 1
+            self.lobby.match_workers.pop(ddict["match"], None)
+
+    def sendMatch(self, match):
+        # match: {"type": "match", "key": match_id, "match": match_id,
+        #         "players": [{"pos": pos, "state": state, "codec": codec, "rtt": rtt, "pending": base64 bytes}]}
+        def describe(players):
+            return {"type": self.PAYLOAD_TYPE_MATCH,
+                    "key": match.match_id,
+                    "match": match.match_id,
+                    "players": [{"pos": player.own_position,
+                                 "state": match.player_states[player],
+                                 "codec": player.codec.NAME,
+                                 "rtt": player.rtt,
+                                 "pending": self._pending(player)} for player in players]}
+        def sent(players):
+            if len(players) == 0:
+                # everyone left before the match could move
+                self.match_count -= 1
+                self.lobby.match_workers.pop(match.match_id, None)
+        self._handOver(list(match.players), match.match_id, describe).addCallback(sent)
+        self.match_count += 1
+
+    def checkRejoin(self, match_id, token):
+        # Deferred firing with whether the worker running the match takes the token
+        # check rejoin: {"type": "check", "match": match_id, "token": token}
+        d = defer.Deferred()
+        self.rejoin_checks.setdefault(token, []).append(d)
+        self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_CHECK_REJOIN, "match": match_id, "token": token}))
+        return d
+
+    def sendRejoin(self, player, match_id, token):
+        # rejoin: {"type": "rejoin", "key": token, "match": match_id, "token": token, "codec": codec, "rtt": rtt,
+        #          "pending": base64 bytes}
+        self._handOver([player], token, lambda players: {"type": self.PAYLOAD_TYPE_REJOIN,
+                                                         "key": token,
+                                                         "match": match_id,
+                                                         "token": token,
+                                                         "codec": player.codec.NAME,
+                                                         "rtt": player.rtt,
+                                                         "pending": self._pending(player)})
+
+    def sendWatch(self, watcher, match_id):
+        # A spectator of a match this worker runs
+        watch_id = "w{0}".format(self.next_watch_id)
+        self.next_watch_id += 1
+        # watch: {"type": "watch", "key": watch id, "match": match_id, "codec": codec, "snaps": relay, "pending": base64 bytes}
+        self._handOver([watcher], watch_id, lambda players: {"type": self.PAYLOAD_TYPE_WATCH,
+                                                             "key": watch_id,
+                                                             "match": match_id,
+                                                             "codec": watcher.codec.NAME,
+                                                             "snaps": watcher.wants_snapshots,
+                                                             "pending": self._pending(watcher)})
+
+
+class CastleLobbyWorkerFactory(Factory):
+    def __init__(self, lobby):
+        self.lobby = lobby
+
+    def buildProtocol(self, addr):
+        return CastleLobbyWorkerProtocol(self.lobby)
+
+
+class CastleWorkerProcessProtocol(ProcessProtocol):
+    def __init__(self, lobby, worker_id):
+        self.lobby = lobby
+        self.worker_id = worker_id
+
+    def processEnded(self, reason):
+        self.lobby.worker_ended(self.worker_id, reason)
+
+
+class CastleLobbyServer(CastleServer):
+    """Front door of the process pool. Accepts TCP connections and forms matches
+    in the lobby, then hands every started match's sockets to a worker process."""
+
+    RUNSERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runserver.py")
+
+    def __init__(self, port, debug=False, max_matches=0, workers=1, replay_dir=None, stall_policy=None,
+                 stall_grace=CastleServer.DEFAULT_STALL_GRACE, watch_delay=CastleMatch.DEFAULT_WATCH_DELAY):
+        CastleServer.__init__(self, port, debug, max_matches, replay_dir, stall_policy, stall_grace, watch_delay)
+        self.worker_count = workers
+        self.workers = []               # [worker conns] that said hello
+        self.match_workers = {}         # {match_id: worker conn} running it
+        self.player_factory = CastleServerProtocolFactory(self)
+        self.returning = None           # return dict of the socket being adopted
+        self.socket_dir = tempfile.mkdtemp(prefix="castle-pool-")
+        self.socket_path = os.path.join(self.socket_dir, "lobby.sock")
+
+        global DEBUG
+        DEBUG = debug
+
+    def start(self):
+        reactor.listenUNIX(self.socket_path, CastleLobbyWorkerFactory(self))
+        for worker_id in range(self.worker_count):
+            self.spawn_worker(worker_id)
+        reactor.addSystemEventTrigger("after", "shutdown", shutil.rmtree, self.socket_dir, True)
+        CastleServer.start(self)
+
+    def spawn_worker(self, worker_id):
+        args = [sys.executable, self.RUNSERVER_PATH, "--worker-socket", self.socket_path, "--worker-id", str(worker_id)]
+        if DEBUG: args.append("-d")
+        if self.replay_dir is not None: args.extend(["--replay-dir", os.path.abspath(self.replay_dir)])
+        if self.stall_policy is not None: args.extend(["--stall-policy", self.stall_policy, "--stall-grace", str(self.stall_grace)])
+        args.extend(["--watch-delay", str(self.watch_delay)])
+        reactor.spawnProcess(CastleWorkerProcessProtocol(self, worker_id), sys.executable, args,
+                             env=os.environ, childFDs={0: "w", 1: 1, 2: 2})
+
+    # ================
+    # Worker lifecycle
+    # ================
+    def worker_ready(self, worker):
+        self.workers.append(worker)
+        print "[INFO][POOL] Worker {0} ready".format(worker.worker_id)
+
+    def worker_lost(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        for match_id, match_worker in self.match_workers.items():
+            if match_worker is worker:
+                del self.match_workers[match_id]
+
+    def worker_ended(self, worker_id, reason):
+        # Only the matches running on that worker are gone; start a replacement
+        print "[ERROR][POOL] Worker {0} ended: {1}".format(worker_id, reason.getErrorMessage())
+        if reactor.running:
+            self.spawn_worker(worker_id)
+
+    # ================
+    # Match management
+    # ================
+    def start_match(self, match):
+        if len(self.workers) == 0:
+            # No worker is up, run the match in the lobby process
+            CastleServer.start_match(self, match)
+            return
+
+        if match is self.lobby:
+            self.lobby = None
+        self.matches.pop(match.match_id, None)
+
+        worker = min(self.workers, key=lambda x: x.match_count)
+        if DEBUG: print "[INFO][POOL] Handing match {0} to worker {1}".format(match.match_id, worker.worker_id)
+        worker.sendMatch(match)
+        self.match_workers[match.match_id] = worker
+
+    def rejoin_player(self, player, match_id, token):
+        # The worker running the match checks the token before the socket moves;
+        # returns a Deferred firing with the answer
+        worker = self.match_workers.get(match_id)
+        if worker is None:
+            return CastleServer.rejoin_player(self, player, match_id, token)
+
+        def checked(ok):
+            if ok:
+                if player.match is not None:
+                    self.purge_player(player)
+                worker.sendRejoin(player, match_id, token)
+            return ok
+        return worker.checkRejoin(match_id, token).addCallback(checked)
+
+    def watch_match(self, watcher, match_id):
+        worker = self.match_workers.get(match_id)
+        if worker is None:
+            return CastleServer.watch_match(self, watcher, match_id)
+        if watcher.match is not None:
+            self.purge_player(watcher)
+            watcher.match = None
+        worker.sendWatch(watcher, match_id)
+        return True
+
+    def adopt_returning(self, fd, returning):
+        # A player of a match that finished on a worker, back for the next one
+        self.returning = returning
+        transport = adopt_socket(fd, self.player_factory)
+        self.returning = None
+        receive_pending(transport, returning["pending"])
+
+    def player_connected(self, player):
+        if self.returning is not None:
+            # it keeps the wire codec and round trip it had on the worker
+            player.useCodec(self.returning["codec"])
+            player.rtt = self.returning["rtt"]
+        return CastleServer.player_connected(self, player)
+
+
+# =======================
+# Worker side of the pool
+# =======================
+class CastleWorkerLobbyProtocol(CastleHandOverMixin, LineReceiver):
+    """Worker end of the Unix socket connected to the lobby."""
+    PAYLOAD_TYPE_HELLO = "hello"
+    PAYLOAD_TYPE_MATCH = "match"
+    PAYLOAD_TYPE_CHECK_REJOIN = "check"
+    PAYLOAD_TYPE_REJOIN_CHECKED = "checked"
+    PAYLOAD_TYPE_REJOIN = "rejoin"
+    PAYLOAD_TYPE_WATCH = "watch"
+    PAYLOAD_TYPE_RETURN = "return"
+    PAYLOAD_TYPE_CLOSED = "closed"
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.handoffs = {}      # {key: [conns]} waiting for the lobby to adopt them
+        self.pending_fds = []
+        self.next_return_id = 0
+
+    def connectionMade(self):
+        self.worker.lobby_conn = self
+        self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_HELLO, "worker": self.worker.worker_id}))
+
+    def connectionLost(self, reason):
+        # Without the lobby there is nothing left to serve
+        print "[ERROR][POOL] Lost lobby connection: {0}".format(reason.getErrorMessage())
+        if reactor.running:
+            reactor.stop()
+
+    def lineReceived(self, line):
+        ddict = json.loads(line)
+        if DEBUG: print "[INFO][POOL] From lobby: {0}".format(ddict)
+
+        if ddict["type"] == self.PAYLOAD_TYPE_MATCH:
+            # match: {"type": "match", "key": match_id, "match": match_id,
+            #         "players": [{"pos": pos, "state": state, "codec": codec, "rtt": rtt, "pending": base64 bytes}]}
+            count = len(ddict["players"])
+            fds = self.pending_fds[:count]
+            self.pending_fds = self.pending_fds[count:]
+            self.worker.adopt_match(ddict["match"], fds, ddict["players"])
+            self.sendAdopted(ddict["key"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_CHECK_REJOIN:
+            # check rejoin: {"type": "check", "match": match_id, "token": token}
+            match = self.worker.matches.get(ddict["match"])
+            # rejoin checked: {"type": "checked", "token": token, "ok": bool}
+            self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_REJOIN_CHECKED,
+                                      "token": ddict["token"],
+                                      "ok": match is not None and match.can_rejoin(ddict["token"])}))
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_REJOIN:
+            # rejoin: {"type": "rejoin", "key": token, "match": match_id, "token": token, "codec": codec, "rtt": rtt,
+            #          "pending": base64 bytes}
+            fd = self.pending_fds.pop(0)
+            self.worker.adopt_rejoin(fd, ddict)
+            self.sendAdopted(ddict["key"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_WATCH:
+            # watch: {"type": "watch", "key": watch id, "match": match_id, "codec": codec, "snaps": relay, "pending": base64 bytes}
+            fd = self.pending_fds.pop(0)
+            self.worker.adopt_watch(fd, ddict)
+            self.sendAdopted(ddict["key"])
+
+        elif ddict["type"] == self.PAYLOAD_TYPE_ADOPTED:
+            # adopted: {"type": "adopted", "key": return id}
+            self.adopted(ddict["key"])
+
+    def sendReturn(self, player):
+        # A player done with its match goes back to the lobby
+        return_id = "p{0}".format(self.next_return_id)
+        self.next_return_id += 1
+        # return: {"type": "return", "key": return id, "codec": codec, "rtt": rtt, "pending": base64 bytes}
+        self._handOver([player], return_id, lambda players: {"type": self.PAYLOAD_TYPE_RETURN,
+                                                             "key": return_id,
+                                                             "codec": player.codec.NAME,
+                                                             "rtt": player.rtt,
+                                                             "pending": self._pending(player)})
+
+    def sendMatchClosed(self, match_id):
+        self.sendLine(json.dumps({"type": self.PAYLOAD_TYPE_CLOSED, "match": match_id}))
+
+
+class CastleWorkerLobbyFactory(ClientFactory):
+    def __init__(self, worker):
+        self.worker = worker
+
+    def buildProtocol(self, addr):
+        return CastleWorkerLobbyProtocol(self.worker)
+
+    def clientConnectionFailed(self, connector, reason):
+        print "[ERROR][POOL] Could not reach lobby: {0}".format(reason.getErrorMessage())
+        reactor.stop()
+
+
+class CastleMatchWorker(CastleServer):
+    """Worker process of the pool. Runs the lockstep loop of the matches the lobby hands over."""
+
+    def __init__(self, socket_path, worker_id, debug=False, replay_dir=None, stall_policy=None,
+                 stall_grace=CastleServer.DEFAULT_STALL_GRACE, watch_delay=CastleMatch.DEFAULT_WATCH_DELAY):
+        CastleServer.__init__(self, None, debug, replay_dir=replay_dir, stall_policy=stall_policy, stall_grace=stall_grace,
+                              watch_delay=watch_delay)
+        self.socket_path = socket_path
+        self.worker_id = worker_id
+        self.lobby_conn = None
+        self.player_factory = CastleServerProtocolFactory(self)
+        self.adopting = None    # (match, player dict) of the socket being adopted
+        self.rejoining = None   # rejoin dict of the socket being adopted
+        self.watching = None    # watch dict of the socket being adopted
+
+        global DEBUG
+        DEBUG = debug
+
+    def start(self):
+        reactor.connectUNIX(self.socket_path, CastleWorkerLobbyFactory(self))
+        self.start_timers()
+        reactor.run()
+
+    def adopt_match(self, match_id, fds, players):
+        match = self.create_match(match_id)
+        adopted = []
+        for fd, player in zip(fds, players):
+            self.adopting = (match, player)
+            adopted.append((adopt_socket(fd, self.player_factory), player["pending"]))
+        self.adopting = None
+        CastleServer.start_match(self, match)
+        # commands the players sent while the match moved belong to the started game
+        for transport, pending in adopted:
+            receive_pending(transport, pending)
+
+    def adopt_rejoin(self, fd, rejoin):
+        self.rejoining = rejoin
+        transport = adopt_socket(fd, self.player_factory)
+        self.rejoining = None
+        receive_pending(transport, rejoin["pending"])
+
+    def adopt_watch(self, fd, watch):
+        self.watching = watch
+        transport = adopt_socket(fd, self.player_factory)
+        self.watching = None
+        receive_pending(transport, watch["pending"])
+
+    def player_connected(self, player):
+        if self.rejoining is not None:
+            # A reconnecting player the lobby passed on, it already picked a codec there.
+            # The lobby had the token checked; only a seat taken since can fail here
+            player.useCodec(self.rejoining["codec"])
+            player.rtt = self.rejoining["rtt"]
+            return self.rejoin_player(player, self.rejoining["match"], self.rejoining["token"])
+
+        if self.watching is not None:
+            # A spectator the lobby passed on
+            player.useCodec(self.watching["codec"])
+            player.wants_snapshots = self.watching.get("snaps", False)
+            return self.watch_match(player, self.watching["match"])
+
+        # Adopted sockets keep the seat, state, wire codec and round trip they had in the lobby
+        if self.adopting is None:
+            return False
+        match, player_dict = self.adopting
+        player.useCodec(player_dict["codec"])
+        player.rtt = player_dict["rtt"]
+        match.add_player(player)
+        match.player_states[player] = player_dict["state"]
+        match.player_pos[player_dict["pos"]] = player
+        player.own_position = player_dict["pos"]
+        return True
+
+    def return_to_lobby(self, player):
+        # The lobby forms the next match, so the socket goes back there
+        self.purge_player(player)
+        player.match = None
+        if self.lobby_conn is None:
+            player.rejectClient()
+            return
+        self.lobby_conn.sendReturn(player)
+
+    def match_closed(self, match):
+        if self.lobby_conn is not None:
+            self.lobby_conn.sendMatchClosed(match.match_id)
@@ -0,0 +1,29 @@
+import argparse
+from twisted.internet import reactor, defer
+from castle_bots import CastleBotSwarm
+
+
+@defer.inlineCallbacks
+def main(args):
+    swarm = CastleBotSwarm(args.server, args.port, args.players, args.apm, not args.json, args.seed)
+    try:
+        yield swarm.run(args.bots, args.duration)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Headless bot load generator for a Castles server.")
+    parser.add_argument("-s", "--server", type=str, default="localhost", dest="server", help="server address")
+    parser.add_argument("-p", "--port", type=int, default=9001, dest="port", help="server port number")
+    parser.add_argument("-n", "--bots", type=int, nargs="+", default=[8, 32, 128, 512], dest="bots", help="bot counts to ramp through, one measured stage each")
+    parser.add_argument("-t", "--duration", type=float, default=10.0, dest="duration", help="seconds measured per stage")
+    parser.add_argument("--players", type=int, default=4, dest="players", help="bots per match")
+    parser.add_argument("--apm", type=float, default=30.0, dest="apm", help="commands per bot per minute")
+    parser.add_argument("--seed", type=int, dest="seed", help="random seed for positions and commands")
+    parser.add_argument("--json", action="store_true", dest="json", help="use the JSON line protocol instead of the binary one")
+    args = parser.parse_args()
+
+    reactor.callWhenRunning(main, args)
+    reactor.run()
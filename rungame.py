@@ -8,9 +8,13 @@ if __name__ == '__main__':
     parser.add_argument("-s", "--server", type=str, dest="server", help="server address", required=True)
     parser.add_argument("-p", "--port", type=int, default=9001, dest="port", help="server port number")
     parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="enable debug mode")
+    parser.add_argument("-w", "--watch", type=int, dest="watch", help="spectate the running match with this id")
+    parser.add_argument("-f", "--fps", type=float, default=CastleClient.DEFAULT_RENDER_FPS, dest="fps", help="frames drawn per second (the game itself always runs at 30 ticks per second)")
+    parser.add_argument("-t", "--network-thread", action="store_true", dest="network_thread", help="run networking on its own thread, leaving the main thread to the game")
+    parser.add_argument("--json", action="store_true", dest="json", help="use the JSON line protocol instead of the binary one")
     args = parser.parse_args()
 
-    client = CastleClient(args.debug)
+    client = CastleClient(args.debug, not args.json, args.watch, args.fps, args.network_thread)
     client.set_server(args.server, args.port)
 
     game_ui = CastleGameUI(args.debug)
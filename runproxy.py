@@ -0,0 +1,47 @@
+import argparse
+from castle_proxy import CastleProxy, CastleLinkProfile
+
+
+def link_profile(args, direction):
+    # --<direction>-<name> overrides --<name> for that direction
+    def pick(name):
+        value = getattr(args, "{0}_{1}".format(direction, name))
+        return value if value is not None else getattr(args, name)
+    return CastleLinkProfile(delay=pick("delay") / 1000.0,
+                             jitter=pick("jitter") / 1000.0,
+                             bandwidth=pick("bandwidth"),
+                             loss=pick("loss"),
+                             loss_penalty=args.loss_penalty / 1000.0,
+                             stall_every=pick("stall_every"),
+                             stall_for=pick("stall_for") / 1000.0)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Latency, jitter and loss proxy for testing Castles over a bad link.")
+    parser.add_argument("-s", "--server", type=str, default="localhost", dest="server", help="server address")
+    parser.add_argument("--server-port", type=int, default=9001, dest="server_port", help="server port number")
+    parser.add_argument("-p", "--port", type=int, default=9002, dest="port", help="port clients connect to")
+    parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="enable debug mode")
+    parser.add_argument("-l", "--log", type=str, dest="log", help="log every shaped chunk to this file")
+    parser.add_argument("--seed", type=int, dest="seed", help="random seed for jitter and loss")
+    parser.add_argument("--loss-penalty", type=float, default=200.0, dest="loss_penalty", help="ms a lost chunk waits for its retransmission")
+
+    # Impairments of both directions, one way each
+    for name, kind, default, text in (("delay", float, 0.0, "one-way delay in ms"),
+                                      ("jitter", float, 0.0, "random extra delay of up to this many ms"),
+                                      ("bandwidth", int, 0, "bytes per second (0 for unlimited)"),
+                                      ("loss", float, 0.0, "chance a chunk is lost and retransmitted"),
+                                      ("stall-every", float, 0.0, "stall the link every this many seconds (0 for never)"),
+                                      ("stall-for", float, 0.0, "ms each stall lasts")):
+        dest = name.replace("-", "_")
+        parser.add_argument("--" + name, type=kind, default=default, dest=dest, help=text)
+        for direction in ("up", "down"):
+            parser.add_argument("--{0}-{1}".format(direction, name), type=kind, dest="{0}_{1}".format(direction, dest),
+                                help="{0}, {1} only".format(text, "client to server" if direction == "up" else "server to client"))
+    args = parser.parse_args()
+
+    # Run proxy
+    proxy = CastleProxy(args.port, args.server, args.server_port, link_profile(args, "up"), link_profile(args, "down"),
+                        args.debug, args.log, args.seed)
+    proxy.start()
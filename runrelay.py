@@ -0,0 +1,16 @@
+import argparse
+from castle_relay import CastleRelay
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Spectator relay for Castles game.")
+    parser.add_argument("-s", "--server", type=str, dest="server", help="match server address", required=True)
+    parser.add_argument("--server-port", type=int, default=9001, dest="server_port", help="match server port number")
+    parser.add_argument("-p", "--port", type=int, default=9101, dest="port", help="port spectators connect to")
+    parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="enable debug mode")
+    parser.add_argument("--json", action="store_true", dest="json", help="use the JSON line protocol towards the match server")
+    args = parser.parse_args()
+
+    # Run relay
+    relay = CastleRelay(args.port, args.server, args.server_port, args.debug, not args.json)
+    relay.start()
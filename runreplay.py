@@ -0,0 +1,94 @@
+import argparse
+import cProfile
+import os
+import pstats
+import time
+
+from castle_replay import CastleReplayReader, CastleReplaySimulation, CastleReplayIndex
+
+DEFAULT_KEYFRAME_INTERVAL = 150     # 25 s of play at the default turn length
+
+
+def print_state(simulation):
+    model = simulation.model
+    print "  lockstep {0}, state hash {1:08x}".format(simulation.lock_step_id, model.state_hash)
+    print "  {0:>6} {1:>8} {2:>8} {3:>8} {4:>10} {5:>9} {6:>9}".format(
+        "player", "money", "income", "castle", "buildings", "soldiers", "defeated")
+    for player in model.player_models:
+        print "  {0:>6} {1:>8} {2:>8} {3:>8} {4:>10} {5:>9} {6:>9}".format(
+            player.pos, player.money, player.money_increment, player.castle.hp,
+            len(player.buildings), len(player.soldiers), player.is_defeated)
+
+
+def open_index(reader, interval):
+    # Reuse the keyframe index next to the replay unless a new interval was asked for.
+    # A new index comes from the keyframes recorded with the match; only replays
+    # without any, or an explicit interval, are simulated to take snapshots
+    index_path = CastleReplayIndex.path_for(reader.path)
+    if interval is None and os.path.exists(index_path):
+        return CastleReplayIndex(index_path)
+    start = time.time()
+    if interval is None and reader.keyframes:
+        index = CastleReplayIndex.from_keyframes(reader, DEFAULT_KEYFRAME_INTERVAL)
+        source = "recorded"
+    else:
+        index = CastleReplayIndex.build(reader, interval or DEFAULT_KEYFRAME_INTERVAL)
+        source = "simulated"
+    print "{0}: {1} keyframes every {2} locksteps ({3}), {4} bytes, built in {5:.3f} s".format(
+        index_path, index.count, index.interval, source, os.path.getsize(index_path), time.time() - start)
+    return index
+
+
+def seek_replay(path, turn, interval):
+    reader = CastleReplayReader(path)
+    index = open_index(reader, interval)
+    simulation = CastleReplaySimulation(reader)
+    start = time.time()
+    simulation.seek(turn, index)
+    print "{0}: seeked to lockstep {1} in {2:.1f} ms".format(path, simulation.lock_step_id, (time.time() - start) * 1000)
+    print_state(simulation)
+    index.close()
+    reader.close()
+
+
+def run_replay(path, until):
+    reader = CastleReplayReader(path)
+    simulation = CastleReplaySimulation(reader)
+    start = time.time()
+    simulation.run(until)
+    elapsed = time.time() - start
+
+    steps = simulation.lock_step_id
+    ticks = steps * reader.frames_per_lock_step
+    print "{0}: match {1}, players {2}, {3} frames per lockstep".format(
+        path, reader.match_id, reader.roster, reader.frames_per_lock_step)
+    print "  {0} locksteps, {1} ticks, {2} commands in {3:.3f} s: {4:.0f} locksteps/s, {5:.0f}x real time".format(
+        steps, ticks, simulation.command_count, elapsed, steps / max(elapsed, 1e-9),
+        ticks / 30.0 / max(elapsed, 1e-9))
+    print_state(simulation)
+    reader.close()
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Fast-forward recorded Castles matches without a display.")
+    parser.add_argument("replays", type=str, nargs="+", help="replay files written by runserver.py -r")
+    parser.add_argument("-u", "--until", type=int, dest="until", help="stop at this lockstep")
+    parser.add_argument("-s", "--seek", type=int, dest="seek", help="jump to this lockstep through the keyframe index")
+    parser.add_argument("-k", "--keyframes", type=int, dest="keyframes", help="(re)build the keyframe index with a keyframe every this many locksteps")
+    parser.add_argument("--profile", action="store_true", dest="profile", help="print the hottest functions of the simulation")
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    for path in args.replays:
+        if profiler is not None: profiler.enable()
+        if args.seek is not None:
+            seek_replay(path, args.seek, args.keyframes)
+        elif args.keyframes is not None:
+            open_index(CastleReplayReader(path), args.keyframes).close()
+        else:
+            run_replay(path, args.until)
+        if profiler is not None: profiler.disable()
+
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("tottime").print_stats(15)
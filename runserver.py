@@ -1,13 +1,30 @@
 import argparse
-from castle_server import CastleServer
+from castle_server import CastleServer, CastleMatch
+from castle_server_pool import CastleLobbyServer, CastleMatchWorker
 
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Server for Castles game.")
     parser.add_argument("-p", "--port", type=int, default=9001, dest="port", help="port number")
     parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="enable debug mode")
+    parser.add_argument("-m", "--max-matches", type=int, default=0, dest="max_matches", help="maximum number of concurrent matches (0 for unlimited)")
+    parser.add_argument("-w", "--workers", type=int, default=0, dest="workers", help="number of match worker processes (0 to run matches in this process)")
+    parser.add_argument("-r", "--replay-dir", type=str, dest="replay_dir", help="record a replay of every match into this directory")
+    parser.add_argument("--stall-policy", choices=CastleServer.STALL_POLICIES, dest="stall_policy", help="stop waiting for a player stalling the lockstep: make it a spectator, or play on with empty input until it catches up")
+    parser.add_argument("--stall-grace", type=float, default=CastleServer.DEFAULT_STALL_GRACE, dest="stall_grace", help="seconds to wait for a stalled player before applying the stall policy")
+    parser.add_argument("--watch-delay", type=int, default=CastleMatch.DEFAULT_WATCH_DELAY, dest="watch_delay", help="locksteps spectators run behind the players")
+    parser.add_argument("--worker-socket", type=str, dest="worker_socket", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-id", type=int, default=0, dest="worker_id", help=argparse.SUPPRESS)
     args = parser.parse_args()
 
     # Run server
-    server = CastleServer(args.port, args.debug)
+    if args.worker_socket is not None:
+        server = CastleMatchWorker(args.worker_socket, args.worker_id, args.debug, args.replay_dir,
+                                   args.stall_policy, args.stall_grace, args.watch_delay)
+    elif args.workers > 0:
+        server = CastleLobbyServer(args.port, args.debug, args.max_matches, args.workers, args.replay_dir,
+                                   args.stall_policy, args.stall_grace, args.watch_delay)
+    else:
+        server = CastleServer(args.port, args.debug, args.max_matches, args.replay_dir, args.stall_policy, args.stall_grace,
+                              args.watch_delay)
     server.start()
@@ -0,0 +1,27 @@
+import unittest
+
+try:
+    from castle_bots import percentile
+except ImportError:     # Twisted is not installed
+    percentile = None
+
+
+@unittest.skipIf(percentile is None, "needs Twisted")
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = range(100, 0, -1)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+
+    def test_few_values(self):
+        self.assertEqual(percentile([0.2], 99), 0.2)
+        self.assertEqual(percentile([0.3, 0.1, 0.2], 50), 0.2)
+        self.assertEqual(percentile([0.3, 0.1, 0.2], 95), 0.3)
+        self.assertEqual(percentile([0.1, 0.2, 0.3, 0.4], 50), 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import unittest
+
+try:
+    from twisted.test.proto_helpers import StringTransport
+    from castle_client import CastleClient
+    from castle_server import CastleMatch, CastleServer, CastleServerProtocol
+except ImportError:     # Twisted is not installed
+    CastleClient = None
+
+from castle_game import CastleGameCommand, CastleGameModel
+from castle_protocol import JSON_CODEC
+
+
+@unittest.skipIf(CastleClient is None, "needs Twisted")
+class CastleClientCatchUpTest(unittest.TestCase):
+    def setUp(self):
+        # A playing client with no server connection or UI, at lockstep 0
+        self.client = CastleClient(render_fps=1.0)
+        self.client.set_game_model(CastleGameModel(None, [0, 1], None))
+        self.client.current_state = CastleClient.GAME_STATE_PLAYING
+        self.client.frames_per_lock_step = 5
+        self.client.input_delay = 2
+        self.client.game_frame_id = 0
+        self.client.allowed_lockstep = 2
+        self.client.reset_clock()
+
+    def owe(self, seconds):
+        self.client.last_frame_time -= seconds
+
+    def test_slowest_client_clears_its_backlog(self):
+        # Holding the barrier, the server lets it run input_delay - 1 locksteps ahead
+        for allowed in range(2, 12):
+            self.client.allowed_lockstep = allowed
+            self.owe(1.0)
+            self.client.tick_simulation()
+            self.assertEqual(self.client.lock_step_id, allowed - 1)
+            self.assertEqual(self.client.lockstep_lag, 0)
+
+    def test_catch_up_follows_real_time(self):
+        # Allowed far ahead, but owing only two locksteps of time
+        self.client.allowed_lockstep = 50
+        self.owe(10 * CastleClient.TICK_LENGTH + 0.001)
+        ticks, alpha = self.client.tick_simulation()
+        self.assertEqual(ticks, 10)
+        self.assertEqual(self.client.lock_step_id, 2)
+
+    def test_waiting_at_the_barrier_owes_nothing(self):
+        self.client.allowed_lockstep = 1
+        self.owe(1.0)
+        self.client.tick_simulation()
+        self.client.allowed_lockstep = 20
+        ticks, alpha = self.client.tick_simulation()
+        self.assertTrue(ticks <= 1)
+        self.assertEqual(self.client.lock_step_id, 1)
+
+
+class Command:
+    """Stands in for a CastleGameCommand; records when it was applied."""
+    def __init__(self, name, applied):
+        self.name = name
+        self.applied = applied
+
+    def apply_to(self, model):
+        self.applied.append((model.lock_step_id + 1, self.name))
+
+
+@unittest.skipIf(CastleClient is None, "needs Twisted")
+class CastleClientPendingCommandsTest(unittest.TestCase):
+    def setUp(self):
+        self.client = CastleClient(render_fps=1.0)
+        self.client.set_game_model(CastleGameModel(None, [0, 1], None))
+        self.client.allowed_lockstep = 10
+        self.applied = []
+
+    def receive(self, turn, name):
+        self.client.receive_game_command({"turn": turn, "command": Command(name, self.applied)})
+
+    def test_commands_run_on_their_turn_in_arrival_order(self):
+        self.receive(5, "c")
+        self.receive(3, "a1")
+        self.receive(3, "a2")
+        self.receive(4, "b")
+        self.assertEqual(self.client.ready_commands, ())
+        while self.client.tick_lock_step():
+            pass
+        self.assertEqual(self.applied, [(3, "a1"), (3, "a2"), (4, "b"), (5, "c")])
+        self.assertEqual(self.client.pending_commands, {})
+
+    def test_turns_ahead_stay_queued(self):
+        self.client.allowed_lockstep = 4
+        self.receive(3, "a")
+        self.receive(7, "later")
+        while self.client.tick_lock_step():
+            pass
+        self.assertEqual(self.applied, [(3, "a")])
+        self.assertEqual(list(self.client.pending_commands), [7])
+
+
+class GameUI:
+    """Stands in for CastleGameUI; a rejoining client only swaps the model in."""
+    def __init__(self, client):
+        self.client = client
+
+    def resume_game(self, game_model):
+        self.client.set_game_model(game_model)
+
+
+def connect(server):
+    player = CastleServerProtocol(server)
+    player.transport = StringTransport()
+    return player
+
+
+@unittest.skipIf(CastleClient is None, "needs Twisted")
+class CastleClientRejoinTest(unittest.TestCase):
+    def setUp(self):
+        # Purple and pink playing; pink's client keeps a reference model of the match
+        self.match = CastleMatch(CastleServer(None), 0)
+        for pos in (0, 1):
+            player = connect(self.match.server)
+            self.match.add_player(player)
+            self.match.player_pos[pos] = player
+            player.own_position = pos
+        self.match.start_game()
+        for player in self.match.players:
+            self.match.player_states[player] = CastleServer.GAME_STATE_PLAYING
+        self.tokens = dict((pos, token) for token, pos in self.match.tokens.items())
+        self.model = CastleGameModel(None, [0, 1], None)
+
+    def play(self, locksteps, commands={}):
+        # Both clients finish every allowed step; commands go in by turn
+        delay = self.match.input_delay
+        start = self.model.lock_step_id + 1
+        for step in range(start, start + locksteps):
+            for pos, cmd in commands.get(step + delay, []):
+                self.match.queue_command(self.match.player_pos[pos], {"lturn": step + delay, "cmd": cmd.serialize()})
+            for pos in (0, 1):
+                self.match.player_finish_lockstep(self.match.player_pos[pos], step)
+            for turn, cmd in self.match.command_log:
+                if turn == step:
+                    CastleGameCommand.decode_command(cmd).apply_to(self.model)
+            self.model.tick_lock_step()
+            self.model.advance(self.match.frames_per_lock_step)
+
+    def rejoin(self, pos):
+        self.match.purge_player(self.match.player_pos[pos])
+        player = connect(self.match.server)
+        self.assertTrue(self.match.can_rejoin(self.tokens[pos]))
+        self.assertTrue(self.match.rejoin_player(player, self.tokens[pos]))
+        client = CastleClient(render_fps=1.0)
+        client.game_ui = GameUI(client)
+        client.current_state = CastleClient.GAME_STATE_PLAYING
+        client.receive_rejoin_state(JSON_CODEC.decode_line(player.transport.value().split("\r\n")[0]))
+        return client
+
+    def test_rejoin_from_snapshot_and_command_tail(self):
+        Build = CastleGameCommand.Build
+        self.play(10, {4: [(0, Build(0, Build.HOUSE, 1, 1)), (1, Build(1, Build.TOWER, 6, 1))]})
+        self.match.store_snapshot(self.model.lock_step_id, self.model.snapshot())
+        self.play(10, {14: [(0, Build(0, Build.MARKET, 2, 0))], 18: [(1, Build(1, Build.HOUSE, 6, 2))]})
+        self.assertEqual([turn for turn, cmd in self.match.command_log], [14, 18])
+
+        client = self.rejoin(1)
+        self.assertEqual(client.own_position, 1)
+        self.assertEqual(client.lock_step_id, self.match.allowed_step - 1)
+        self.assertEqual(client.game_model.current_player.pos, 1)
+        # the rejoined client ran every allowed step; the others are one behind
+        self.play(1)
+        self.assertEqual(client.game_model.snapshot(), self.model.snapshot())
+
+    def test_rejoin_before_any_snapshot(self):
+        self.play(6)
+        client = self.rejoin(0)
+        self.assertEqual(client.lock_step_id, self.match.allowed_step - 1)
+        self.play(1)
+        self.assertEqual(client.game_model.snapshot(), self.model.snapshot())
+
+    def test_only_left_seats_can_be_rejoined(self):
+        self.assertFalse(self.match.can_rejoin(self.tokens[0]))
+        self.assertFalse(self.match.can_rejoin("bad"))
+
+
+if __name__ == "__main__":
+    unittest.main()
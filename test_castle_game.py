@@ -0,0 +1,81 @@
+import unittest
+
+from castle_game import CastleGameCommand, CastleGameModel
+
+
+def play(model, locksteps, frames_per_lock_step=5):
+    # Run locksteps the way every client does: hash, then frames_per_lock_step ticks
+    for i in range(locksteps):
+        model.tick_lock_step()
+        model.advance(frames_per_lock_step)
+
+
+def route_dims(model, house, points):
+    # Route sections from house through the grids in points, as RouteDraft builds them
+    dims = []
+    last = house.grid
+    for x, y in points:
+        grid = model.board[y][x]
+        dims.append((house.color, last.centerx, last.centery, grid.centerx, grid.centery, 4))
+        last = grid
+    return dims
+
+
+class CastleGameSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        # Purple and pink with a house, a tower, a market and soldiers on the way
+        self.model = CastleGameModel(None, [0, 1], None)
+        for player in self.model.player_models:
+            player.money = 1000
+        for cmd in [CastleGameCommand.Build(0, CastleGameCommand.Build.HOUSE, 1, 1),
+                    CastleGameCommand.Build(0, CastleGameCommand.Build.MARKET, 2, 0),
+                    CastleGameCommand.Build(1, CastleGameCommand.Build.TOWER, 6, 1)]:
+            cmd.apply_to(self.model)
+        house = self.model.board[1][1].building
+        CastleGameCommand.Route(1, 1, route_dims(self.model, house, [(x, 1) for x in range(2, 8)] + [(7, 0)])).apply_to(self.model)
+        play(self.model, 60)
+        self.assertTrue(len(self.model.player_models[0].soldiers) > 0)
+
+    def test_restore_round_trip(self):
+        snapshot = self.model.snapshot()
+        restored = CastleGameModel.restore(snapshot)
+        self.assertEqual(restored.snapshot(), snapshot)
+        self.assertEqual(restored.lock_step_id, self.model.lock_step_id)
+        self.assertEqual(restored.state_hash, self.model.state_hash)
+        self.assertEqual(restored.hash_state(), self.model.hash_state())
+
+    def test_restored_model_stays_in_sync(self):
+        restored = CastleGameModel.restore(self.model.snapshot())
+        play(self.model, 100)
+        play(restored, 100)
+        self.assertEqual(restored.state_hash, self.model.state_hash)
+        self.assertEqual(restored.snapshot(), self.model.snapshot())
+
+    def test_hashed_every_interval(self):
+        interval = CastleGameModel.HASH_INTERVAL
+        previous = self.model.state_hash
+        for i in range(2 * interval):
+            self.model.tick_lock_step()
+            if self.model.lock_step_id % interval == 0:
+                self.assertEqual(self.model.state_hash, self.model.hash_state(previous))
+                previous = self.model.state_hash
+            else:
+                self.assertEqual(self.model.state_hash, previous)
+            self.model.advance(5)
+
+    def test_restored_between_hashes_stays_in_sync(self):
+        play(self.model, CastleGameModel.HASH_INTERVAL // 2 + 1)
+        restored = CastleGameModel.restore(self.model.snapshot())
+        play(self.model, 20)
+        play(restored, 20)
+        self.assertEqual(restored.state_hash, self.model.state_hash)
+
+    def test_reroute_drops_soldiers(self):
+        house = self.model.board[1][1].building
+        CastleGameCommand.Route(1, 1, []).apply_to(self.model)
+        self.assertEqual(house.soldiers, [])
+        self.assertFalse([x for x in self.model.player_models[0].soldiers if x.house is house])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import struct
+import unittest
+
+from castle_protocol import BINARY_CODEC, JSON_CODEC, MAX_PAYLOAD_SIZE, CastleFramingMixin
+
+
+# One payload of every type the binary codec packs, plus one it doesn't
+PAYLOADS = [
+    {"type": "cmd", "lturn": 12, "cmd": "B#1#3#4#h"},
+    {"type": "cs", "state": 2},
+    {"type": "ap", "ownpos": 1, "allpos": [0, 1, 3]},
+    {"type": "ap", "ownpos": None, "allpos": []},
+    {"type": "sp", "pos": 3},
+    {"type": "lkf", "step": 1234, "hash": 851149338},
+    {"type": "lka", "step": 40, "cmds": [[38, "B#0#1#1#h"], [39, "B#1#6#1#t"]]},
+    {"type": "lka", "step": 41, "cmds": []},
+    {"type": "err", "info": "Server is full"},
+    {"type": "png", "t": 1400000000.25},
+    {"type": "pog", "t": 1400000000.25},
+    {"type": "tk", "match": 3, "token": "00ff00ff00ff00ff"},
+]
+
+
+class CastleJSONCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for ddict in PAYLOADS:
+            line = JSON_CODEC.encode(ddict)
+            self.assertTrue(line.endswith(JSON_CODEC.DELIMITER))
+            self.assertEqual(JSON_CODEC.decode_line(line[:-len(JSON_CODEC.DELIMITER)]), ddict)
+
+
+class CastleBinaryCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for ddict in PAYLOADS:
+            ddicts, leftover = BINARY_CODEC.split_frames(BINARY_CODEC.encode(ddict))
+            self.assertEqual(ddicts, [ddict])
+            self.assertEqual(leftover, "")
+
+    def test_packed_types_skip_json(self):
+        data = BINARY_CODEC.encode({"type": "lkf", "step": 1, "hash": 2})
+        self.assertNotEqual(struct.unpack_from("!B", data, 2)[0], BINARY_CODEC.MSG_JSON)
+
+    def test_extra_keys_fall_back_to_json(self):
+        ddict = {"type": "lkf", "step": 1, "hash": 2, "extra": "kept"}
+        data = BINARY_CODEC.encode(ddict)
+        self.assertEqual(struct.unpack_from("!B", data, 2)[0], BINARY_CODEC.MSG_JSON)
+        self.assertEqual(BINARY_CODEC.split_frames(data)[0], [ddict])
+
+    def test_stream_split_anywhere(self):
+        data = "".join(BINARY_CODEC.encode(x) for x in PAYLOADS)
+        for cut in range(len(data) + 1):
+            first, leftover = BINARY_CODEC.split_frames(data[:cut])
+            rest, leftover = BINARY_CODEC.split_frames(leftover + data[cut:])
+            self.assertEqual(first + rest, PAYLOADS)
+            self.assertEqual(leftover, "")
+
+    def test_long_frame(self):
+        ddict = {"type": "rs", "snap": "x" * 100000, "cmds": [[1, "B#0#1#1#h"]]}
+        data = BINARY_CODEC.encode(ddict)
+        self.assertEqual(struct.unpack_from("!H", data)[0], 0)
+        self.assertEqual(BINARY_CODEC.split_frames(data[:-1]), ([], data[:-1]))
+        self.assertEqual(BINARY_CODEC.split_frames(data), ([ddict], ""))
+
+    def test_too_large(self):
+        ddict = {"type": "rs", "snap": "x" * (MAX_PAYLOAD_SIZE + 1)}
+        self.assertRaises(ValueError, BINARY_CODEC.encode, ddict)
+        self.assertRaises(ValueError, JSON_CODEC.encode, ddict)
+
+    def test_bad_frames_are_skipped(self):
+        ping = {"type": "png", "t": 2.0}
+        data = (struct.pack("!HB", 3, 77) + "ab" +      # unknown message type
+                struct.pack("!HB", 2, BINARY_CODEC.MSG_PING) + "x" +    # truncated body
+                BINARY_CODEC.encode(ping))
+        self.assertEqual(BINARY_CODEC.split_frames(data), ([ping], ""))
+
+    def test_frames_without_type_are_skipped(self):
+        ping = {"type": "png", "t": 2.0}
+        data = (BINARY_CODEC.encode({"lturn": 3, "cmd": "B#0#1#1#h"}) +
+                struct.pack("!HB", 7, BINARY_CODEC.MSG_JSON) + "[1, 2]" + BINARY_CODEC.encode(ping))
+        self.assertEqual(BINARY_CODEC.split_frames(data), ([ping], ""))
+        self.assertRaises(ValueError, JSON_CODEC.decode_line, '{"lturn": 3}')
+
+
+class Framing(CastleFramingMixin):
+    """CastleFramingMixin over a stand-in for LineReceiver's buffer."""
+    def __init__(self, line_buffer):
+        self.line_buffer = line_buffer
+
+    def clearLineBuffer(self):
+        data, self.line_buffer = self.line_buffer, ""
+        return data
+
+
+class CastleFramingMixinTest(unittest.TestCase):
+    def test_clear_buffers_keeps_order(self):
+        framing = Framing("later")
+        framing._frame_buffer = "older "
+        self.assertEqual(framing.clearBuffers(), "older later")
+        self.assertEqual(framing.clearBuffers(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+try:
+    from twisted.test.proto_helpers import StringTransport
+    from castle_proxy import CastleProxy, CastleLinkProfile, CastleProxyFactory, CastleProxyUpstreamProtocol
+except ImportError:     # Twisted is not installed
+    CastleProxy = None
+
+
+@unittest.skipIf(CastleProxy is None, "needs Twisted")
+class CastleProxyTest(unittest.TestCase):
+    def setUp(self):
+        proxy = CastleProxy(0, "localhost", 0, CastleLinkProfile(), CastleLinkProfile(), seed=1)
+        self.downstream = CastleProxyFactory(proxy).buildProtocol(None)
+        self.downstream.transport = StringTransport()
+
+    def test_upstream_dropped_after_client_left(self):
+        # The client hangs up while the proxy is still connecting to the server
+        self.downstream.dataReceived("hi")
+        self.downstream.connectionLost(None)
+        upstream = StringTransport()
+        CastleProxyUpstreamProtocol(self.downstream).makeConnection(upstream)
+        self.assertTrue(upstream.disconnecting)
+        self.assertEqual(upstream.value(), "")
+        self.assertIsNone(self.downstream.upstream)
+
+
+if __name__ == "__main__":
+    unittest.main()
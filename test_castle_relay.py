@@ -0,0 +1,57 @@
+import json
+import unittest
+
+try:
+    from twisted.test.proto_helpers import StringTransport
+    from castle_relay import CastleRelayFeed, CastleRelayViewerProtocol
+except ImportError:     # Twisted is not installed
+    CastleRelayFeed = None
+
+
+def viewer():
+    protocol = CastleRelayViewerProtocol(None)
+    protocol.transport = StringTransport()
+    return protocol
+
+
+def received(protocol):
+    return [json.loads(x) for x in protocol.transport.value().split("\r\n") if x]
+
+
+@unittest.skipIf(CastleRelayFeed is None, "needs Twisted")
+class CastleRelayFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.feed = CastleRelayFeed(None, 3)
+        self.feed.receive_state({"type": "ws", "step": 9, "snap": "s0", "cmds": [[3, "a"], [5, "b"], [8, "c"]],
+                                 "allpos": [0, 1], "fpl": 5, "delay": 2})
+
+    def test_snapshot_rebases_the_state(self):
+        self.feed.receive_snapshot({"type": "wsn", "step": 5, "snap": "s5"})
+        self.assertEqual(self.feed.state["snap"], "s5")
+        self.assertEqual(self.feed.state["cmds"], [[8, "c"]])
+        self.assertEqual(self.feed.state["step"], 9)
+
+    def test_late_viewer_gets_the_current_state(self):
+        early = viewer()
+        self.feed.add_viewer(early)
+        self.feed.receive_allow({"type": "lka", "step": 10, "cmds": [[9, "d"]]})
+        self.feed.receive_snapshot({"type": "wsn", "step": 8, "snap": "s8"})
+        late = viewer()
+        self.feed.add_viewer(late)
+        self.assertEqual([x["type"] for x in received(early)], ["ws", "lka"])
+        state = received(late)[0]
+        self.assertEqual((state["step"], state["snap"], state["cmds"]), (10, "s8", [[9, "d"]]))
+
+    def test_viewers_wait_while_the_state_is_too_large(self):
+        self.feed.receive_allow({"type": "lka", "step": 10, "cmds": [[9, "x"]] * CastleRelayFeed.MAX_STATE_COMMANDS})
+        waiting = viewer()
+        self.feed.add_viewer(waiting)
+        self.assertEqual(self.feed.waiting, [waiting])
+        self.assertEqual(received(waiting), [])
+        self.feed.receive_snapshot({"type": "wsn", "step": 9, "snap": "s9"})
+        self.assertEqual(self.feed.viewers, [waiting])
+        self.assertEqual(received(waiting)[0]["cmds"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
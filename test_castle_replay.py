@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from castle_game import CastleGameCommand, CastleGameModel
+from castle_replay import CastleReplayIndex, CastleReplayReader, CastleReplayRecorder, CastleReplaySimulation
+
+
+class Match:
+    """Stands in for a started CastleMatch; the recorder only reads its settings."""
+    def __init__(self, roster):
+        self.match_id = 7
+        self.player_pos = [object() if pos in roster else None for pos in range(4)]
+        self.frames_per_lock_step = 5
+        self.input_delay = 2
+
+
+# [turn, cmd] bundles of a short match between purple and pink
+BUNDLES = {
+    3: [[3, CastleGameCommand.Build(0, CastleGameCommand.Build.HOUSE, 1, 1).serialize()],
+        [3, CastleGameCommand.Build(1, CastleGameCommand.Build.TOWER, 6, 1).serialize()]],
+    9: [[9, CastleGameCommand.Build(0, CastleGameCommand.Build.MARKET, 2, 0).serialize()]],
+    23: [[23, CastleGameCommand.Build(1, CastleGameCommand.Build.HOUSE, 6, 2).serialize()]],
+}
+
+
+def play(model, step):
+    # Run lockstep step on model the way every client does
+    for turn, cmd in BUNDLES.get(step, []):
+        CastleGameCommand.decode_command(cmd).apply_to(model)
+    model.tick_lock_step()
+    model.advance(5)
+
+
+class CastleReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.recorder = CastleReplayRecorder(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, last_step, keyframe_interval=None):
+        # Record lka for every step up to last_step, the way CastleMatch does. A
+        # client uploads the snapshot after every keyframe_interval locksteps; it
+        # reaches the server a few lka later
+        writer = self.recorder.open(Match([0, 1]))
+        model = CastleGameModel(None, [0, 1], None)
+        uploads = []
+        for step in range(2, last_step + 1):
+            writer.record_allow(step, BUNDLES.get(step - 1, []))
+            play(model, step - 1)
+            if keyframe_interval and (step - 1) % keyframe_interval == 0:
+                uploads.append((step - 1, model.snapshot()))
+            if uploads and uploads[0][0] + 3 <= step:
+                writer.record_keyframe(*uploads.pop(0))
+        writer.close()
+        self.recorder.stop()
+        return CastleReplayReader(writer.path)
+
+    def test_round_trip(self):
+        reader = self.record(40)
+        self.assertEqual(reader.match_id, 7)
+        self.assertEqual(reader.roster, [0, 1])
+        self.assertEqual((reader.frames_per_lock_step, reader.input_delay), (5, 2))
+        self.assertEqual(reader.last_step, 40)
+        recorded = [[turn, cmd] for offset, turn, cmd in reader.commands()]
+        self.assertEqual(recorded, BUNDLES[3] + BUNDLES[9] + BUNDLES[23])
+        reader.close()
+
+    def test_simulation_matches_the_clients(self):
+        reader = self.record(40)
+        simulation = CastleReplaySimulation(reader)
+        simulation.run()
+
+        model = CastleGameModel(None, [0, 1], None)
+        for step in range(1, 40):
+            play(model, step)
+        self.assertEqual(simulation.lock_step_id, 39)
+        self.assertEqual(simulation.command_count, 4)
+        self.assertEqual(simulation.model.snapshot(), model.snapshot())
+        reader.close()
+
+    def seek_matches_run(self, reader, index, turns):
+        for turn in turns:
+            simulation = CastleReplaySimulation(reader)
+            simulation.seek(turn, index)
+            expected = CastleReplaySimulation(reader)
+            expected.run(turn)
+            self.assertEqual(simulation.lock_step_id, turn)
+            self.assertEqual(simulation.model.snapshot(), expected.model.snapshot())
+
+    def test_index_from_recorded_keyframes(self):
+        reader = self.record(60, keyframe_interval=10)
+        self.assertEqual([x[0] for x in reader.keyframes], [10, 20, 30, 40, 50])
+        index = CastleReplayIndex.from_keyframes(reader, 10)
+        self.assertEqual(index.count, 6)
+        self.assertEqual(index.keyframe_for(25)[0], 20)
+        self.assertEqual(index.keyframe_for(9)[0], 0)
+        self.seek_matches_run(reader, index, [0, 5, 20, 23, 24, 37, 59])
+        index.close()
+        reader.close()
+
+    def test_index_with_missing_keyframes(self):
+        reader = self.record(60, keyframe_interval=25)
+        index = CastleReplayIndex.from_keyframes(reader, 10)
+        self.assertEqual([index.keyframe_for(x)[0] for x in range(0, 60, 10)], [0, 0, 0, 25, 25, 50])
+        self.seek_matches_run(reader, index, [24, 26, 49, 59])
+        index.close()
+        reader.close()
+
+    def test_index_built_by_simulation(self):
+        reader = self.record(60)
+        self.assertEqual(reader.keyframes, [])
+        index = CastleReplayIndex.build(reader, 10)
+        self.assertEqual(index.keyframe_for(25)[0], 20)
+        self.seek_matches_run(reader, index, [5, 23, 59])
+        index.close()
+        reader.close()
+
+    def test_long_command(self):
+        writer = self.recorder.open(Match([0, 1]))
+        writer.record_allow(2, [[1, "x" * 70000]])
+        writer.close()
+        self.recorder.stop()
+        reader = CastleReplayReader(writer.path)
+        self.assertEqual([len(cmd) for offset, turn, cmd in reader.commands()], [70000])
+        reader.close()
+
+    def test_bad_chunk_is_dropped(self):
+        writer = self.recorder.open(Match([0, 1]))
+        writer.record_allow(2, [[-1, "bad turn"]])
+        writer.flush()
+        writer.record_allow(3, BUNDLES[3])
+        writer.close()
+        self.recorder.stop()
+        reader = CastleReplayReader(writer.path)
+        self.assertEqual([[turn, cmd] for offset, turn, cmd in reader.commands()], BUNDLES[3])
+        self.assertEqual(reader.last_step, 3)
+        reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+
+try:
+    from twisted.test.proto_helpers import StringTransport
+    from castle_server import CastleLockstepBarrier, CastleMatch, CastleServer, CastleServerProtocol
+except ImportError:     # Twisted is not installed
+    CastleServer = None
+
+
+class Player:
+    """Stands in for a seated CastleServerProtocol; only its position is read."""
+    def __init__(self, pos):
+        self.own_position = pos
+
+
+@unittest.skipIf(CastleServer is None, "needs Twisted")
+class CastleLockstepBarrierTest(unittest.TestCase):
+    def setUp(self):
+        self.barrier = CastleLockstepBarrier(delay=2)
+        for pos in (0, 1, 2):
+            self.barrier.add(pos)
+
+    def test_allowed_step_follows_slowest(self):
+        self.assertEqual(self.barrier.allowed_step, 2)
+        self.assertFalse(self.barrier.finish(0, 1))
+        self.assertFalse(self.barrier.finish(1, 3))
+        self.assertEqual(self.barrier.allowed_step, 2)
+        self.assertTrue(self.barrier.finish(2, 1))
+        self.assertEqual(self.barrier.allowed_step, 3)
+        self.assertEqual(sorted(self.barrier.slowest()), [0, 2])
+
+    def test_old_and_unknown_steps_are_ignored(self):
+        self.barrier.finish(0, 5)
+        self.assertFalse(self.barrier.finish(0, 4))
+        self.assertFalse(self.barrier.finish(7, 9))
+        self.assertEqual(self.barrier.steps[0], 5)
+
+    def test_slowest_leaving_moves_barrier(self):
+        self.barrier.finish(0, 4)
+        self.barrier.finish(1, 6)
+        self.assertTrue(self.barrier.remove(2))
+        self.assertEqual(self.barrier.allowed_step, 6)
+        self.assertFalse(self.barrier.remove(2))
+        self.assertEqual(len(self.barrier), 2)
+
+
+@unittest.skipIf(CastleServer is None, "needs Twisted")
+class CastleMatchBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.match = CastleMatch(CastleServer(None), 0)
+        self.match.start_game()
+
+    def queue(self, pos, turn, cmd):
+        self.match.queue_command(Player(pos), {"lturn": turn, "cmd": cmd})
+
+    def test_bundle_orders_by_turn_position_arrival(self):
+        allowed = self.match.allowed_step
+        self.queue(2, allowed + 1, "c")
+        self.queue(1, allowed, "b")
+        self.queue(2, allowed, "a1")
+        self.queue(0, allowed + 1, "d")
+        self.queue(2, allowed, "a2")
+        self.match.advance_allowed_step(allowed + 2)
+        self.assertEqual(self.match.command_log, [[allowed, "b"], [allowed, "a1"], [allowed, "a2"],
+                                                  [allowed + 1, "d"], [allowed + 1, "c"]])
+
+    def test_only_turns_below_allowed_step_are_sent(self):
+        allowed = self.match.allowed_step
+        self.queue(0, allowed + 3, "later")
+        self.match.advance_allowed_step(allowed + 1)
+        self.assertEqual(self.match.command_log, [])
+        self.assertEqual(self.match.turn_commands, {allowed + 3: [(0, "later")]})
+
+    def test_late_commands_are_dropped(self):
+        allowed = self.match.allowed_step
+        self.match.advance_allowed_step(allowed + 1)
+        self.queue(0, allowed, "late")
+        self.assertEqual(self.match.turn_commands, {})
+
+    def test_oversize_commands_are_dropped(self):
+        allowed = self.match.allowed_step
+        self.queue(0, allowed, "x" * (CastleMatch.MAX_COMMAND_LENGTH + 1))
+        self.assertEqual(self.match.turn_commands, {})
+
+
+@unittest.skipIf(CastleServer is None, "needs Twisted")
+class CastleMatchStallTest(unittest.TestCase):
+    def start(self, policy):
+        # Three seated players; nobody finished a step yet
+        self.match = CastleMatch(CastleServer(None, stall_policy=policy, stall_grace=3.0), 0)
+        for pos in (0, 1, 2):
+            player = CastleServerProtocol(self.match.server)
+            player.transport = StringTransport()
+            self.match.add_player(player)
+            self.match.player_pos[pos] = player
+            player.own_position = pos
+        self.match.start_game()
+        for player in self.match.players:
+            player.transport.clear()
+
+    def finish(self, pos, step):
+        self.match.player_finish_lockstep(self.match.player_pos[pos], step)
+
+    def stall_player_2(self):
+        # 0 and 1 wait at the barrier for 2, which stopped sending lkf
+        allowed = self.match.allowed_step
+        self.finish(0, allowed - 1)
+        self.finish(1, allowed - 1)
+        self.assertEqual(self.match.allowed_step, allowed)
+        self.match.check_stall(self.match.waiting_since + 2.9)
+        self.assertEqual(self.match.allowed_step, allowed)
+        self.match.check_stall(self.match.waiting_since + 3.0)
+        return allowed
+
+    def test_no_policy_waits_forever(self):
+        self.start(None)
+        allowed = self.stall_player_2()
+        self.match.check_stall(self.match.waiting_since + 3600)
+        self.assertEqual(self.match.allowed_step, allowed)
+
+    def test_spectate_drops_the_stalled_player_for_good(self):
+        self.start(CastleServer.STALL_POLICY_SPECTATE)
+        allowed = self.stall_player_2()
+        self.assertEqual(self.match.spectators, set([2]))
+        self.assertEqual(self.match.allowed_step, allowed + self.match.input_delay - 1)
+        self.assertIn('"err"', self.match.player_pos[2].transport.value())
+        # it keeps getting lka, but its commands and lkf no longer count
+        self.assertIn('"lka"', self.match.player_pos[2].transport.value())
+        self.match.queue_command(self.match.player_pos[2], {"lturn": self.match.allowed_step, "cmd": "x"})
+        self.assertEqual(self.match.turn_commands, {})
+        self.finish(2, self.match.allowed_step - 1)
+        self.assertNotIn(2, self.match.barrier.steps)
+
+    def test_empty_benches_the_player_until_it_caught_up(self):
+        self.start(CastleServer.STALL_POLICY_EMPTY)
+        allowed = self.stall_player_2()
+        self.assertEqual(self.match.benched, set([2]))
+        self.assertEqual(self.match.allowed_step, allowed + self.match.input_delay - 1)
+        # still behind the others: stays out of the barrier
+        self.finish(2, self.match.barrier.min_step - 1)
+        self.assertEqual(self.match.benched, set([2]))
+        # caught up: holds the barrier again
+        self.finish(2, self.match.barrier.min_step)
+        self.assertEqual(self.match.benched, set())
+        self.assertIn(2, self.match.barrier.steps)
+
+    def test_nobody_is_dropped_when_everyone_is_behind(self):
+        self.start(CastleServer.STALL_POLICY_SPECTATE)
+        allowed = self.match.allowed_step
+        self.match.check_stall(self.match.waiting_since + 60)
+        self.assertEqual(self.match.allowed_step, allowed)
+        self.assertEqual(self.match.spectators, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
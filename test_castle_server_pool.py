@@ -0,0 +1,43 @@
+import json
+import unittest
+
+try:
+    from twisted.test.proto_helpers import StringTransport
+    from castle_server import CastleServerProtocol
+    from castle_server_pool import CastleFlushWatcher
+except ImportError:     # Twisted is not installed
+    CastleFlushWatcher = None
+
+
+@unittest.skipIf(CastleFlushWatcher is None, "needs Twisted")
+class CastleFlushWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.player = CastleServerProtocol(None)
+        self.player.transport = StringTransport()
+        self.player.transport.write("ap\r\n")
+        self.watcher = CastleFlushWatcher(self.player)
+        self.flushed = []
+        self.watcher.flushed.addCallback(self.flushed.append)
+
+    def test_flushed_after_the_ping_went_out(self):
+        # Asked for data when registered: write a ping behind what is buffered
+        self.player.transport.registerProducer(self.watcher, False)
+        self.watcher.resumeProducing()
+        lines = self.player.transport.value().split("\r\n")
+        self.assertEqual(lines[0], "ap")
+        self.assertEqual(json.loads(lines[1])["type"], CastleServerProtocol.PAYLOAD_TYPE_PING)
+        self.assertEqual(self.flushed, [])
+        # Asked again once the buffer ran empty
+        self.watcher.resumeProducing()
+        self.assertEqual(self.flushed, [self.player])
+        self.assertEqual(self.player.transport.producer, None)
+
+    def test_lost_connection(self):
+        self.player.transport.registerProducer(self.watcher, False)
+        self.watcher.resumeProducing()
+        self.watcher.stopProducing()
+        self.assertEqual(self.flushed, [None])
+
+
+if __name__ == "__main__":
+    unittest.main()